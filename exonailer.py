@@ -2,37 +2,71 @@
 import sys
 sys.path.append('utilities')
 import os
-import data_utils
+import argparse
 import general_utils
 import numpy as np
 
 ################# OPTIONS ######################
 
+parser = argparse.ArgumentParser(description='Fits transit and/or RV data with the options in options_file.dat.')
+parser.add_argument('--estimate', action='store_true', help='Dry run: does the whole set-up of the fit, times '+\
+                                                             'the posterior evaluations and projects the cost of the fit '+\
+                                                             'without running it.')
+parser.add_argument('--grid-noise-models', default=None, help='Comma-separated list of the noise models (e.g., '+\
+                                                              '"white,flicker,GPGranulation") of a grid of fits, which '+\
+                                                              'are applied to all the transit instruments.')
+parser.add_argument('--grid-ld-laws', default=None, help='Comma-separated list of the limb-darkening laws (e.g., '+\
+                                                         '"quadratic,squareroot,logarithmic") of a grid of fits, which '+\
+                                                         'are applied to all the transit instruments.')
+parser.add_argument('--inject-periods', default=None, help='Comma-separated list of the periods (in days) of the transits '+\
+                                                           'injected in an injection-recovery test.')
+parser.add_argument('--inject-radii', default=None, help='Comma-separated list of the planet-to-star radius ratios of the '+\
+                                                         'transits injected in an injection-recovery test.')
+parser.add_argument('--inject-trials', type=int, default=1, help='Number of trials (with random times of transit and '+\
+                                                                 'impact parameters) for each period and radius ratio.')
+parser.add_argument('--inject-bmax', type=float, default=0.8, help='Maximum impact parameter of the injected transits.')
+parser.add_argument('--inject-seed', type=int, default=0, help='Seed of the random draws of the injection-recovery trials.')
+args = parser.parse_args()
+
 options = general_utils.read_input_parameters()
 
 ################################################
 
+# If plots are made in batch mode, use a non-interactive backend
+# (this has to be done before pyplot is imported):
+if options['PLOT'].lower() == 'batch':
+    import matplotlib
+    matplotlib.use('Agg')
+import data_utils
+
 # ---------- DATA PRE-PROCESSING ------------- #
 
 # First, get the transit and RV data:
 t_tr,f,f_err,transit_instruments,t_rv,rv,rv_err,rv_instruments = general_utils.read_data(options)
 
-# Sort transit data if there is any:
 # Initialize the parameters:
 parameters = general_utils.read_priors(options['TARGET'],options['MODE'])
 
+# On injection-recovery runs, inject transits in the (raw) transit data and fit them, saving 
+# the injected and recovered parameters (each trial is pre-processed on its own):
+if args.inject_periods is not None or args.inject_radii is not None:
+    if args.inject_periods is None or args.inject_radii is None:
+        print 'Error: injection-recovery tests need both --inject-periods and --inject-radii. Exiting...'
+        sys.exit()
+    periods = np.array(args.inject_periods.split(',')).astype('float64')
+    radii = np.array(args.inject_radii.split(',')).astype('float64')
+    data_utils.run_injection_recovery(t_tr, f, f_err, transit_instruments, parameters, options, periods, radii,\
+                                      args.inject_trials, args.inject_seed, args.inject_bmax)
+    sys.exit()
+
 # Pre-process the transit data if available:
 if options['MODE'] != 'rvs':
-    t_tr,phases,f, f_err,transit_instruments = data_utils.pre_process(t_tr,f,f_err,options,transit_instruments,parameters)
-    idx = np.argsort(t_tr)
-    t_tr = t_tr[idx]
-    f = f[idx]
-    f_err = f_err[idx]
-    phases = phases[idx]
-    transit_instruments = transit_instruments[idx]
+    # (the data is sorted by instrument, and in time within each instrument; transit_instruments
+    # is the instrument registry, with the slice of the data of each instrument):
+    t_tr,phases,f, f_err,transit_instruments,oot_summaries = data_utils.pre_process(t_tr,f,f_err,options,transit_instruments,parameters)
     idx_resampling = {}
-    for instrument in options['photometry'].keys():
-        idx = np.where(transit_instruments==instrument)[0]
+    for instrument in transit_instruments['names']:
+        idx = transit_instruments['slices'][instrument]
         if options['photometry'][instrument]['RESAMPLING']:
             # Define indexes between which data will be resampled:
             idx_resampling[instrument] = np.where((phases[idx]>-options['photometry'][instrument]['PHASE_MAX_RESAMPLING'])&\
@@ -41,30 +75,60 @@ if options['MODE'] != 'rvs':
             idx_resampling[instrument] = []
 else:
     idx_resampling = []
+    oot_summaries = {}
 # Create results folder if not already created:
 if not os.path.exists('results'):
     os.mkdir('results')
 
-mode = options['MODE']
 target = options['TARGET']
-fname = target+'_'+mode+'_'
-if options['MODE'] != 'rvs':
-    for instrument in options['photometry'].keys():
-        fname = fname + instrument +'_'+options['photometry'][instrument]['PHOT_NOISE_MODEL']+\
-                      '_'+options['photometry'][instrument]['LD_LAW']+'_'
-out_dir = 'results/'+fname[:-1]+'/'
+out_dir = general_utils.get_out_dir(options)
+
+# On dry runs, only estimate the cost of the fit (as it would be run) and save it:
+if args.estimate:
+    warm_start = None
+    if options['WARM_START'].lower() == 'yes' and os.path.exists(out_dir+'posteriors.pkl'):
+        warm_start = general_utils.read_posteriors(out_dir)
+    print '\t Estimating the cost of the fit...'
+    estimate = data_utils.exonailer_mcmc_fit(t_tr, f, f_err, transit_instruments, t_rv, rv, rv_err, rv_instruments,\
+                                             parameters, idx_resampling, options, warm_start, estimate = True)
+    general_utils.save_cost_estimate(options,estimate)
+    sys.exit()
 
-# If chains not ran, run the MCMC and save results:
-if not os.path.exists(out_dir):
-    print '\t Starting MCMC...'
-    data_utils.exonailer_mcmc_fit(t_tr, f, f_err, transit_instruments, t_rv, rv, rv_err, rv_instruments,\
-                                     parameters, idx_resampling, options)
+# On grid runs, fit every combination of the given noise models and limb-darkening laws to the 
+# (already pre-processed) data, in parallel, and save the table comparing them:
+if args.grid_noise_models is not None or args.grid_ld_laws is not None:
+    noise_models,ld_laws = None,None
+    if args.grid_noise_models is not None:
+        noise_models = args.grid_noise_models.split(',')
+    if args.grid_ld_laws is not None:
+        ld_laws = args.grid_ld_laws.split(',')
+    rows = data_utils.run_model_grid(t_tr, f, f_err, transit_instruments, t_rv, rv, rv_err, rv_instruments,\
+                                     parameters, idx_resampling, options, noise_models, ld_laws)
+    general_utils.save_model_grid(options,rows)
+    sys.exit()
 
-    general_utils.save_results(target,options,parameters)
+# If chains not ran (or if a warm-started refit is asked), run the MCMC and save results (the 
+# results folder might exist without posteriors, e.g., with the progress records of an interrupted fit):
+if not os.path.exists(out_dir+'posteriors.pkl') or options['WARM_START'].lower() == 'yes':
+    warm_start = None
+    if os.path.exists(out_dir+'posteriors.pkl'):
+        print '\t Warm-starting the fit from the previous posteriors...'
+        warm_start = general_utils.read_posteriors(out_dir)
+    if options['FIT_METHOD'].lower() == 'map':
+        print '\t Starting MAP fit...'
+    else:
+        print '\t Starting MCMC...'
+    diagnostics = data_utils.exonailer_mcmc_fit(t_tr, f, f_err, transit_instruments, t_rv, rv, rv_err, rv_instruments,\
+                                                parameters, idx_resampling, options, warm_start)
+
+    general_utils.save_results(target,options,parameters,diagnostics)
 
 else:
     parameters = general_utils.read_results(target,options,transit_instruments,rv_instruments)
 
+# Save the summaries of the out-of-transit data discarded by the pre-processing, if any:
+general_utils.save_oot_summaries(out_dir,oot_summaries)
+
 if options['MODE'] != 'transit_noise':
     data_utils.plot_transit_and_rv(t_tr, f, f_err, transit_instruments, t_rv, rv, rv_err, rv_instruments,\
                                    parameters, idx_resampling, options)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import sys
+sys.path.append('utilities')
+import os
+import json
+import argparse
+import numpy as np
+import general_utils
+
+G = 6.67408e-11 # Grav. constant in mks
+
+################# OPTIONS ######################
+
+parser = argparse.ArgumentParser(description='Importance-reweights the posterior samples of an existing exonailer fit '+\
+                                             'to a new set of priors, without re-running the MCMC.')
+parser.add_argument('results_dir', help='Folder with the results of the fit (e.g., results/my_target_full_.../).')
+parser.add_argument('priors_file', help='File with the new priors (same format as the files in priors_data).')
+parser.add_argument('--stellardensity', default=None, help='New stellar density constraint, "mean,error" (in kg/m^3).')
+parser.add_argument('--old-stellardensity', default=None, help='Stellar density constraint used in the original fit, '+\
+                                                               'if any, "mean,error" (in kg/m^3).')
+parser.add_argument('--nsamples', type=int, default=None, help='Number of samples to draw from the reweighted '+\
+                                                               'posterior. Default is the number of stored samples.')
+parser.add_argument('--out_dir', default=None, help='Folder for the reweighted results. Default is results_dir '+\
+                                                    'with a "_reweighted" suffix.')
+args = parser.parse_args()
+
+################################################
+
+results_dir = os.path.join(args.results_dir,'')
+if args.out_dir is None:
+    out_dir = results_dir[:-1]+'_reweighted/'
+else:
+    out_dir = os.path.join(args.out_dir,'')
+
+old_priors = general_utils.read_priors(None,None,filename = results_dir+'priors.dat')
+new_priors = general_utils.read_priors(None,None,filename = args.priors_file)
+posteriors = general_utils.read_posteriors(results_dir)
+nsamples = len(posteriors.values()[0])
+
+# As the likelihood is the same, the importance weights of the stored posterior samples are
+# the ratio between the new and the old priors:
+ln_weights = np.zeros(nsamples)
+for parameter in new_priors.keys():
+    if parameter not in old_priors.keys():
+        print 'Error: parameter '+parameter+' was not in the original fit. A new fit is needed. Exiting...'
+        sys.exit()
+    if new_priors[parameter]['type'] == 'FIXED' or old_priors[parameter]['type'] == 'FIXED':
+        if new_priors[parameter]['type'] != old_priors[parameter]['type'] or \
+           new_priors[parameter]['object'].value != old_priors[parameter]['object'].value:
+            print 'Error: parameter '+parameter+' is fixed in one of the fits but not in the other (or it is fixed '+\
+                  'to a different value). A new fit is needed. Exiting...'
+            sys.exit()
+        continue
+    ln_weights = ln_weights + general_utils.get_ln_prior_samples(new_priors[parameter],posteriors[parameter]) - \
+                              general_utils.get_ln_prior_samples(old_priors[parameter],posteriors[parameter])
+for parameter in old_priors.keys():
+    if parameter not in new_priors.keys():
+        print 'Error: parameter '+parameter+' is not in the new priors. A new fit is needed. Exiting...'
+        sys.exit()
+
+# Stellar density constraints (see the STELLARDENSITY option), which are applied on a/R* and P:
+for sd,sign in [(args.stellardensity,1.),(args.old_stellardensity,-1.)]:
+    if sd is not None:
+        sd_mean,sd_sigma = np.array(sd.split(',')).astype('float64')
+        if 'a' not in posteriors.keys():
+            print 'Error: the stellar density constraint needs a single a/R* parameter (a). Exiting...'
+            sys.exit()
+        if 'P' in posteriors.keys():
+            P = posteriors['P']
+        else:
+            P = old_priors['P']['object'].value
+        model = ((3.*np.pi)/(G*(P*(24.*3600.0))**2))*(posteriors['a'])**3
+        ln_weights = ln_weights - sign*0.5*((model-sd_mean)/sd_sigma)**2
+
+if not np.any(np.isfinite(ln_weights)):
+    print 'Error: none of the stored samples are within the support of the new priors. A new fit is needed. Exiting...'
+    sys.exit()
+weights = np.exp(ln_weights - np.max(ln_weights))
+weights = weights/np.sum(weights)
+ess = 1./np.sum(weights**2)
+print '\t Effective sample size of the reweighted posterior: {0:.1f} ({1:.1f}% of {2:} samples).'.format(ess,100.*ess/nsamples,nsamples)
+if ess < 0.1*nsamples:
+    print '\t Warning: the new priors are too different from the old ones for the reweighting to be reliable. '+\
+          'Consider doing a new fit.'
+
+# Resample the stored posterior samples according to their weights:
+if args.nsamples is None:
+    args.nsamples = nsamples
+idx = np.random.choice(nsamples,args.nsamples,p=weights)
+if not os.path.exists(out_dir):
+    os.mkdir(out_dir)
+os.system('cp '+args.priors_file+' '+out_dir+'priors.dat')
+for parameter in new_priors.keys():
+    if new_priors[parameter]['type'] != 'FIXED':
+        new_priors[parameter]['object'].set_posterior(np.copy(posteriors[parameter][idx]))
+general_utils.write_posteriors(out_dir,new_priors,'the importance-reweighted samples of '+results_dir)
+f = open(out_dir+'reweighting.json','w')
+json.dump({'results_dir':results_dir,'priors_file':args.priors_file,'stellardensity':args.stellardensity,\
+           'old_stellardensity':args.old_stellardensity,'nsamples':nsamples,'ess':float(ess),\
+           'ess_fraction':float(ess/nsamples),'max_weight':float(np.max(weights))},f,indent=2,sort_keys=True)
+f.close()
+print '\t Done! Results saved in '+out_dir
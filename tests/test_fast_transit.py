@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','utilities'))
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import data_utils
+
+def get_times(state):
+    # Sorted times with gaps, as in multi-sector or multi-night photometry:
+    t = np.sort(np.concatenate([state.uniform(0.,13.,3000),state.uniform(27.,40.,3000),state.uniform(100.,100.3,200)]))
+    return t
+
+def test_fast_light_curve_matches_full_model():
+    state = np.random.RandomState(3)
+    t = get_times(state)
+    for law in ['linear','quadratic','squareroot','logarithmic']:
+        params,m = data_utils.init_batman(t,law=law)
+        m_fast = data_utils.init_fast_model(m,params)
+        # The fast model is reused for all the evaluations, as in the fit:
+        for trial in range(30):
+            params.t0 = state.uniform(0.,5.)
+            params.per = state.uniform(0.5,20.)
+            params.rp = state.uniform(0.01,0.2)
+            params.a = state.uniform(2.,40.)
+            params.inc = np.arccos(state.uniform(0.,1.1)/params.a)*180./np.pi
+            params.ecc = state.choice([0.,state.uniform(0.,0.6)])
+            params.w = state.uniform(0.,360.)
+            if law == 'linear':
+                params.u = [state.uniform(0.,1.)]
+            else:
+                params.u = [state.uniform(0.,0.5),state.uniform(0.,0.3)]
+            fast_model = data_utils.get_fast_light_curve(m,m_fast,params)
+            full_model = m.light_curve(params)
+            assert np.max(np.abs(fast_model-full_model)) < 1e-10
+
+def test_fast_light_curve_without_points_in_transit():
+    t = np.linspace(0.,0.2,100)
+    params,m = data_utils.init_batman(t,law='quadratic')
+    m_fast = data_utils.init_fast_model(m,params)
+    params.t0 = 5.
+    params.per = 10.
+    assert np.all(data_utils.get_fast_light_curve(m,m_fast,params) == 1.)
+    params.t0 = 0.1
+    assert np.max(np.abs(data_utils.get_fast_light_curve(m,m_fast,params)-m.light_curve(params))) < 1e-10
+
+def test_fast_light_curve_on_resampled_times():
+    # Resampled times of the points near the transits, built as in the fit (eq. (35) in Kipping 2010):
+    t = np.arange(0.,20.,0.02)
+    t = t[np.abs(((t-1.)/4.+0.5)%1.-0.5) < 0.05]
+    nresampling,texp = 20,0.02
+    t_resampling = (t[:,None]+((np.arange(1,nresampling+1)-(nresampling+1)/2.)*(texp/nresampling))[None,:]).flatten()
+    assert np.all(np.diff(t_resampling)>=0)
+    params,m = data_utils.init_batman(t_resampling,law='quadratic')
+    m_fast = data_utils.init_fast_model(m,params)
+    params.t0,params.per,params.rp,params.a,params.inc = 1.,4.,0.1,12.,89.
+    fast_model = data_utils.get_fast_light_curve(m,m_fast,params)
+    assert np.max(np.abs(fast_model-m.light_curve(params))) < 1e-10
+    assert np.any(fast_model < 1.)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','utilities'))
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import data_utils
+import Wavelets
+
+def get_options(noise_segments):
+    return {'photometry':{'TESS':{'NOISE_SEGMENTS':noise_segments,'SEGMENT_GAP':1.}}}
+
+def test_short_segments_are_merged():
+    # Segments of 1, 100, 2, 50 and 3 points:
+    t = np.concatenate([[0.],10.+0.01*np.arange(100),[20.,20.01],30.+0.01*np.arange(50),40.+0.01*np.arange(3)])
+    segments = data_utils.get_noise_segments(t,get_options(True),'TESS')
+    assert segments == [(0,103),(103,156)]
+    assert data_utils.get_noise_segments(t,get_options(False),'TESS') == [(0,len(t))]
+    # The wavelet transform of the 'flicker' model can be computed on all of them:
+    for start,end in segments:
+        Wavelets.getDWT(np.random.randn(end-start))
+
+def test_segments_cover_the_data():
+    state = np.random.RandomState(4)
+    for trial in range(50):
+        t = np.cumsum(state.choice([0.01,2.],size=state.randint(1,60),p=[0.7,0.3]))
+        segments = data_utils.get_noise_segments(t,get_options(True),'TESS')
+        assert segments[0][0] == 0 and segments[-1][1] == len(t)
+        for i in range(1,len(segments)):
+            assert segments[i][0] == segments[i-1][1]
+        if len(t) >= 4:
+            assert np.min([end-start for start,end in segments]) >= 4
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','utilities'))
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import data_utils
+import general_utils
+
+class Fixed(object):
+    def __init__(self,value):
+        self.value = value
+
+def get_parameters(P=3.,t0=1.):
+    values = {'P':P,'t0':t0,'a':10.,'p':0.1,'inc':89.,'q1':0.3,'q2':0.3,'ecc':0.,'omega':90.}
+    return dict([(name,{'object':Fixed(values[name])}) for name in values.keys()])
+
+def get_options(nomit):
+    photometry = {'PHOT_DETREND':None,'NOMIT':nomit,'PHOT_GET_OUTLIERS':False,'PHOT_TRANSIT_WINDOW':None,\
+                  'PHOT_OOT_SUMMARY':False,'LD_LAW':'quadratic'}
+    return {'MODE':'transit','NCPUS':1,'photometry':{'TESS':photometry}}
+
+def get_data(state):
+    t = np.linspace(0.,30.,3000)
+    f = 1.+1e-3*state.randn(len(t))
+    f_err = 1e-3*np.ones(len(t))
+    return t,f,f_err,general_utils.get_instrument_registry(np.zeros(len(t),dtype=int),times=t,names=['TESS'])
+
+def test_nomit_does_not_modify_the_input():
+    t,f,f_err,registry = get_data(np.random.RandomState(1))
+    f_input = np.copy(f)
+    out_t,out_phases,out_f,out_f_err,out_registry,summaries = \
+        data_utils.pre_process(t,f,f_err,get_options([2,5]),registry,get_parameters())
+    assert np.array_equal(f,f_input)
+    # Only the points within half a period of the omitted transits are removed:
+    phases = (t-1.)/3.
+    removed = ((phases>1.5)&(phases<2.5))|((phases>4.5)&(phases<5.5))
+    assert np.array_equal(out_t,t[~removed])
+    assert np.array_equal(out_f,f[~removed])
+    assert np.array_equal(out_f_err,f_err[~removed])
+
+def test_nomit_on_read_only_memory_maps(tmpdir):
+    t,f,f_err,registry = get_data(np.random.RandomState(2))
+    arrays = []
+    for name,array in [('t',t),('f',f),('f_err',f_err)]:
+        fname = str(tmpdir.join(name+'.npy'))
+        np.save(fname,array)
+        arrays.append(np.load(fname,mmap_mode='r'))
+    mt,mf,mf_err = arrays
+    out = data_utils.pre_process(mt,mf,mf_err,get_options([3]),registry,get_parameters())
+    expected = data_utils.pre_process(t,f,f_err,get_options([3]),registry,get_parameters())
+    for i in range(4):
+        assert np.array_equal(out[i],expected[i])
+    assert np.array_equal(mf,f)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','utilities'))
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import data_utils
+
+def brute_force_running_median(t,f,window,mask):
+    medians = np.zeros(len(t))*np.nan
+    for i in range(len(t)):
+        idx = (t >= t[i]-window/2.) & (t <= t[i]+window/2.) & (~mask)
+        if np.any(idx):
+            medians[i] = np.median(f[idx])
+    idx_nan = np.isnan(medians)
+    if np.all(idx_nan):
+        medians[:] = np.median(f)
+    elif np.any(idx_nan):
+        medians[idx_nan] = np.interp(t[idx_nan],t[~idx_nan],medians[~idx_nan])
+    return medians
+
+def test_running_median_matches_brute_force():
+    state = np.random.RandomState(42)
+    for trial in range(20):
+        n = state.randint(1,300)
+        # Times with gaps and repeated values:
+        t = np.sort(np.round(state.uniform(0.,10.,n),2))
+        f = state.normal(1.,0.01,n)
+        mask = state.uniform(0.,1.,n) < 0.3
+        window = state.uniform(0.05,3.)
+        medians = data_utils.running_median(t,f,window,mask)
+        assert np.allclose(medians,brute_force_running_median(t,f,window,mask),rtol=0.,atol=1e-14)
+
+def test_running_median_all_masked():
+    t = np.linspace(0.,1.,50)
+    f = np.linspace(1.,2.,50)
+    medians = data_utils.running_median(t,f,0.1,np.ones(50,dtype=bool))
+    assert np.all(medians == np.median(f))
+
+def test_running_median_filter_unsorted_input():
+    state = np.random.RandomState(1)
+    t = state.uniform(0.,10.,200)
+    f = state.normal(1.,0.01,200)
+    mask = np.zeros(200,dtype=bool)
+    filt = data_utils.get_running_median_filter((t,f,mask,0.5,None))
+    idx = np.argsort(t)
+    assert np.allclose(filt[idx],brute_force_running_median(t[idx],f[idx],0.5,mask),rtol=0.,atol=1e-14)
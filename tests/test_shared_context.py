@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','utilities'))
+import signal
+import numpy as np
+import parallel_utils
+
+def test_close_restores_the_sigterm_handler():
+    previous = signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    try:
+        context = parallel_utils.SharedContext({'x':np.arange(10.)},{'name':'test'})
+        path = context.path
+        assert signal.getsignal(signal.SIGTERM) != signal.SIG_DFL
+        arrays,meta = parallel_utils.attach_context(path)
+        assert np.array_equal(arrays['x'],np.arange(10.)) and meta == {'name':'test'}
+        context.close()
+        assert not os.path.exists(path)
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+    finally:
+        signal.signal(signal.SIGTERM,previous)
+
+def test_other_sigterm_handlers_are_kept():
+    handler = lambda signum,frame: None
+    previous = signal.signal(signal.SIGTERM,handler)
+    try:
+        context = parallel_utils.SharedContext({'x':np.arange(10.)},{})
+        assert signal.getsignal(signal.SIGTERM) == handler
+        context.close()
+        assert signal.getsignal(signal.SIGTERM) == handler
+    finally:
+        signal.signal(signal.SIGTERM,previous)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','utilities'))
+import time
+import threading
+import numpy as np
+from multiprocessing.connection import Listener
+import parallel_utils
+
+AUTHKEY = 'test-key'
+
+def start_fake_worker(evaluate):
+    # Serves one SocketPool connection as serve_worker does, with evaluate giving the reply to each batch:
+    listener = Listener(('127.0.0.1',0),authkey=AUTHKEY)
+    def serve():
+        connection = listener.accept()
+        connection.recv()
+        connection.send(('ready',0))
+        while True:
+            try:
+                command,positions = connection.recv()
+            except EOFError:
+                break
+            if command == 'close':
+                break
+            connection.send(evaluate(positions))
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return '{0:}:{1:}'.format(*listener.address)
+
+def ok(positions):
+    return ('ok',[np.sum(position) for position in positions])
+
+def slow(positions):
+    time.sleep(0.5)
+    return ok(positions)
+
+def fail(positions):
+    return ('error','Traceback: fake error')
+
+def hang(positions):
+    threading.Event().wait()
+
+def test_error_drains_the_other_workers(monkeypatch):
+    monkeypatch.setenv('EXONAILER_AUTHKEY',AUTHKEY)
+    pool = parallel_utils.SocketPool({},{},[start_fake_worker(fail),start_fake_worker(slow)],timeout=10.)
+    positions = [np.arange(3)+i for i in range(4)]
+    try:
+        pool.map(None,positions)
+        assert False
+    except RuntimeError as e:
+        assert 'fake error' in str(e)
+    # The reply of the slow worker was read before raising, so no reply is left pending:
+    for worker in pool.workers:
+        assert not worker['connection'].poll(1.)
+    pool.close()
+
+def test_hung_worker_is_dropped(monkeypatch):
+    monkeypatch.setenv('EXONAILER_AUTHKEY',AUTHKEY)
+    addresses = [start_fake_worker(ok),start_fake_worker(hang)]
+    pool = parallel_utils.SocketPool({},{},addresses,timeout=1.)
+    positions = [np.arange(3)+i for i in range(8)]
+    assert pool.map(None,positions) == [np.sum(position) for position in positions]
+    pool.close()
+    assert pool.stats['lost'] == [addresses[1]]
+    assert pool.stats['requeued_batches'] >= 1
@@ -14,6 +14,9 @@ try:
     from celerite import terms
 except:
     print 'Warning! The celerite package is not installed. Some GP functionalities will not work.'
+import sys
+import time
+from StringIO import StringIO
 import numpy as np
 import batman
 import radvel
@@ -22,6 +25,12 @@ G = 6.67408e-11 # Grav. constant in mks
 # This defines prior distributions that need samples to be
 # controlled so they don't get out of their support:
 prior_distributions = ['Uniform','Jeffreys','Beta']
+# Parameters of the correlated noise models of the photometry (besides sigma_w), and the ones
+# of these models which are gaussian processes:
+noise_model_params = {'flicker':['sigma_r'],'GPExpSquaredKernel':['lnh','lnlambda'],'GPMatern32':['lnh','lnlambda'],\
+                      'GPGranulation':['lnomega','lnS'],\
+                      'GPAsteroseismology':['lnomega','lnS','lnQ','lnA','epsilon','lnW','lnnu','lnDeltanu']}
+gp_noise_models = ['GPExpSquaredKernel','GPMatern32','GPGranulation','GPAsteroseismology']
 
 def get_sigma(x,median):
     """
@@ -36,6 +45,219 @@ def get_phases(t,P,t0):
     phase[ii] = phase[ii]-1.0
     return phase
 
+def get_transit_duration(P,a,p,inc,ecc=0.,omega=90.):
+    """
+    This function returns the total transit duration (from first to fourth contact)
+    using eq. (14) and (16) in Winn (2010), in the same units as the period. If the
+    planet does not transit, it returns zero.
+    """
+    factor = (1.-ecc**2)/(1.+ecc*np.sin(omega*np.pi/180.))
+    b = a*np.cos(inc*np.pi/180.)*factor
+    if b >= 1.+p:
+        return 0.
+    arg = np.sqrt((1.+p)**2 - b**2)/(a*np.sin(inc*np.pi/180.))
+    return (P/np.pi)*np.arcsin(np.min([arg,1.]))*np.sqrt(1.-ecc**2)/(1.+ecc*np.sin(omega*np.pi/180.))
+
+def get_segments(t,max_gap=None):
+    """
+    Given a sorted array of times, this function returns the (start,end) indexes of
+    the contiguous segments of data, i.e., the chunks of data separated by gaps
+    larger than max_gap. If max_gap is not given, ten times the median cadence is used.
+    """
+    if len(t) < 2:
+        return [(0,len(t))]
+    dt = np.diff(t)
+    if max_gap is None:
+        max_gap = 10.*np.median(dt)
+    breaks = np.where(dt > max_gap)[0]+1
+    starts = np.append(0,breaks)
+    ends = np.append(breaks,len(t))
+    return zip(starts,ends)
+
+def get_noise_segments(t,options,instrument,min_length=4):
+    """
+    This function returns the (start,end) indexes of the segments of the (sorted) times t of an 
+    instrument on which its correlated noise likelihood is evaluated independently: the contiguous 
+    segments of the data (see get_segments) if NOISE_SEGMENTS is set, and all the data otherwise. 
+    Segments of less than min_length points (which the wavelet transform of the 'flicker' model 
+    cannot handle) are merged with the previous segment (or the next one, for the first segment).
+    """
+    if not options['photometry'][instrument]['NOISE_SEGMENTS']:
+        return [(0,len(t))]
+    segments = []
+    for start,end in get_segments(t,options['photometry'][instrument]['SEGMENT_GAP']):
+        if len(segments) > 0 and (end-start < min_length or segments[-1][1]-segments[-1][0] < min_length):
+            segments[-1] = (segments[-1][0],end)
+        else:
+            segments.append((start,end))
+    return segments
+
+import heapq
+def running_median(t,f,window,mask=None):
+    """
+    This function returns the running median of f evaluated at each of the (sorted)
+    times t, using all the points within a time window of total length window
+    centered on each time. Points for which mask is True are not used to compute the
+    medians (but the median is still evaluated at their times). It uses two heaps
+    with lazy deletion, so the cost is O(N log w), where w is the number of points
+    on the window. If there are no usable points on a window, the median is
+    interpolated from the neighbouring ones.
+    """
+    n = len(t)
+    if mask is None:
+        mask = np.zeros(n,dtype=bool)
+    medians = np.zeros(n)*np.nan
+    low,high = [],[]              # Max-heap (stored as negatives) and min-heap
+    side = np.zeros(n,dtype=int)  # Heap where each point lives (0: low, 1: high)
+    removed = np.zeros(n,dtype=bool)
+    sizes = [0,0]                 # Number of valid elements on each heap
+
+    def prune(heap):
+        while len(heap)>0 and removed[heap[0][1]]:
+            heapq.heappop(heap)
+
+    def rebalance():
+        while sizes[0] > sizes[1]+1:
+            prune(low)
+            value,j = heapq.heappop(low)
+            heapq.heappush(high,(-value,j))
+            side[j] = 1
+            sizes[0] -= 1
+            sizes[1] += 1
+        while sizes[1] > sizes[0]:
+            prune(high)
+            value,j = heapq.heappop(high)
+            heapq.heappush(low,(-value,j))
+            side[j] = 0
+            sizes[1] -= 1
+            sizes[0] += 1
+        prune(low)
+        prune(high)
+
+    left = 0
+    right = 0
+    half_window = window/2.
+    for i in range(n):
+        # Add points that entered the window:
+        while right < n and t[right] <= t[i] + half_window:
+            if not mask[right]:
+                prune(low)
+                if sizes[0] == 0 or f[right] <= -low[0][0]:
+                    heapq.heappush(low,(-f[right],right))
+                    side[right] = 0
+                    sizes[0] += 1
+                else:
+                    heapq.heappush(high,(f[right],right))
+                    side[right] = 1
+                    sizes[1] += 1
+                rebalance()
+            right += 1
+        # Remove points that left the window:
+        while t[left] < t[i] - half_window:
+            if not mask[left]:
+                removed[left] = True
+                sizes[side[left]] -= 1
+                rebalance()
+            left += 1
+        if sizes[0] > sizes[1]:
+            medians[i] = -low[0][0]
+        elif sizes[0] > 0:
+            medians[i] = (-low[0][0]+high[0][0])/2.
+    idx_nan = np.isnan(medians)
+    if np.all(idx_nan):
+        medians[:] = np.median(f)
+    elif np.any(idx_nan):
+        medians[idx_nan] = np.interp(t[idx_nan],t[~idx_nan],medians[~idx_nan])
+    return medians
+
+def get_running_median_filter(args):
+    """
+    This function returns the running median filter of a given instrument, whose data
+    does not need to be sorted in time. The filter is computed independently on each
+    contiguous segment of data. The input is a tuple (t,f,mask,window,max_gap) in
+    order to be used in a multiprocessing pool.
+    """
+    t,f,mask,window,max_gap = args
+    idx = np.argsort(t)
+    t,f,mask = t[idx],f[idx],mask[idx]
+    filt = np.zeros(len(t))
+    for start,end in get_segments(t,max_gap):
+        filt[start:end] = running_median(t[start:end],f[start:end],window,mask[start:end])
+    out_filt = np.zeros(len(t))
+    out_filt[idx] = filt
+    return out_filt
+
+def get_running_median_filters(all_t,all_f,transit_instruments,options,parameters):
+    """
+    This function computes the running median filters of all the instruments for which
+    PHOT_DETREND is 'rmedian', in parallel (using up to NCPUS processes). If
+    DETREND_MASK_TRANSIT is set, the in-transit points predicted by the priors on the
+    ephemeris are not used to compute the filter. It returns a dictionary with the
+    filters, each one in the same order as the data of the instrument.
+    """
+    instruments = []
+    args = []
+    for instrument in options['photometry'].keys():
+        if options['photometry'][instrument]['PHOT_DETREND'] != 'rmedian' or \
+           instrument not in transit_instruments['slices']:
+            continue
+        t = all_t[transit_instruments['slices'][instrument]]
+        f = all_f[transit_instruments['slices'][instrument]]
+        mask = np.zeros(len(t),dtype=bool)
+        if options['photometry'][instrument]['DETREND_MASK_TRANSIT'] and options['MODE'] != 'transit_noise':
+            P,inc,a,p,t0,q1,q2 = read_transit_params(parameters,instrument)
+            ecc,omega = parameters['ecc']['object'].value,parameters['omega']['object'].value
+            duration = get_transit_duration(P,a,p,inc,ecc,omega)
+            # Mask twice the duration of the transit to account for uncertainties on the ephemeris:
+            mask = np.abs(get_phases(t,P,t0)*P) < duration
+        instruments.append(instrument)
+        args.append((t,f,mask,options['photometry'][instrument]['WINDOW_TIME'],\
+                     options['photometry'][instrument]['SEGMENT_GAP']))
+    if len(args) == 0:
+        return {}
+    if options['NCPUS'] > 1 and len(args) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(np.min([options['NCPUS'],len(args)]))
+        filters = pool.map(get_running_median_filter,args)
+        pool.close()
+        pool.join()
+    else:
+        filters = map(get_running_median_filter,args)
+    return dict(zip(instruments,filters))
+
+def get_oot_summary(t,f,t0,P):
+    """
+    This function condenses out-of-transit data into summary statistics. The data is
+    divided in chunks between consecutive transits and, for each one, the mean time,
+    the median flux, the MAD-based standard-deviation of the flux and the number of
+    points are returned in a structured array.
+    """
+    chunks = np.floor((t-t0)/P).astype(int)
+    unique_chunks = np.unique(chunks)
+    summary = np.zeros(len(unique_chunks),dtype=[('time','f8'),('flux','f8'),('sigma','f8'),('npoints','i8')])
+    for i in range(len(unique_chunks)):
+        idx = np.where(chunks == unique_chunks[i])[0]
+        median_flux = np.median(f[idx])
+        summary[i] = (np.mean(t[idx]),median_flux,get_sigma(f[idx],median_flux),len(idx))
+    return summary
+
+def get_model_speedup(t_full,t_reduced,t0,P,p,a,inc,q1,q2,ld_law,nrepeat=3):
+    """
+    This function returns the ratio between the time it takes to evaluate the transit
+    model on t_full and on t_reduced (taking the best of nrepeat evaluations).
+    """
+    if len(t_reduced) == 0:
+        return np.inf
+    times = []
+    for tt in [t_full,t_reduced]:
+        best = np.inf
+        for i in range(nrepeat):
+            tic = time.time()
+            get_transit_model(tt.astype('float64'),t0,P,p,a,inc,q1,q2,ld_law)
+            best = np.min([best,time.time()-tic])
+        times.append(best)
+    return times[0]/np.max([times[1],1e-9])
+
 def read_transit_params(prior_dict,instrument):
     names = ['P','inc','a','p','t0','q1','q2']
     vals = len(names)*[[]]
@@ -47,19 +269,27 @@ def read_transit_params(prior_dict,instrument):
         vals[i] = param['object'].value
     return vals
 
+from general_utils import get_instrument_registry
 def pre_process(all_t,all_f,all_f_err,options,transit_instruments,parameters):
-    out_t = np.array([])
-    out_f = np.array([])
-    out_phases = np.array([])
-    out_f_err = np.array([])
-    out_transit_instruments = np.array([])
-    all_phases = np.zeros(len(all_t))
+    # The pre-processing of each instrument only selects the indexes of the points to keep (and the 
+    # detrending filters to apply to them), so the input arrays (which can be read-only memory-maps) are 
+    # not copied; the output arrays are extracted at the end with a single index. The summaries of 
+    # the out-of-transit data discarded by the transit windows (see get_oot_summary), if asked for 
+    # with PHOT_OOT_SUMMARY, are returned too:
+    out_idx = []
+    out_filt = {}
+    out_ephemeris = {}
+    out_summaries = {}
+    # Compute the running median filters (in parallel over instruments), if any:
+    rmedian_filters = get_running_median_filters(all_t,all_f,transit_instruments,options,parameters)
     for instrument in options['photometry'].keys():
-        all_idx = np.where(transit_instruments==instrument)[0]
+        if instrument not in transit_instruments['slices']:
+            continue
+        all_idx = transit_instruments['slices'][instrument]
         t = all_t[all_idx]
         f = all_f[all_idx]
-        if all_f_err is not None:
-            f_err = all_f_err[all_idx]
+        kept_idx = np.arange(all_idx.start,all_idx.stop)
+        filt = None
         
         # Now, the first phase in transit fitting is to 'detrend' the 
         # data. This is done with the 'detrend' flag. If 
@@ -71,8 +301,10 @@ def pre_process(all_t,all_f,all_f_err,options,transit_instruments,parameters):
                 from scipy.ndimage.filters import gaussian_filter
                 filt = gaussian_filter(medfilt(f,options['photometry'][instrument]['WINDOW']),5)
                 f = f/filt
-                if f_err is not None:
-                    f_err = f_err/filt
+            elif options['photometry'][instrument]['PHOT_DETREND'] == 'rmedian':
+                # Divide by the running median on a time window:
+                filt = rmedian_filters[instrument]
+                f = f/filt
             elif type(options['photometry'][instrument]['PHOT_DETREND']) is not bool:
                 print '\t WARNING: PHOT_DETREND option '+options['photometry'][instrument]['PHOT_DETREND']+\
                       ' for '+instrument+' not recognized!'
@@ -80,6 +312,7 @@ def pre_process(all_t,all_f,all_f_err,options,transit_instruments,parameters):
         # Extract transit parameters from prior dictionary:
         if options['MODE'] != 'transit_noise':
             P,inc,a,p,t0,q1,q2 = read_transit_params(parameters,instrument)
+            out_ephemeris[instrument] = (P,t0)
 
         # If the user wants to ommit transit events:
         if len(options['photometry'][instrument]['NOMIT'])>0:
@@ -89,18 +322,20 @@ def pre_process(all_t,all_f,all_f_err,options,transit_instruments,parameters):
             # Get the transit events in phase space:
             transit_events = np.arange(ceil(np.min(phases)),floor(np.max(phases))+1)
 
-            # Convert to zeros fluxes at the events you want to eliminate:
+            # Flag the points of the events you want to eliminate (f can be a view of the 
+            # input arrays, so it is not modified):
+            keep = np.ones(len(t),dtype=bool)
             for n in options['photometry'][instrument]['NOMIT']:
-                idx = np.where((phases>n-0.5)&(phases<n+0.5))[0]
-                f[idx] = np.zeros(len(idx))
+                keep = keep & ~((phases>n-0.5)&(phases<n+0.5))
 
             # Eliminate them from the t,f and phases array:
-            idx = np.where(f!=0.0)[0]
+            idx = np.where(keep)[0]
             t = t[idx]
             f = f[idx]
             phases = phases[idx]
-            if f_err is not None:
-                f_err = f_err[idx]
+            kept_idx = kept_idx[idx]
+            if filt is not None:
+                filt = filt[idx]
 
         if options['MODE'] != 'transit_noise':
             # Generate the phases:
@@ -113,58 +348,82 @@ def pre_process(all_t,all_f,all_f_err,options,transit_instruments,parameters):
             phase_dur = np.abs(phases[idx][np.where(np.abs(phases[idx]) == \
                                np.min(np.abs(phases[idx])))])[0] + 0.01
 
-            # Get precision:
-            median_flux = np.median(f)
-            sigma = get_sigma(f,median_flux)
-            # Perform sigma-clipping for out-of-transit data using phased data:
-            good_times = np.array([])
-            good_fluxes = np.array([])
-            good_phases = np.array([])
-            if f_err is not None:
-                good_errors = np.array([])
-
-            # Iterate through the dataset:
-            for i in range(len(t)):
-                    if np.abs(phases[i])<phase_dur:
-                            good_times = np.append(good_times,t[i])
-                            good_fluxes = np.append(good_fluxes,f[i])
-                            good_phases = np.append(good_phases,phases[i])
-                            if f_err is not None:
-                               good_errors = np.append(good_errors,f_err[i])
-                    else:
-                            if (f[i]<median_flux + 3*sigma) and (f[i]>median_flux - 3*sigma):
-                                    good_times = np.append(good_times,t[i])
-                                    good_fluxes = np.append(good_fluxes,f[i])
-                                    good_phases = np.append(good_phases,phases[i])
-                                    if f_err is not None:
-                                        good_errors = np.append(good_errors,f_err[i])
-            t = good_times
-            f = good_fluxes
-            phases = good_phases
-            if f_err is not None:
-                f_err = good_errors
-        out_t = np.append(out_t,t)
-        out_f = np.append(out_f,f)
-        out_transit_instruments = np.append(out_transit_instruments,np.array(len(t)*[instrument]))
-        out_f_err = np.append(out_f_err,f_err)
-        #all_t[all_idx] = t
-        #all_f[all_idx] = f 
-        #all_f_err[all_idx] = f_err
+            # Perform (iterative) sigma-clipping of the out-of-transit data using the phased 
+            # data. On each iteration, the median and the MAD-based sigma are computed from the 
+            # points that survived the previous iterations:
+            nsigma = options['photometry'][instrument]['PHOT_OUTLIERS_NSIGMA']
+            in_transit = np.abs(phases)<phase_dur
+            good = np.ones(len(t),dtype=bool)
+            for iteration in range(options['photometry'][instrument]['PHOT_OUTLIERS_MAXITER']):
+                median_flux = np.median(f[good])
+                sigma = get_sigma(f[good],median_flux)
+                new_good = good & (in_transit | ((f<median_flux + nsigma*sigma) & (f>median_flux - nsigma*sigma)))
+                n_rejected = np.sum(good) - np.sum(new_good)
+                good = new_good
+                print '\t Outlier removal for '+instrument+', iteration '+str(iteration+1)+': '+\
+                      str(n_rejected)+' points rejected.'
+                if n_rejected == 0:
+                    break
+            print '\t Outlier removal for '+instrument+': '+str(len(t)-np.sum(good))+' out of '+\
+                  str(len(t))+' points rejected in total.'
+            t = t[good]
+            f = f[good]
+            phases = phases[good]
+            kept_idx = kept_idx[good]
+            if filt is not None:
+                filt = filt[good]
+
+        # If requested, only keep the data around the transits predicted by the priors:
+        if options['photometry'][instrument]['PHOT_TRANSIT_WINDOW'] is not None and options['MODE'] != 'transit_noise':
+            duration = get_transit_duration(P,a,p,inc,parameters['ecc']['object'].value,\
+                                            parameters['omega']['object'].value)
+            if duration == 0.:
+                print '\t WARNING: priors on the ephemeris of '+instrument+' predict no transit. Not cropping the data.'
+            else:
+                in_window = np.abs(phases*P) < 0.5*options['photometry'][instrument]['PHOT_TRANSIT_WINDOW']*duration
+                if options['photometry'][instrument]['PHOT_OOT_SUMMARY']:
+                    summary = get_oot_summary(t[~in_window],f[~in_window],t0,P)
+                    out_summaries[instrument] = summary
+                    print '\t Out-of-transit data of '+instrument+' condensed in '+str(len(summary))+' chunks:'
+                    print '\t    time         median flux     sigma       npoints'
+                    for i in range(len(summary)):
+                        print '\t {0:.5f} {1:.10f} {2:.10f} {3:d}'.format(summary['time'][i],summary['flux'][i],\
+                                                                          summary['sigma'][i],summary['npoints'][i])
+                speedup = get_model_speedup(t,t[in_window],t0,P,p,a,inc,q1,q2,options['photometry'][instrument]['LD_LAW'])
+                print '\t Transit window for '+instrument+': kept '+str(np.sum(in_window))+' out of '+str(len(t))+\
+                      ' points (reduction factor of {0:.1f}, model evaluation speed-up of {1:.1f}x).'.format(\
+                      len(t)/np.double(np.max([np.sum(in_window),1])),speedup)
+                t = t[in_window]
+                f = f[in_window]
+                phases = phases[in_window]
+                kept_idx = kept_idx[in_window]
+                if filt is not None:
+                    filt = filt[in_window]
+        out_idx.append(kept_idx)
+        out_filt[instrument] = filt
+
+    # Extract the pre-processed data (in the same order as the input data), and apply the 
+    # detrending filters and compute the phases in place:
+    idx = np.sort(np.concatenate(out_idx))
+    out_t = np.array(all_t[idx],dtype='float64')
+    out_f = np.array(all_f[idx],dtype='float64')
+    out_f_err = None
+    if all_f_err is not None:
+        out_f_err = np.array(all_f_err[idx],dtype='float64')
+    out_transit_instruments = get_instrument_registry(transit_instruments['codes'][idx],names=transit_instruments['names'])
+    out_phases = np.zeros(len(idx))
+    for instrument in out_transit_instruments['names']:
+        instrument_idx = out_transit_instruments['slices'][instrument]
+        if out_filt[instrument] is not None:
+            out_f[instrument_idx] = out_f[instrument_idx]/out_filt[instrument]
+            if out_f_err is not None:
+                out_f_err[instrument_idx] = out_f_err[instrument_idx]/out_filt[instrument]
         if options['MODE'] != 'transit_noise':
-            out_phases = np.append(out_phases,phases)
-            #all_phases[all_idx] = phases
-        else:
-            out_phases = np.append(out_phases,np.zeros(len(t)))
-            #all_phases = np.zeros(len(t))
+            P,t0 = out_ephemeris[instrument]
+            out_phases[instrument_idx] = get_phases(out_t[instrument_idx],P,t0)
+    return out_t, out_phases, out_f, out_f_err, out_transit_instruments, out_summaries
 
-    if f_err is not None:
-       return out_t.astype('float64'), out_phases.astype('float64'), out_f.astype('float64'), out_f_err.astype('float64'),out_transit_instruments
-       #return all_t.astype('float64'), all_phases.astype('float64'), all_f.astype('float64'), all_f_err.astype('float64')
-    else:
-       return out_t.astype('float64'), out_phases.astype('float64'), out_f.astype('float64'), f_err,out_transit_instruments
-       #return all_t.astype('float64'), all_phases.astype('float64'), all_f.astype('float64'), f_err
-
-def init_batman(t,law):
+def init_batman(t,law,nthreads=1):
     """
     This function initializes the batman code.
     """
@@ -181,9 +440,33 @@ def init_batman(t,law):
     else:
         params.u = [0.1,0.3]
     params.limb_dark = law
-    m = batman.TransitModel(params,t)
+    if nthreads > 1:
+        try:
+            m = batman.TransitModel(params,t,nthreads=nthreads)
+        except Exception:
+            print '\t Warning: batman could not use '+str(nthreads)+' threads (is it compiled with OpenMP?). Using one thread.'
+            m = batman.TransitModel(params,t)
+    else:
+        m = batman.TransitModel(params,t)
     return params,m
 
+def get_instrument_threads(npoints,ncpus):
+    """
+    This function distributes ncpus threads among instruments proportionally to the number
+    of points on which the transit model of each instrument is evaluated (npoints), giving at
+    least one thread to each of them. It returns an array with the number of threads per instrument.
+    """
+    npoints = np.array(npoints).astype('float64')
+    nthreads = np.ones(len(npoints)).astype(int)
+    nextra = ncpus - len(npoints)
+    if nextra > 0 and np.sum(npoints) > 0:
+        shares = nextra*npoints/np.sum(npoints)
+        nthreads = nthreads + np.floor(shares).astype(int)
+        nremaining = ncpus - np.sum(nthreads)
+        order = np.argsort(np.floor(shares)-shares)
+        nthreads[order[:nremaining]] = nthreads[order[:nremaining]] + 1
+    return nthreads
+
 def init_radvel(nplanets=1):
     return radvel.model.Parameters(nplanets,basis='per tc e w k')
 
@@ -201,6 +484,71 @@ def get_transit_model(t,t0,P,p,a,inc,q1,q2,ld_law):
         params.u = [coeff1,coeff2]
     return m.light_curve(params)
 
+def get_max_transit_halfwidth(P,a,p,ecc=0.):
+    """
+    This function returns a conservative upper bound on the time between the time of
+    inferior conjunction and any moment in which the planet can be in front of the star,
+    valid for any inclination and argument of periastron. It uses the fact that the
+    projected star-planet distance is at least r*sin(df), where df is the change in true
+    anomaly from conjunction and r >= a(1-ecc), together with the minimum angular velocity
+    on the orbit. If no useful bound exists (e.g., for very close-in or very eccentric
+    orbits), it returns None.
+    """
+    x = (1.+p)/(a*(1.-ecc))
+    if x >= 1.:
+        return None
+    min_angular_velocity = (2.*np.pi/P)*np.sqrt((1.-ecc)/(1.+ecc)**3)
+    halfwidth = 1.05*np.arcsin(x)/min_angular_velocity
+    if halfwidth >= 0.5*P:
+        return None
+    return halfwidth
+
+def get_in_transit_idx(t,t0,P,a,p,ecc=0.):
+    """
+    Given a sorted array of times, this function returns the indexes of the times that
+    can possibly be in transit, using the bound given by get_max_transit_halfwidth and
+    a binary search around each epoch. If all the points might be in transit, it returns None.
+    """
+    halfwidth = get_max_transit_halfwidth(P,a,p,ecc)
+    if halfwidth is None:
+        return None
+    n_min = int(np.floor((t[0]-t0-halfwidth)/P))
+    n_max = int(np.ceil((t[-1]-t0+halfwidth)/P))
+    centers = t0 + P*np.arange(n_min,n_max+1)
+    lower = np.searchsorted(t,centers-halfwidth,side='left')
+    upper = np.searchsorted(t,centers+halfwidth,side='right')
+    lengths = upper-lower
+    total = np.sum(lengths)
+    if total == 0:
+        return np.array([],dtype=int)
+    offsets = np.repeat(lower-(np.cumsum(lengths)-lengths),lengths)
+    return np.arange(total)+offsets
+
+def init_fast_model(m,params):
+    """
+    This function returns the batman.TransitModel used by get_fast_light_curve for the times of 
+    m (which must be sorted), which is built once and reused on every evaluation.
+    """
+    return batman.TransitModel(params,m.t,nthreads=m.nthreads,fac=m.fac)
+
+def get_fast_light_curve(m,m_fast,params):
+    """
+    This function returns the same light curve as m.light_curve(params) (where m is a
+    batman.TransitModel initialized with sorted times), but evaluates the transit model only
+    on the points that can possibly be in transit; the rest are set to one. m_fast is the 
+    model returned by init_fast_model, whose times are replaced by the in-transit ones.
+    """
+    idx = get_in_transit_idx(m.t,params.t0,params.per,params.a,params.rp,params.ecc)
+    if idx is None:
+        return m.light_curve(params)
+    model = np.ones(len(m.t))
+    if len(idx) > 0:
+        # (resetting t0 makes batman recompute the star-planet separations on the new times):
+        m_fast.t = m_fast.t_supersample = m.t[idx]
+        m_fast.t0 = None
+        model[idx] = m_fast.light_curve(params)
+    return model
+
 def convert_ld_coeffs(ld_law, coeff1, coeff2):
     if ld_law == 'quadratic':
         q1 = (coeff1 + coeff2)**2
@@ -230,23 +578,781 @@ def reverse_ld_coeffs(ld_law, q1, q2):
         coeff2 = 0.0
     return coeff1,coeff2
 
-def count_instruments(instrument_list):
-    all_instruments = []
-    for instrument in instrument_list:
-        if instrument not in all_instruments:
-            all_instruments.append(instrument)
-    all_idxs = len(all_instruments)*[[]]
-    all_ndata = len(all_instruments)*[[]]
-    for i in range(len(all_instruments)):
-        all_idxs[i] = np.where(all_instruments[i] == instrument_list)[0]
-        all_ndata[i] = len(all_idxs[i])
+def count_instruments(registry):
+    """
+    This function returns the names of the instruments in an instrument registry (see 
+    general_utils.get_instrument_registry), the slice of the data of each one and their 
+    number of points.
+    """
+    all_instruments = registry['names']
+    all_idxs = [registry['slices'][instrument] for instrument in all_instruments]
+    all_ndata = [registry['counts'][instrument] for instrument in all_instruments]
     return all_instruments,all_idxs,np.array(all_ndata)
 
+def get_parameter_table(parameters,all_mcmc_params):
+    """
+    This function compiles the values of all the parameters into a single vector, in which the first 
+    len(all_mcmc_params) entries are the parameters that are sampled (in the same order as in theta) 
+    and the rest are the constant values of the other parameters. It returns this vector and a 
+    dictionary with the position of each parameter in it, from which the integer indexes used by the 
+    likelihood to gather the values it needs are built.
+    """
+    names = list(all_mcmc_params) + [par for par in parameters.keys() if par not in all_mcmc_params]
+    values = np.zeros(len(names))
+    index = {}
+    for i in range(len(names)):
+        index[names[i]] = i
+        values[i] = parameters[names[i]]['object'].value
+    return values,index
+
+def get_reparameterization(all_mcmc_params,parameters,options,times):
+    """
+    This function defines the internal parameterizations in which the sampler works, which are 
+    set by the REPARAMETERIZE option (a comma-separated list). These can be 'rhob' (the stellar density, 
+    in kg/m^3, and b = a*cos(inc) instead of a and inc), 'esinw' (sqrt(ecc)*cos(omega) and sqrt(ecc)*sin(omega) 
+    instead of ecc and omega), 'logjeffreys' (the logarithm of parameters with Jeffreys priors) and 't0mid' 
+    (the time of transit center at the epoch closest to the middle of the data instead of t0). It returns 
+    a dictionary with the indexes of the transformed parameters in all_mcmc_params (None if no 
+    reparameterization is used), which is used by theta_to_phi and phi_to_theta.
+    """
+    if options['REPARAMETERIZE'].lower() == 'none':
+        return None
+    reparameterizations = options['REPARAMETERIZE'].lower().split(',')
+    reparam = {'logjeffreys':[],'esinw':None,'rhob':None,'t0mid':[]}
+    used_params = []
+    # Index (or fixed value) of the period:
+    if 'P' in all_mcmc_params:
+        reparam['P'] = (all_mcmc_params.index('P'),None)
+        P_init = parameters['P']['object'].init_value
+    else:
+        reparam['P'] = (None,parameters['P']['object'].value)
+        P_init = parameters['P']['object'].value
+    if 'esinw' in reparameterizations and 'ecc' in all_mcmc_params and 'omega' in all_mcmc_params:
+        reparam['esinw'] = (all_mcmc_params.index('ecc'),all_mcmc_params.index('omega'))
+        used_params = used_params + ['ecc','omega']
+    if 'rhob' in reparameterizations and 'a' in all_mcmc_params and 'inc' in all_mcmc_params:
+        reparam['rhob'] = (all_mcmc_params.index('a'),all_mcmc_params.index('inc'))
+        used_params = used_params + ['a','inc']
+    if 't0mid' in reparameterizations:
+        for i in range(len(all_mcmc_params)):
+            if all_mcmc_params[i] == 't0' or all_mcmc_params[i][:3] == 't0_':
+                # Number of the epoch closest to the middle of the data:
+                n_mid = np.round((np.median(times)-parameters[all_mcmc_params[i]]['object'].init_value)/P_init)
+                reparam['t0mid'].append((i,n_mid))
+                used_params.append(all_mcmc_params[i])
+    if 'logjeffreys' in reparameterizations:
+        for i in range(len(all_mcmc_params)):
+            if parameters[all_mcmc_params[i]]['type'] == 'Jeffreys' and all_mcmc_params[i] not in used_params:
+                reparam['logjeffreys'].append(i)
+                used_params.append(all_mcmc_params[i])
+    if len(used_params) == 0:
+        return None
+    reparam['indexes'] = [all_mcmc_params.index(par) for par in used_params]
+    print '\t Sampling parameters '+','.join(used_params)+' on the reparameterizations: '+options['REPARAMETERIZE']
+    return reparam
+
+def theta_to_phi(theta,reparam):
+    """
+    This function converts the parameters theta (in the order of all_mcmc_params) to the internal 
+    parameterization phi used by the sampler. theta can also be an array of samples, one per row.
+    """
+    theta = np.array(theta).astype('float64')
+    phi = np.copy(theta)
+    iP,P = reparam['P']
+    if iP is not None:
+        P = theta[...,iP]
+    if reparam['esinw'] is not None:
+        iecc,iomega = reparam['esinw']
+        phi[...,iecc] = np.sqrt(theta[...,iecc])*np.cos(theta[...,iomega]*np.pi/180.)
+        phi[...,iomega] = np.sqrt(theta[...,iecc])*np.sin(theta[...,iomega]*np.pi/180.)
+    if reparam['rhob'] is not None:
+        ia,iinc = reparam['rhob']
+        phi[...,ia] = ((3.*np.pi)/(G*(P*(24.*3600.0))**2))*theta[...,ia]**3
+        phi[...,iinc] = theta[...,ia]*np.cos(theta[...,iinc]*np.pi/180.)
+    for it0,n_mid in reparam['t0mid']:
+        phi[...,it0] = theta[...,it0] + n_mid*P
+    for i in reparam['logjeffreys']:
+        phi[...,i] = np.log(theta[...,i])
+    if iP in reparam['logjeffreys']:
+        phi[...,iP] = np.log(theta[...,iP])
+    return phi
+
+def phi_to_theta(phi,reparam):
+    """
+    This function is the inverse of theta_to_phi. It also returns the logarithm of the jacobian of 
+    the transformation, |d theta/d phi|, which has to be added to the log-posterior of theta so the 
+    priors defined by the user stay the same when sampling in phi. Values of phi that are outside 
+    the domain of the transformation get a log-jacobian of -np.inf.
+    """
+    phi = np.array(phi).astype('float64')
+    theta = np.copy(phi)
+    ln_jacobian = np.zeros(phi.shape[:-1])
+    for i in reparam['logjeffreys']:
+        theta[...,i] = np.exp(phi[...,i])
+        ln_jacobian = ln_jacobian + phi[...,i]
+    iP,P = reparam['P']
+    if iP is not None:
+        P = theta[...,iP]
+    if reparam['esinw'] is not None:
+        # The jacobian of this transformation is constant:
+        iecc,iomega = reparam['esinw']
+        theta[...,iecc] = phi[...,iecc]**2 + phi[...,iomega]**2
+        theta[...,iomega] = (np.arctan2(phi[...,iomega],phi[...,iecc])*180./np.pi) % 360.
+    if reparam['rhob'] is not None:
+        ia,iinc = reparam['rhob']
+        rho,b = phi[...,ia],phi[...,iinc]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            a = (rho*G*(P*(24.*3600.0))**2/(3.*np.pi))**(1./3.)
+            cos_inc = b/a
+            sin_inc = np.sqrt(1.-cos_inc**2)
+            theta[...,ia] = a
+            theta[...,iinc] = np.arccos(cos_inc)*180./np.pi
+            ln_jacobian = ln_jacobian - np.log(3.*rho*sin_inc)
+        outside = (rho <= 0.) | (np.abs(cos_inc) >= 1.) | ~np.isfinite(cos_inc)
+        ln_jacobian = np.where(outside,-np.inf,ln_jacobian)
+    for it0,n_mid in reparam['t0mid']:
+        theta[...,it0] = phi[...,it0] - n_mid*P
+    return theta,ln_jacobian
+
 import emcee
 import Wavelets
 import scipy.optimize as op
+def get_finite_difference_steps(lnprob,theta,scales,nmax=30):
+    """
+    This function returns, for each parameter, a step around theta for which the change 
+    in lnprob is between 0.01 and 1 (starting the search from the corresponding value in 
+    scales), i.e., a local estimate of the scale of the posterior along that parameter. It 
+    also returns the sign of the differences to use: 0 for central differences, and +1 (-1) for 
+    forward (backward) differences for parameters at the edge of the support of their prior.
+    """
+    ndim = len(theta)
+    def f(dtheta):
+        try:
+            val = lnprob(theta+dtheta)
+        except:
+            return -np.inf
+        return val
+    f0 = f(np.zeros(ndim))
+    steps = np.zeros(ndim)
+    signs = np.zeros(ndim)
+    for i in range(ndim):
+        e = np.zeros(ndim)
+        e[i] = 1.
+        h = scales[i]
+        for j in range(nmax):
+            fp,fm = f(h*e),f(-h*e)
+            if not np.isfinite(fp) and not np.isfinite(fm):
+                h = h/4.
+                continue
+            delta = np.max(np.abs(np.array([fp,fm])[np.isfinite([fp,fm])]-f0))
+            if delta > 1.:
+                h = h/4.
+            elif delta < 0.01 and h < 1e3*scales[i]:
+                h = h*4.
+            else:
+                break
+        steps[i] = h
+        fp,fm = f(h*e),f(-h*e)
+        if not np.isfinite(fm) and np.isfinite(fp):
+            signs[i] = 1.
+        elif not np.isfinite(fp) and np.isfinite(fm):
+            signs[i] = -1.
+    return steps,signs
+
+def get_map_fit(lnprob,starting_points,bounds,nstarts=1,nrounds=10,tol=1e-3):
+    """
+    This function finds the maximum a-posteriori (MAP) parameters of the lnprob function. From 
+    each of the nstarts starting_points with the largest posterior probability, it runs Powell 
+    optimizations within the bounds (a list with the (lower,upper) limits of each parameter, with 
+    None for unbounded ones) until the log-posterior improves by less than tol (or nrounds rounds 
+    are done). To keep the problem well-conditioned, the search directions of the first round are 
+    the parameters scaled by the spread of the starting points, and those of the next rounds are 
+    the principal axes of the Laplace approximation around the current best parameters. It returns 
+    the best parameter vector found along with its log-posterior.
+    """
+    ndim = len(starting_points[0])
+    scale = np.std(starting_points,axis=0)
+    scale[scale == 0] = 1.
+    lower = np.array([-np.inf if b is None else b[0] for b in bounds])
+    upper = np.array([np.inf if b is None else b[1] for b in bounds])
+    # As the supports of the priors are open intervals, the bounds are slightly shrinked:
+    margin = 1e-10*(upper-lower)
+    margin[~np.isfinite(margin)] = 0.
+    lower,upper = lower+margin,upper-margin
+    def neg_lnprob(theta):
+        try:
+            val = lnprob(np.clip(theta,lower,upper))
+        except:
+            return np.inf
+        if not np.isfinite(val):
+            return np.inf
+        return -val
+    values = np.array([neg_lnprob(theta) for theta in starting_points])
+    idx = np.argsort(values)[:nstarts]
+    idx = idx[np.isfinite(values[idx])]
+    if len(idx) == 0:
+        print 'Error: posterior probability is not finite on any of the starting points. Exiting...'
+        sys.exit()
+    best_theta,best_value = None,np.inf
+    for i in idx:
+        theta,value = np.copy(starting_points[i]),values[i]
+        directions = np.diag(scale)
+        for j in range(nrounds):
+            result = op.minimize(neg_lnprob,theta,method='Powell',options={'xtol':1e-2,'ftol':1e-6,'direc':directions})
+            improvement = value - result.fun
+            if result.fun < value:
+                theta,value = np.clip(np.atleast_1d(result.x),lower,upper),result.fun
+            if improvement < tol:
+                break
+            hessian,steps = get_hessian(lnprob,theta,1e-3*scale)
+            eigenvalues,eigenvectors = np.linalg.eigh(get_laplace_covariance(hessian,steps))
+            directions = (eigenvectors*np.sqrt(eigenvalues)).T
+        if value < best_value:
+            best_theta,best_value = theta,value
+    return best_theta,-best_value
+
+def get_hessian(lnprob,theta,scales):
+    """
+    This function returns a finite-difference estimate of the hessian of lnprob at theta. The 
+    steps are obtained with get_finite_difference_steps, which keeps both truncation and round-off 
+    errors small regardless of the scale of each parameter. Central differences are used, except 
+    for parameters at the edge of the support of their prior, for which one-sided differences are used. 
+    It returns the hessian and the steps.
+    """
+    ndim = len(theta)
+    def f(dtheta):
+        try:
+            val = lnprob(theta+dtheta)
+        except:
+            return -np.inf
+        return val
+    f0 = f(np.zeros(ndim))
+    steps,signs = get_finite_difference_steps(lnprob,theta,scales)
+    hessian = np.zeros([ndim,ndim])
+    for i in range(ndim):
+        ei = np.zeros(ndim)
+        ei[i] = steps[i]
+        if signs[i] == 0:
+            hessian[i,i] = (f(ei)+f(-ei)-2.*f0)/steps[i]**2
+        else:
+            hessian[i,i] = (f(2.*signs[i]*ei)-2.*f(signs[i]*ei)+f0)/steps[i]**2
+        for j in range(i+1,ndim):
+            ej = np.zeros(ndim)
+            ej[j] = steps[j]
+            if signs[i] == 0 and signs[j] == 0:
+                hessian[i,j] = (f(ei+ej)-f(ei-ej)-f(-ei+ej)+f(-ei-ej))/(4.*steps[i]*steps[j])
+            else:
+                si = 1. if signs[i] == 0 else signs[i]
+                sj = 1. if signs[j] == 0 else signs[j]
+                hessian[i,j] = (f(si*ei+sj*ej)-f(si*ei)-f(sj*ej)+f0)/(si*sj*steps[i]*steps[j])
+            hessian[j,i] = hessian[i,j]
+    return hessian,steps
+
+def get_laplace_covariance(hessian,steps):
+    """
+    This function returns the covariance matrix of the gaussian (Laplace) approximation to 
+    the posterior, i.e., the inverse of minus the hessian of the log-posterior. Parameters 
+    with no negative curvature (e.g., at the edge of their prior), or with a curvature too small 
+    to be resolved on their finite-difference step, are treated as independent, with a width given 
+    by that step. If the resulting matrix is not positive-definite, the absolute values of its 
+    eigenvalues are used.
+    """
+    hessian = np.copy(hessian)
+    hessian[~np.isfinite(hessian)] = 0.
+    for i in range(len(steps)):
+        if -hessian[i,i]*steps[i]**2 < 1e-2:
+            hessian[i,:] = 0.
+            hessian[:,i] = 0.
+            hessian[i,i] = -1./steps[i]**2
+    eigenvalues,eigenvectors = np.linalg.eigh(-hessian)
+    if np.any(eigenvalues <= 0.):
+        eigenvalues = np.abs(eigenvalues)
+        eigenvalues[eigenvalues == 0.] = np.max(eigenvalues)
+    return np.dot(eigenvectors,np.dot(np.diag(1./eigenvalues),eigenvectors.T))
+
+def get_laplace_samples(lnprior,theta_map,cov,nsamples):
+    """
+    This function draws nsamples samples from the gaussian (Laplace) approximation to the 
+    posterior around the MAP parameters theta_map, with covariance matrix cov. Samples outside 
+    the support of the priors (i.e., for which lnprior is not finite) are rejected.
+    """
+    samples = np.zeros([0,len(theta_map)])
+    ntries = 0
+    while len(samples) < nsamples and ntries < 100:
+        draws = np.random.multivariate_normal(theta_map,cov,nsamples)
+        in_support = np.array([np.isfinite(lnprior(draw)) for draw in draws])
+        samples = np.vstack((samples,draws[in_support]))
+        ntries = ntries + 1
+    if len(samples) < nsamples:
+        print 'Error: could not draw samples from the Laplace approximation within the support of the priors. Exiting...'
+        sys.exit()
+    return samples[:nsamples]
+
+def get_integrated_autocorr_time(chain,c=5.):
+    """
+    This function returns the integrated autocorrelation time of a parameter given its chain, an 
+    array of shape (nwalkers, nsteps). The autocorrelation function is computed with FFTs, averaged 
+    over the walkers, and summed up to the smallest window M for which M >= c*tau (Sokal, 1989). It 
+    also returns a flag which is False if the chain is too short for such a window to exist (in 
+    which case the estimate is only a lower limit) or if the walkers did not move at all.
+    """
+    nwalkers,nsteps = chain.shape
+    n = 2**int(np.ceil(np.log2(2*nsteps)))
+    x = chain - np.mean(chain,axis=1)[:,None]
+    fx = np.fft.rfft(x,n=n,axis=1)
+    acf = np.mean(np.fft.irfft(fx*np.conjugate(fx),n=n,axis=1)[:,:nsteps],axis=0)
+    if acf[0] <= 0.:
+        return np.nan,False
+    taus = 2.*np.cumsum(acf/acf[0]) - 1.
+    in_window = np.arange(nsteps) < c*taus
+    if np.all(in_window):
+        return taus[-1],False
+    return taus[np.argmin(in_window)],True
+
+def get_split_rhat(chain,ngroups=4):
+    """
+    This function returns the split-R-hat (Gelman et al., 2013) of a parameter given its chain, an 
+    array of shape (nwalkers, nsteps). As the walkers of an ensemble sampler are not independent, 
+    they are split in ngroups groups, and the samples of each group on the first and second halves 
+    of the chain are used as 2*ngroups separate chains. Values close to 1 indicate convergence.
+    """
+    nwalkers,nsteps = chain.shape
+    ngroups = min(ngroups,nwalkers)
+    half = nsteps/2
+    groups = np.arange(ngroups*(nwalkers/ngroups)).reshape(ngroups,-1)
+    chains = np.array([chain[group,:half].flatten() for group in groups] + \
+                      [chain[group,nsteps-half:].flatten() for group in groups])
+    n = chains.shape[1]
+    W = np.mean(np.var(chains,axis=1,ddof=1))
+    B = n*np.var(np.mean(chains,axis=1),ddof=1)
+    if W <= 0.:
+        return np.nan
+    return np.sqrt(((n-1.)/n*W + B/n)/W)
+
+def get_chain_diagnostics(chain,names,acceptance_fraction,wall_time):
+    """
+    This function returns a dictionary with the convergence and efficiency diagnostics of an 
+    MCMC run given its (post burn-in) chain, an array of shape (nwalkers, nsteps, nparameters), 
+    the names of the parameters, the acceptance fraction of each walker and the wall time (in 
+    seconds) spent on the sampling. For each parameter, it computes the integrated autocorrelation 
+    time, the effective sample size (ESS), the split-R-hat and the effective samples per second.
+    """
+    nwalkers,nsteps,ndim = chain.shape
+    diagnostics = {'fit_method':'MCMC','nwalkers':nwalkers,'nsteps':nsteps,'wall_time':float(wall_time),\
+                   'mean_acceptance_fraction':float(np.mean(acceptance_fraction)),\
+                   'min_acceptance_fraction':float(np.min(acceptance_fraction)),\
+                   'max_acceptance_fraction':float(np.max(acceptance_fraction)),'parameters':{}}
+    for i in range(ndim):
+        tau,reliable = get_integrated_autocorr_time(chain[:,:,i])
+        ess = nwalkers*nsteps/tau
+        diagnostics['parameters'][names[i]] = {'autocorr_time':float(tau),'autocorr_time_reliable':reliable,\
+                                               'ess':float(ess),'split_rhat':float(get_split_rhat(chain[:,:,i])),\
+                                               'ess_per_second':float(ess/wall_time)}
+    values = diagnostics['parameters'].values()
+    diagnostics['min_ess'] = float(np.nanmin([v['ess'] for v in values]))
+    diagnostics['max_split_rhat'] = float(np.nanmax([v['split_rhat'] for v in values]))
+    diagnostics['min_ess_per_second'] = float(np.nanmin([v['ess_per_second'] for v in values]))
+    return diagnostics
+
+def get_model_comparison(lnlike,samples,n_params,n_data,nmax=500):
+    """
+    This function returns the statistics used to compare the fit of a model with the fits of other 
+    models (see run_model_grid): the maximum log-likelihood over (at most nmax, evenly spaced) posterior 
+    samples, an array of shape (nsamples, nparameters), where lnlike is a function that returns the 
+    log-likelihood of a parameter vector, and the Bayesian Information Criterion, BIC = 
+    n_params*ln(n_data) - 2*max_lnlike, of the model with n_params parameters fitted to n_data datapoints.
+    """
+    idx = np.unique(np.linspace(0,len(samples)-1,np.min([nmax,len(samples)])).astype(int))
+    max_lnlike = float(np.max([lnlike(samples[i]) for i in idx]))
+    return {'max_lnlike':max_lnlike,'n_params':int(n_params),'n_data':int(n_data),\
+            'bic':float(n_params*np.log(n_data) - 2.*max_lnlike)}
+
+import os,json
+from parallel_utils import get_rss
+def run_sampler(sampler,pos,nsteps,progress=None,phase='',total_steps=None):
+    """
+    This function runs nsteps steps of an emcee sampler from the positions pos, step by step (which 
+    is equivalent to sampler.run_mcmc, whose output it returns). If progress (a dictionary with the 
+    open 'file' and the 'interval', in seconds) is given, every interval seconds and at the end of 
+    the run it appends a record to the file (a JSON line) with the phase of the fit, the step (of 
+    total_steps, which defaults to the steps run so far plus nsteps), the evaluations of the posterior 
+    per second since the last record, the mean acceptance fraction, the current maximum log-probability 
+    of the walkers, the running estimate of the largest integrated autocorrelation time of the 
+    parameters (on a subset of the chain), the estimated time to finish the phase and the memory used by the process. The 
+    records are also printed, and are cheap compared with the steps between them.
+    """
+    nwalkers = sampler.chain.shape[0]
+    first_step = sampler.iterations
+    if total_steps is None:
+        total_steps = first_step + nsteps
+    start = last_time = time.time()
+    last_step = first_step
+    for i,result in enumerate(sampler.sample(pos,iterations=nsteps)):
+        if progress is None or progress['interval'] <= 0. or \
+           (time.time()-last_time < progress['interval'] and i < nsteps-1):
+            continue
+        now,step = time.time(),sampler.iterations
+        # The running autocorrelation time is estimated on (at most) 64 walkers and 1000 steps of the 
+        # chain, thinned if needed, so its cost does not grow with the length of the run:
+        thin = int(np.ceil(step/1000.))
+        chain = sampler.chain[:64,:step:thin,:]
+        taus = thin*np.array([get_integrated_autocorr_time(chain[:,:,j])[0] for j in range(chain.shape[2])])
+        rss = get_rss(os.getpid())
+        record = {'phase':phase,'step':step,'total_steps':total_steps,'time':now-progress['start'],\
+                  'evaluations_per_second':nwalkers*(step-last_step)/(now-last_time),\
+                  'mean_acceptance_fraction':float(np.mean(sampler.acceptance_fraction)),\
+                  'max_lnprob':float(np.max(result[1])),\
+                  'tau':float(np.max(taus[np.isfinite(taus)])) if np.any(np.isfinite(taus)) else None,\
+                  'eta':(now-start)*(total_steps-step)/np.double(step-first_step),\
+                  'rss_mb':None if rss is None else rss['total']}
+        progress['file'].write(json.dumps(record)+'\n')
+        progress['file'].flush()
+        print '\t {0:} step {1:}/{2:}: {3:.1f} evaluations/s, acceptance {4:.3f}, max lnprob {5:.2f}, tau {6:}, ETA {7:.0f} s.'.format(\
+              phase,step,total_steps,record['evaluations_per_second'],record['mean_acceptance_fraction'],\
+              record['max_lnprob'],'-' if record['tau'] is None else '{0:.1f}'.format(record['tau']),record['eta'])
+        sys.stdout.flush()
+        last_time,last_step = now,step
+    return result
+
+def get_warm_start_positions(lnprob,posteriors,all_mcmc_params,parameters,nwalkers,reparam=None):
+    """
+    This function returns the initial positions of nwalkers walkers drawn from the posteriors of 
+    a previous fit (a dictionary with the posterior samples of each parameter, as saved in 
+    posteriors.pkl). Joint samples are drawn, so the correlations between the parameters are kept; 
+    parameters that were not in the previous fit are drawn from their priors. Positions for which 
+    lnprob is not finite (e.g., because of new data) are discarded.
+    """
+    n_params = len(all_mcmc_params)
+    nsamples = np.min([len(posteriors[par]) for par in all_mcmc_params if par in posteriors.keys()])
+    pos = []
+    ntries = 0
+    while len(pos) < nwalkers:
+        if ntries % nsamples == 0:
+            idx = np.random.permutation(nsamples)
+        theta_vector = np.zeros(n_params)
+        for i in range(n_params):
+            if all_mcmc_params[i] in posteriors.keys():
+                theta_vector[i] = posteriors[all_mcmc_params[i]][idx[ntries % nsamples]]
+            else:
+                theta_vector[i] = parameters[all_mcmc_params[i]]['object'].sample()
+        if reparam is not None:
+            theta_vector = theta_to_phi(theta_vector,reparam)
+        try:
+            val = lnprob(theta_vector)
+        except:
+            val = -np.inf
+        if np.isfinite(val):
+            pos.append(theta_vector)
+        ntries = ntries + 1
+        if ntries > 100*nwalkers and len(pos) < nwalkers:
+            print 'Error: could not initialize the walkers from the previous posteriors. Exiting...'
+            sys.exit()
+    return pos
+
+def get_cost_estimate(lnprob,lnprior,draw_point,components,n_params,options,warm_start=None,nmarginalized=0,\
+                      plot_time=0.,ntests=20):
+    """
+    This function estimates the cost of a fit without running it. It times ntests evaluations of lnprob 
+    on points drawn with draw_point (as the ones used to initialize the walkers) and, on the points 
+    where lnprob is finite, of each of the components of the posterior (a list of (name, function) 
+    pairs, which use the parameters set by the last call to lnprior; they are timed on a new point 
+    each time, as the transit models cache the orbit if it does not change). From these, it projects the 
+    number of evaluations and the time of each phase of the fit: the walker initialization, the 
+    warm-up run, the final run and the plots (which take plot_time seconds) for MCMC fits, and the 
+    optimization, the hessian and the Laplace samples for MAP fits (whose number of evaluations is an 
+    approximation based on the number of parameters). The steps of the MCMC runs are split among the 
+    NWORKERS posterior workers, if used. It also suggests the parallelism over the walkers. It prints 
+    and returns a dictionary with the breakdown.
+    """
+    points,finite,lnprob_times = [],[],[]
+    for j in range(ntests):
+        points.append(draw_point())
+        start = time.time()
+        try:
+            finite.append(np.isfinite(lnprob(points[-1])))
+        except:
+            finite.append(False)
+        lnprob_times.append(time.time()-start)
+    finite = np.array(finite)
+    if not np.any(finite):
+        print 'Error: posterior probability is not finite on any of the test points. Exiting...'
+        sys.exit()
+    t_lnprob = np.mean(np.array(lnprob_times)[finite])
+    component_times = {}
+    for name,function in components:
+        component_times[name] = 0.
+    for j in np.where(finite)[0]:
+        lnprior(points[j])
+        for name,function in components:
+            start = time.time()
+            function()
+            component_times[name] = component_times[name] + (time.time()-start)/np.sum(finite)
+    finite_fraction = np.mean(finite)
+
+    # Number of evaluations (and time per evaluation) of each phase of the fit:
+    nwalkers,njumps,nburnin = options['NWALKERS'],options['NJUMPS'],options['NBURNIN']
+    # (the steps of the MCMC runs are split among the posterior workers, at most one per CPU, or 
+    # among the remote ones, assumed to run on one CPU each):
+    import multiprocessing
+    nworkers = np.min([options['NWORKERS'],multiprocessing.cpu_count()])
+    if options['WORKER_NODES'].lower() != 'none':
+        nworkers = len(options['WORKER_NODES'].split(','))
+    phases = []
+    if options['FIT_METHOD'].lower() == 'map':
+        # The Powell rounds (about 4, of ~8*n_params^2 evaluations each) are followed by a hessian 
+        # (of ~2*n_params^2 evaluations) each, plus the final one:
+        nhessian = 2*n_params**2+4*n_params
+        phases.append(('optimization',100+4*(8*n_params**2+nhessian),t_lnprob))
+        phases.append(('hessian',nhessian,t_lnprob))
+        phases.append(('Laplace samples',nwalkers*njumps,component_times.get('priors',0.)))
+    elif warm_start is not None:
+        phases.append(('walker initialization',nwalkers,t_lnprob))
+        phases.append(('adaptive burn-in (at most)',nwalkers*nburnin,t_lnprob/np.min([nworkers,nwalkers/2])))
+        phases.append(('final run',nwalkers*njumps,t_lnprob/np.min([nworkers,nwalkers/2])))
+    else:
+        # Each candidate starting point of the warm-up run is evaluated three times:
+        nwarmup,njumps_warmup = options['WARMUP_NWALKERS'],options['WARMUP_NJUMPS']
+        if njumps_warmup > 0:
+            phases.append(('walker initialization',int(3*nwarmup/finite_fraction)+nwalkers,t_lnprob))
+            phases.append(('warm-up run',nwarmup*njumps_warmup,t_lnprob/np.min([nworkers,nwarmup/2])))
+        else:
+            phases.append(('walker initialization',int(3*nwalkers/finite_fraction),t_lnprob))
+        phases.append(('final run',nwalkers*(njumps+nburnin),t_lnprob/np.min([nworkers,nwalkers/2])))
+    if nmarginalized > 0:
+        phases.append(('marginalized parameters',nwalkers*njumps,t_lnprob))
+    total_time = np.sum([nevals*t for name,nevals,t in phases]) + plot_time
+
+    # Each half of the walkers can be evaluated on the posterior workers (see the NWORKERS option). 
+    # The transit instruments are evaluated one after the other, so no parallelism is suggested over them:
+    max_workers = int(np.min([multiprocessing.cpu_count(),nwalkers/2]))
+    suggested = {}
+    if options['FIT_METHOD'].lower() != 'map' and nworkers == 1 and max_workers > 1:
+        suggested['NWORKERS'] = max_workers
+
+    print '\t Estimated cost of the fit ({0:} parameters, {1:.2e} s per posterior evaluation):'.format(n_params,t_lnprob)
+    for name,function in components:
+        print '\t     {0:35} {1:.2e} s per evaluation'.format(name,component_times[name])
+    for name,nevals,t in phases:
+        print '\t     {0:35} {1:9d} evaluations, {2:.1f} s'.format(name,int(nevals),nevals*t)
+    if plot_time > 0.:
+        print '\t     {0:35} {1:9} {2:.1f} s'.format('plots','',plot_time)
+    print '\t Total: {0:.1f} s ({1:.2f} h).'.format(total_time,total_time/3600.)
+    if 'NWORKERS' in suggested.keys():
+        print '\t Suggested parallelism over the walkers: NWORKERS: {0:} (speed-up of up to {0:}x on the MCMC runs).'.format(\
+              suggested['NWORKERS'])
+    return {'fit_method':options['FIT_METHOD'],'n_params':n_params,'lnprob_time':float(t_lnprob),\
+            'finite_fraction':float(finite_fraction),\
+            'components':dict([(name,float(t)) for name,t in component_times.items()]),\
+            'phases':dict([(name,{'nevals':int(nevals),'time':float(nevals*t)}) for name,nevals,t in phases]),\
+            'plot_time':float(plot_time),\
+            'total_time':float(total_time),'suggested':suggested}
+
+from scipy.special import ndtr
+from scipy.stats import truncnorm
+def get_marginalized_lnlike(y,x,variances,prior_type,prior_hypp):
+    """
+    This function returns the log-likelihood of data y with gaussian noise of the given variances 
+    and a model c*x, where c is a linear parameter which is marginalized analytically. The prior 
+    on c can be either 'Normal' (prior_hypp are its mean and standard-deviation) or 'Uniform' 
+    (prior_hypp are its lower and upper limits). It also returns the mean, standard-deviation, 
+    lower and upper limits of the (truncated) gaussian conditional posterior of c, from which 
+    it can be sampled afterwards with sample_linear_parameter.
+    """
+    variances = variances*np.ones(len(y))
+    A = np.sum(x**2/variances)
+    B = np.sum(x*y/variances)
+    C = np.sum(y**2/variances)
+    log_like = -0.5*(len(y)*log2pi + np.sum(np.log(variances)))
+    if prior_type == 'Normal':
+        mu0,sigma0 = prior_hypp[0],prior_hypp[1]
+        P = A + 1./sigma0**2
+        Q = B + mu0/sigma0**2
+        log_like = log_like - 0.5*(np.log(P*sigma0**2) + C + (mu0/sigma0)**2 - Q**2/P)
+        return log_like,(Q/P,1./np.sqrt(P),-np.inf,np.inf)
+    lower,upper = prior_hypp[0],prior_hypp[1]
+    mean,sigma = B/A,1./np.sqrt(A)
+    prob = ndtr((upper-mean)/sigma) - ndtr((lower-mean)/sigma)
+    if prob <= 0.:
+        return -np.inf,(mean,sigma,lower,upper)
+    log_like = log_like - np.log(upper-lower) + 0.5*np.log(2.*np.pi/A) - 0.5*(C - B**2/A) + np.log(prob)
+    return log_like,(mean,sigma,lower,upper)
+
+def sample_linear_parameter(conditional):
+    """
+    Given the (mean, standard-deviation, lower and upper limits) of the conditional posterior 
+    of a linear parameter returned by get_marginalized_lnlike, this function returns a sample of it.
+    """
+    mean,sigma,lower,upper = conditional
+    return truncnorm.rvs((lower-mean)/sigma,(upper-mean)/sigma,loc=mean,scale=sigma)
+
+def get_matern32_gp(t,errors,sigma_w,lnh,lnlambda):
+    """
+    This function returns the (already factorized) celerite GP of the GPMatern32 noise model: a 
+    Matern-3/2 kernel of amplitude exp(lnh) and timescale exp(lnlambda), which approximates the 
+    squared-exponential kernel of the GPExpSquaredKernel model (the timescale of the Matern-3/2 
+    term is sqrt(3) times the one of the squared-exponential kernel, so both have the same curvature 
+    at zero lag) with a cost that scales as O(N). The white noise, sigma_w, is added to the errors. 
+    Returns None if the GP cannot be factorized.
+    """
+    kernel = terms.Matern32Term(log_sigma=lnh, log_rho=lnlambda+0.5*np.log(3.))
+    gp = celerite.GP(kernel, mean=0.)
+    try:
+        gp.compute(t,np.sqrt(errors**2 + sigma_w**2))
+    except:
+        return None
+    return gp
+
+def get_noise_gp(model,t,errors,noise,nasteroseismology=1,mean=0.):
+    """
+    This function returns the (already factorized) GP of one of the gaussian-process noise models 
+    (see gp_noise_models) on times t with errors errors, given the noise parameters of the model 
+    (sigma_w and then the parameters in noise_model_params). The kernels are the ones used in the 
+    likelihoods of the fit; the mean of the celerite GPs is mean (the george one is zero), and 
+    nasteroseismology is the number of frequency kernels of the GPAsteroseismology model. Returns 
+    None if the GP cannot be factorized.
+    """
+    if model == 'GPMatern32':
+        return get_matern32_gp(t,errors,*noise)
+    if model == 'GPExpSquaredKernel':
+        sigma_w,lnh,lnlambda = noise
+        kernel = (np.exp(lnh)**2)*george.kernels.ExpSquaredKernel(np.exp(lnlambda)**2)
+        gp = george.GP(kernel,solver=george.HODLRSolver)
+        try:
+            gp.compute(t,np.sqrt(errors**2 + sigma_w**2))
+        except:
+            return None
+        return gp
+    bounds = dict(log_S0=(-1e15, 1e15), log_Q=(-1e15, 1e15), log_omega0=(-1e15, 1e15),log_sigma=(-1e15,1e15))
+    # First, the granulation noise component:
+    sigma_w,lnomega,lnS = noise[:3]
+    kernel = terms.SHOTerm(log_S0=lnS, log_Q=np.log(1./np.sqrt(2.)), log_omega0=lnomega,\
+                               bounds=bounds)
+    kernel.freeze_parameter("log_Q")
+    if model == 'GPAsteroseismology':
+        # Next, the frequency kernels:
+        lnQ,lnA,epsilon,lnW,lnnu,lnDeltanu = noise[3:]
+        nu = np.exp(lnnu)
+        Deltanu = np.exp(lnDeltanu)
+        W = np.exp(lnW)
+        n = nasteroseismology
+        for j in range(-(n-1)/2,(n-1)/2+1):
+            lnSj = lnA - 2.*lnQ - (j*Deltanu+epsilon)**2/(2.*(W**2))
+            wj = 2.*np.pi*(nu+j*Deltanu+epsilon)*0.0864 # Last factor converts from muHz to 1/day (assuming t is in days)
+            if wj>0.:
+                kernel += terms.SHOTerm(log_S0=lnSj, log_Q=lnQ, log_omega0=np.log(wj),
+                            bounds=bounds)
+            else:
+                return None
+    # Finally, a "jitter" term component for the photometric noise:
+    kernel += terms.JitterTerm(log_sigma=np.log(sigma_w),\
+              bounds=bounds)
+    gp = celerite.GP(kernel, mean=mean)
+    try:
+        gp.compute(t,errors)
+    except:
+        return None
+    return gp
+
+def get_gp_prediction(model,gp,residuals,t,t_pred,variance=True,nchunk=200):
+    """
+    Given a GP factorized on times t by get_noise_gp, this function returns the mean and the 
+    variance (None if variance is False) of its conditional distribution given the residuals, at 
+    times t_pred. Only the correlated component of the noise (i.e., not the white noise) is 
+    predicted. Both reuse the factorization of the GP: the mean of the celerite GPs costs O(N+M) 
+    (for N times t and M times t_pred), while the variance (and the mean of the george GP) costs 
+    O(N*M), and is computed on chunks of nchunk times t_pred to bound the memory.
+    """
+    mu = np.zeros(len(t_pred))
+    var = np.zeros(len(t_pred)) if variance else None
+    if model == 'GPExpSquaredKernel':
+        alpha = gp.apply_inverse(residuals)
+    else:
+        mu = gp.predict(residuals,t_pred,return_cov=False)
+    for i in range(0,len(t_pred),nchunk):
+        if model != 'GPExpSquaredKernel' and not variance:
+            break
+        Kxs = gp.get_matrix(t_pred[i:i+nchunk],t)
+        if model == 'GPExpSquaredKernel':
+            mu[i:i+nchunk] = np.dot(Kxs,alpha)
+        if variance:
+            KxsT = np.ascontiguousarray(Kxs.T)
+            var[i:i+nchunk] = gp.get_matrix(t_pred[:1],t_pred[:1])[0,0] - np.sum(KxsT*gp.apply_inverse(KxsT),axis=0)
+    return mu,var
+
+def get_gp_products(model,t,residuals,errors,noise,segments,t_grid,nasteroseismology=1,variance=True):
+    """
+    This function factorizes the GP of a gaussian-process noise model (see get_noise_gp) once on each 
+    of the segments of the data (a list of (start,end) indexes, see get_segments), as in the likelihood 
+    of the fit, and uses these factorizations to return the log-likelihood of the residuals and the 
+    conditional mean and variance (see get_gp_prediction) of the GP on the times t of the data and on 
+    the times t_grid (which are predicted with the segment closest to them). Returns -np.inf and None 
+    for the predictions if the GP cannot be factorized.
+    """
+    log_like = 0.
+    mu,mu_grid = np.zeros(len(t)),np.zeros(len(t_grid))
+    var,var_grid = None,None
+    if variance:
+        var,var_grid = np.zeros(len(t)),np.zeros(len(t_grid))
+    edges = [(t[start-1]+t[start])/2. for start,end in segments[1:]]
+    grid_segments = np.searchsorted(edges,t_grid)
+    for i in range(len(segments)):
+        start,end = segments[i]
+        gp = get_noise_gp(model,t[start:end],errors[start:end],noise,nasteroseismology,mean=np.mean(residuals))
+        if gp is None:
+            return -np.inf,None,None,None,None
+        log_like = log_like + gp.log_likelihood(residuals[start:end])
+        idx = np.where(grid_segments == i)[0]
+        mu_i,var_i = get_gp_prediction(model,gp,residuals[start:end],t[start:end],t[start:end],variance)
+        mu_grid_i,var_grid_i = get_gp_prediction(model,gp,residuals[start:end],t[start:end],t_grid[idx],variance)
+        mu[start:end],mu_grid[idx] = mu_i,mu_grid_i
+        if variance:
+            var[start:end],var_grid[idx] = var_i,var_grid_i
+    return log_like,mu,var,mu_grid,var_grid
+
+def get_gp_benchmark(t,errors,residuals,sigma_w,lnh,lnlambda,nrepeat=3):
+    """
+    This function compares the GPMatern32 noise model with the george (HODLR) GPExpSquaredKernel 
+    model it approximates: it returns the time it takes to build and factorize each of the GPs and 
+    to evaluate the log-likelihood of the residuals (taking the best of nrepeat evaluations), the 
+    ratio between both times and the log-likelihoods of both models (which are None for a 
+    model whose GP could not be factorized, e.g., if george runs out of memory).
+    """
+    def sq_exp_lnlike():
+        kernel = (np.exp(lnh)**2)*george.kernels.ExpSquaredKernel(np.exp(lnlambda)**2)
+        gp = george.GP(kernel,solver=george.HODLRSolver)
+        gp.compute(t,np.sqrt(errors**2 + sigma_w**2))
+        return gp.lnlikelihood(residuals)
+    def matern32_lnlike():
+        return get_matern32_gp(t,errors,sigma_w,lnh,lnlambda).log_likelihood(residuals)
+    benchmark = {'npoints':len(t)}
+    for name,function in [('george',sq_exp_lnlike),('celerite',matern32_lnlike)]:
+        benchmark[name+'_time'],benchmark[name+'_lnlike'] = None,None
+        best = np.inf
+        try:
+            for i in range(nrepeat):
+                tic = time.time()
+                lnlike = function()
+                best = np.min([best,time.time()-tic])
+        except:
+            continue
+        benchmark[name+'_time'] = float(best)
+        benchmark[name+'_lnlike'] = float(lnlike)
+    benchmark['speedup'],benchmark['delta_lnlike'] = None,None
+    if benchmark['george_time'] is not None and benchmark['celerite_time'] is not None:
+        benchmark['speedup'] = benchmark['george_time']/np.max([benchmark['celerite_time'],1e-9])
+        benchmark['delta_lnlike'] = benchmark['celerite_lnlike']-benchmark['george_lnlike']
+    return benchmark
+
+def get_fnorm_name(parameters,instrument):
+    """
+    This function returns the name of the flux normalization parameter of a given instrument.
+    """
+    if 'fnorm_'+instrument in parameters.keys():
+        return 'fnorm_'+instrument
+    return 'fnorm'
+
 def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv, rv_err, rv_instruments,\
-                       parameters, idx_resampling, options):
+                       parameters, idx_resampling, options, warm_start = None, estimate = False, worker = None):
     """
     This function performs an MCMC fitting procedure using a transit model 
     fitted to input data using the batman package (Kreidberg, 2015) assuming 
@@ -265,7 +1371,7 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
       error:            If you have errors on the fluxes, put them here. Otherwise, set 
                         this to None.
 
-      tr_instruments:   Instruments of each time/flux pair.
+      tr_instruments:   Instrument registry of the time/flux pairs (see general_utils.get_instrument_registry).
 
       times_rv:         Times (in same units as the period and time of transit center) 
                         of RV data.
@@ -275,7 +1381,7 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
       rv_err:           If you have errors on the RVs, put them here. Otherwise, set 
                         this to None.
 
-      rv_instruments:   Instruments of each time/RV pair.
+      rv_instruments:   Instrument registry of the time/RV pairs.
 
       parameters:       Dictionary containing the information regarding the parameters (including priors).
 
@@ -285,33 +1391,105 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
 
       options:          Dictionary containing the information inputted by the user.
 
+      warm_start:       (Optional) Dictionary with the posterior samples of a previous fit. If given, the 
+                        walkers are initialized from them and the burn-in is stopped as soon as the 
+                        split-R-hat of all the parameters is below options['WARM_START_RHAT'] (the MAP 
+                        fit, instead, starts from their medians).
+
+      estimate:         (Optional) If True, the fit is not performed; instead, its cost is estimated 
+                        (see get_cost_estimate) after the whole set-up is done.
+
+      worker:           (Optional) Used by the posterior workers (see parallel_utils.WorkerPool). If given, 
+                        the data of the fit is taken from the arrays published by the main process, and 
+                        the function serves the evaluations of the posterior instead of performing the fit.
+
     The outputs are the chains of each of the parameters in the theta_0 array in the same 
-    order as they were inputted. This includes the sampled parameters from all the walkers.
+    order as they were inputted. This includes the sampled parameters from all the walkers. 
+    The function returns a dictionary with the convergence and efficiency diagnostics of the 
+    fit (see get_chain_diagnostics), or None if the posteriors were already computed. If 
+    estimate is True, it returns the cost estimate instead.
 
     """
 
+    correlated_noise_models = ['flicker','GPExpSquaredKernel','GPMatern32','GPGranulation','GPAsteroseismology']
+    # If the posterior is evaluated on worker processes, keep the inputs of the set-up of the fit for them:
+    if worker is None and not estimate and (options['NWORKERS'] > 1 or options['WORKER_NODES'].lower() != 'none'):
+        import copy
+        worker_meta = {'parameters':copy.deepcopy(parameters),'options':options,\
+                       'tr_instruments':None,'rv_instruments':None,'resampling_instruments':None}
     # If mode is not RV:
     if options['MODE'] != 'rvs':
         params = {}
         m = {}
         t_resampling = {}
         transit_flat = {}
+        fast_transit = {}
+        fast_models = {}
+        resampling_order = {}
         # Count instruments:
         all_tr_instruments,all_tr_instruments_idxs,n_data_trs = count_instruments(tr_instruments)
-        # Prepare data for batman:
-        xt = times.astype('float64')
-        yt = relative_flux.astype('float64')
-        yerrt = error.astype('float64')
+        # Prepare data for batman. Times are referenced to t_ref and fluxes are stored as offsets from 1 (which 
+        # is exact in double precision), so on float32 mode the times, fluxes and errors can be stored in single 
+        # precision (the times are cast to double precision for batman on each evaluation, and residuals and 
+        # likelihoods are computed in double precision):
+        if options['PRECISION'].lower() == 'float32':
+            t_ref = np.floor(np.min(times))
+            tr_dtype = 'float32'
+        else:
+            t_ref = 0.
+            tr_dtype = 'float64'
+        if worker is not None:
+            t_ref = worker.meta['t_ref']
+            xt,dyt,yerrt = worker.arrays['xt'],worker.arrays['dyt'],worker.arrays['yerrt']
+        else:
+            xt = (np.asarray(times,dtype='float64')-t_ref).astype(tr_dtype,copy=False)
+            dyt = (relative_flux-1.).astype(tr_dtype,copy=False)
+            yerrt = error.astype(tr_dtype,copy=False)
+        # Data used by the likelihoods, by the precision asked for (None is the one of the fit):
+        tr_data = {None:(xt,dyt,yerrt)}
+        tr_idxs = dict(zip(all_tr_instruments,all_tr_instruments_idxs))
+        # Contiguous segments of the data of each instrument (see get_segments), on which the correlated 
+        # noise likelihoods are evaluated independently (so the wavelet transforms are not padded, and the 
+        # GPs are not factorized, across the gaps):
+        noise_segments = {}
+        for k in range(len(all_tr_instruments)):
+            instrument = all_tr_instruments[k]
+            noise_segments[instrument] = [slice(None)]
+            if options['photometry'][instrument]['PHOT_NOISE_MODEL'] in correlated_noise_models:
+                segments = get_noise_segments(xt[all_tr_instruments_idxs[k]],options,instrument)
+                if len(segments) > 1:
+                    noise_segments[instrument] = [slice(start,end) for start,end in segments]
+                    print '\t Evaluating the noise likelihood of instrument '+instrument+' on '+str(len(segments))+' segments.'
         if options['MODE'] != 'transit_noise':
+          # Define the number of batman threads of each instrument, which are sized according to the 
+          # number of points on which each transit model is evaluated (the instruments are evaluated one 
+          # after the other, as the batman extensions do not release the GIL, so Python threads could 
+          # not run them concurrently):
+          tr_nthreads = np.ones(len(all_tr_instruments)).astype(int)
+          if options['PARALLEL_INSTRUMENTS'].lower() == 'yes':
+              npoints = np.zeros(len(all_tr_instruments))
+              for k in range(len(all_tr_instruments)):
+                  instrument = all_tr_instruments[k]
+                  if options['photometry'][instrument]['RESAMPLING']:
+                      npoints[k] = len(idx_resampling[instrument])*options['photometry'][instrument]['NRESAMPLING']
+                  else:
+                      npoints[k] = n_data_trs[k]
+              tr_nthreads = get_instrument_threads(npoints,options['NCPUS'])
+              for k in range(len(all_tr_instruments)):
+                  print '\t Using '+str(tr_nthreads[k])+' thread(s) for the transit model of instrument '+all_tr_instruments[k]+'.'
           for k in range(len(all_tr_instruments)):
             instrument = all_tr_instruments[k]
-            params[instrument],m[instrument] = init_batman(xt[all_tr_instruments_idxs[k]],\
-                                               law=options['photometry'][instrument]['LD_LAW'])
+            params[instrument],m[instrument] = init_batman(xt[all_tr_instruments_idxs[k]].astype('float64',copy=False),\
+                                               law=options['photometry'][instrument]['LD_LAW'],\
+                                               nthreads=tr_nthreads[k])
             # Initialize the parameters of the transit model, 
             # and prepare resampling data if resampling is True:
             if options['photometry'][instrument]['RESAMPLING']:
-               t_resampling[instrument] = np.array([])
-               for i in range(len(idx_resampling[instrument])):
+               if worker is not None:
+                   t_resampling[instrument] = worker.arrays['t_resampling_'+instrument]
+               else:
+                 t_resampling[instrument] = np.array([])
+                 for i in range(len(idx_resampling[instrument])):
                    tij = np.zeros(options['photometry'][instrument]['NRESAMPLING'])
                    for j in range(1,options['photometry'][instrument]['NRESAMPLING']+1):
                        # Eq (35) in Kipping (2010)    
@@ -320,11 +1498,27 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
                                   options['photometry'][instrument]['NRESAMPLING'])))
                    t_resampling[instrument] = np.append(t_resampling[instrument], np.copy(tij))
 
-               params[instrument],m[instrument] = init_batman(t_resampling[instrument],\
-                                                  law=options['photometry'][instrument]['LD_LAW'])
+               t_model = t_resampling[instrument]
+               if options['photometry'][instrument]['FAST_TRANSIT']:
+                   # The exposures of consecutive points can overlap, so the fast path evaluates the model 
+                   # on the sorted resampled times (and the model is put back in their order afterwards):
+                   resampling_order[instrument] = np.argsort(t_model,kind='mergesort')
+                   t_model = t_model[resampling_order[instrument]]
+               params[instrument],m[instrument] = init_batman(t_model,\
+                                                  law=options['photometry'][instrument]['LD_LAW'],\
+                                                  nthreads=tr_nthreads[k])
                transit_flat[instrument] = np.ones(len(xt[all_tr_instruments_idxs[k]]))
                transit_flat[instrument][idx_resampling[instrument]] = np.zeros(len(idx_resampling[instrument]))
 
+            # Check if the out-of-transit fast path can be used (it needs sorted times):
+            fast_transit[instrument] = False
+            if options['photometry'][instrument]['FAST_TRANSIT']:
+               if np.all(np.diff(m[instrument].t)>=0):
+                   fast_transit[instrument] = True
+                   fast_models[instrument] = init_fast_model(m[instrument],params[instrument])
+               else:
+                   print '\t Warning: times of instrument '+instrument+' are not sorted. Not using the fast transit path.'
+
     # Initialize the variable names:
     if options['MODE'] != 'rvs':
         if len(all_tr_instruments)>1:
@@ -338,12 +1532,15 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
 
     # If mode is not transit, prepare the RV data too:
     if 'transit' not in options['MODE']:
-       xrv = times_rv.astype('float64')
-       yrv = rv.astype('float64')
-       if rv_err is None:
-           yerrrv = 0.0
+       if worker is not None:
+           xrv,yrv,yerrrv = worker.arrays['xrv'],worker.arrays['yrv'],worker.arrays.get('yerrrv',0.0)
        else:
-           yerrrv = rv_err.astype('float64')
+           xrv = times_rv.astype('float64')
+           yrv = rv.astype('float64')
+           if rv_err is None:
+               yerrrv = 0.0
+           else:
+               yerrrv = rv_err.astype('float64')
        all_rv_instruments,all_rv_instruments_idxs,n_data_rvs = count_instruments(rv_instruments)
 
        rv_params = ['K']
@@ -411,7 +1608,7 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
                             transit_params.pop(transit_params.index(noise_param+'_'+instrument))
                         elif parameters[noise_param+'_'+instrument]['type'] in prior_distributions:
                             parameters_to_check.append(noise_param+'_'+instrument)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
+                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] in ['GPExpSquaredKernel','GPMatern32']:
                     for noise_param in ['lnh','lnlambda']:
                         transit_params.append(noise_param+'_'+instrument)
                         if parameters[noise_param+'_'+instrument]['type'] == 'FIXED':
@@ -444,7 +1641,7 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
                     transit_params.pop(transit_params.index('sigma_r'))
                 elif parameters['sigma_r']['type'] in prior_distributions:
                     parameters_to_check.append('sigma_r')
-            elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
+            elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] in ['GPExpSquaredKernel','GPMatern32']:
                 transit_params.pop(transit_params.index('sigma_r'))
                 for noise_param in ['lnh','lnlambda']:
                     transit_params.append(noise_param)
@@ -507,6 +1704,46 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
                     rv_params.append(rvpar)
                 elif parameters[rvpar]['type'] != 'FIXED':
                     rv_params.append(rvpar)
+    # Linear parameters that are marginalized analytically in the likelihood (and, thus, not sampled), 
+    # and the parameters of their conditional posteriors on the last evaluation of the likelihood:
+    marginalized_params = []
+    linear_conditionals = {}
+    rv_offset_names = {}
+    fnorm_names = {}
+    if options['MODE'] != 'transit' and options['MODE'] != 'transit_noise' and \
+       options['MARGINALIZE_RV_OFFSETS'].lower() == 'yes':
+        for instrument in all_rv_instruments:
+            if len(all_rv_instruments)>1:
+                if sufix[instrument]['mu'] == '':
+                    print 'Error: RV offsets can only be marginalized if they are defined for each instrument. Exiting...'
+                    sys.exit()
+                par = 'mu'+sufix[instrument]['mu']
+            else:
+                par = 'mu'
+            if parameters[par]['type'] == 'FIXED':
+                continue
+            if parameters[par]['type'] not in ['Normal','Uniform']:
+                print 'Error: only parameters with Normal or Uniform priors can be marginalized ('+par+'). Exiting...'
+                sys.exit()
+            rv_params.pop(rv_params.index(par))
+            marginalized_params.append(par)
+            rv_offset_names[instrument] = par
+    if options['MODE'] != 'rvs' and options['MODE'] != 'transit_noise':
+        for instrument in all_tr_instruments:
+            if options['photometry'][instrument]['MARGINALIZE_FNORM']:
+                par = get_fnorm_name(parameters,instrument)
+                if options['photometry'][instrument]['PHOT_NOISE_MODEL'] != 'white':
+                    print 'Error: the flux normalization can only be marginalized for white-noise fits. Exiting...'
+                    sys.exit()
+                if par not in parameters.keys() or parameters[par]['type'] not in ['Normal','Uniform']:
+                    print 'Error: parameter '+par+' has to be defined with a Normal or Uniform prior. Exiting...'
+                    sys.exit()
+                if par in marginalized_params:
+                    print 'Error: the flux normalization has to be defined for each instrument ('+par+'_instrument). Exiting...'
+                    sys.exit()
+                marginalized_params.append(par)
+                fnorm_names[instrument] = par
+
     if options['MODE'] == 'transit':
             all_mcmc_params = transit_params + common_params
     elif options['MODE'] == 'rvs':
@@ -518,8 +1755,8 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
                 noise_parameters = ['sigma_w']
             if options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] == 'flicker':
                 noise_parameters = ['sigma_w','sigma_r']
-            elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
-                noise_parameters in ['lnh','lnlambda','sigma_w']
+            elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] in ['GPExpSquaredKernel','GPMatern32']:
+                noise_parameters = ['lnh','lnlambda','sigma_w']
             elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] == 'GPGranulation':
                 noise_parameters = ['lnomega','lnS','sigma_w']
             elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] == 'GPAsteroseismology':
@@ -534,6 +1771,36 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
             all_mcmc_params = transit_params + rv_params + common_params
 
     n_params = len(all_mcmc_params)
+
+    # Compile the positions of the parameters used by the models of each instrument in the vector 
+    # of parameter values (which is updated with theta on each call to lnprior), so the likelihood 
+    # gathers them by integer indexes instead of looking them up by name. For the transits, the 
+    # order is t0, P, p, a, inc, ecc, omega, q1, q2 and then sigma_w and the other noise parameters; 
+    # for the RVs, it is P, t0, omega, ecc, K and then mu and sigma_w_rv:
+    param_values,param_index = get_parameter_table(parameters,all_mcmc_params)
+    tr_slots = {}
+    noise_slots = {}
+    rv_slots = {}
+    if options['MODE'] != 'rvs':
+        for instrument in all_tr_instruments:
+            names = ['sigma_w']+noise_model_params.get(options['photometry'][instrument]['PHOT_NOISE_MODEL'],[])
+            if len(all_tr_instruments)>1:
+                names = [name+sufix[instrument].get(name,'_'+instrument) for name in names]
+            noise_slots[instrument] = np.array([param_index[name] for name in names])
+            if options['MODE'] != 'transit_noise':
+                names = ['t0','P','p','a','inc','ecc','omega','q1','q2']
+                if len(all_tr_instruments)>1:
+                    names = [name+sufix[instrument].get(name,'') for name in names]
+                tr_slots[instrument] = np.append([param_index[name] for name in names],noise_slots[instrument])
+    if options['MODE'] != 'transit' and options['MODE'] != 'transit_noise':
+        for instrument in all_rv_instruments:
+            names = ['P','t0','omega','ecc','K','mu','sigma_w_rv']
+            if len(all_rv_instruments)>1:
+                names = [name+sufix[instrument].get(name,'') for name in names]
+            rv_slots[instrument] = np.array([param_index[name] for name in names])
+    mcmc_objects = [parameters[par]['object'] for par in all_mcmc_params]
+    mcmc_checks = [par in parameters_to_check for par in all_mcmc_params]
+
     def normal_like(x,mu,tau):
         return 0.5*(np.log(tau) - log2pi - tau*( (x-mu)**2))
 
@@ -567,58 +1834,35 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
         return like
 
     def get_sq_exp_likelihood(t,residuals,errors,sigma_w,lnh,lnlambda):
-        kernel = (np.exp(lnh)**2)*george.kernels.ExpSquaredKernel(np.exp(lnlambda)**2)
-        gp = george.GP(kernel,solver=george.HODLRSolver)
-        try:
-            gp.compute(t,np.sqrt(errors**2 + sigma_w**2))
-        except:
+        gp = get_noise_gp('GPExpSquaredKernel',t,errors,[sigma_w,lnh,lnlambda])
+        if gp is None:
             return -np.inf
-        return gp.lnlikelihood(residuals)
+        return gp.log_likelihood(residuals)
 
-    def get_granulation_likelihood(t,residuals,errors,sigma_w,lnomega,lnS):
-        bounds = dict(log_S0=(-1e15, 1e15), log_Q=(-1e15, 1e15), log_omega0=(-1e15, 1e15),log_sigma=(-1e15,1e15))
-        kernel = terms.SHOTerm(log_S0=lnS, log_Q=np.log(1./np.sqrt(2.)), log_omega0=lnomega,\
-                                   bounds=bounds)
-        kernel.freeze_parameter("log_Q")
-        kernel += terms.JitterTerm(log_sigma=np.log(sigma_w),\
-                  bounds=bounds)
-        gp = celerite.GP(kernel, mean=np.mean(residuals))
-        try:
-            gp.compute(t,errors)
-        except:
+    def get_matern32_likelihood(t,residuals,errors,sigma_w,lnh,lnlambda):
+        gp = get_matern32_gp(t,errors,sigma_w,lnh,lnlambda)
+        if gp is None:
+            return -np.inf
+        log_like = gp.log_likelihood(residuals)
+        if np.isnan(log_like):
+            return -np.inf
+        return log_like
+
+    def get_granulation_likelihood(t,residuals,errors,sigma_w,lnomega,lnS,mean=None):
+        gp = get_noise_gp('GPGranulation',t,errors,[sigma_w,lnomega,lnS],\
+                          mean=np.mean(residuals) if mean is None else mean)
+        if gp is None:
             return -np.inf
         return gp.log_likelihood(residuals)
 
     def get_asteroseismology_likelihood(t,residuals,errors,sigma_w,lnomega,lnS,lnQ,lnA,epsilon,\
-                                        lnW,lnnu,lnDeltanu,instrument):
-        bounds = dict(log_S0=(-1e15, 1e15), log_Q=(-1e15, 1e15), log_omega0=(-1e15, 1e15),log_sigma=(-1e15,1e15))
-        # First, the granulation noise component:
-        kernel = terms.SHOTerm(log_S0=lnS, log_Q=np.log(1./np.sqrt(2.)), log_omega0=lnomega,\
-                                   bounds=bounds)
-        kernel.freeze_parameter("log_Q")
-
-        # Next, the frequency kernels:
-        nu = np.exp(lnnu)
-        Deltanu = np.exp(lnDeltanu)
-        W = np.exp(lnW)
-        n = options['photometry'][instrument]["NASTEROSEISMOLOGY"]
-        for j in range(-(n-1)/2,(n-1)/2+1):
-            lnSj = lnA - 2.*lnQ - (j*Deltanu+epsilon)**2/(2.*(W**2))
-            wj = 2.*np.pi*(nu+j*Deltanu+epsilon)*0.0864 # Last factor converts from muHz to 1/day (assuming t is in days)
-            if wj>0.:
-                kernel += terms.SHOTerm(log_S0=lnSj, log_Q=lnQ, log_omega0=np.log(wj),
-                            bounds=bounds)
-            else:
-                return -np.inf
-
-        # Finally, a "jitter" term component for the photometric noise:
-        kernel += terms.JitterTerm(log_sigma=np.log(sigma_w),\
-                  bounds=bounds)
-
-        # Set the GP:
-        gp = celerite.GP(kernel, mean=np.mean(residuals))
+                                        lnW,lnnu,lnDeltanu,instrument,mean=None):
+        gp = get_noise_gp('GPAsteroseismology',t,errors,[sigma_w,lnomega,lnS,lnQ,lnA,epsilon,lnW,lnnu,lnDeltanu],\
+                          options['photometry'][instrument]["NASTEROSEISMOLOGY"],\
+                          mean=np.mean(residuals) if mean is None else mean)
+        if gp is None:
+            return -np.inf
         try:
-            gp.compute(t,errors)
             lnlike = gp.log_likelihood(residuals)
         except:
             return -np.inf
@@ -629,151 +1873,140 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
         else:
             return -np.inf
 
-    def lnlike_transit_noise(gamma=1.0):
-            residuals = (yt-1.0)*1e6
-            if options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'flicker':
-               log_like = get_fn_likelihood(residuals,parameters['sigma_w']['object'].value,\
-                               parameters['sigma_r']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
-               log_like = get_sq_exp_likelihood(xt,residuals,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnh']['object'].value,\
-                              parameters['lnlambda']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPGranulation':
-               log_like = get_granulation_likelihood(xt,residuals,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnomega']['object'].value,\
-                              parameters['lnS']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPAsteroseismology':
-               log_like = get_asteroseismology_likelihood(xt,residuals,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnomega']['object'].value,\
-                              parameters['lnS']['object'].value,\
-                              parameters['lnQ']['object'].value,\
-                              parameters['lnA']['object'].value,\
-                              parameters['epsilon']['object'].value,\
-                              parameters['lnW']['object'].value,\
-                              parameters['lnnu']['object'].value,\
-                              parameters['lnDeltanu']['object'].value,\
-                              the_instrument)
+    def get_noise_likelihood(instrument,t,residuals,errors,noise):
+        # Correlated noise likelihood of an instrument, summed over its segments (the mean of the 
+        # celerite GPs is the one of all the residuals):
+        model = options['photometry'][instrument]['PHOT_NOISE_MODEL']
+        mean = np.mean(residuals)
+        log_like = 0.
+        for segment in noise_segments[instrument]:
+            if model == 'flicker':
+               log_like = log_like + get_fn_likelihood(residuals[segment],noise[0],noise[1])
+            elif model == 'GPExpSquaredKernel':
+               log_like = log_like + get_sq_exp_likelihood(t[segment],residuals[segment],errors[segment],*noise)
+            elif model == 'GPMatern32':
+               log_like = log_like + get_matern32_likelihood(t[segment],residuals[segment],errors[segment],*noise)
+            elif model == 'GPGranulation':
+               log_like = log_like + get_granulation_likelihood(t[segment],residuals[segment],errors[segment],\
+                                                                *noise,mean=mean)
+            elif model == 'GPAsteroseismology':
+               log_like = log_like + get_asteroseismology_likelihood(t[segment],residuals[segment],errors[segment],\
+                                                                     *(list(noise)+[instrument]),mean=mean)
+        return log_like
+
+    def lnlike_transit_noise(gamma=1.0,dtype=None):
+            xt,dyt,yerrt = tr_data[dtype]
+            residuals = dyt*1e6
+            noise = param_values[noise_slots[the_instrument]]
+            if options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] in correlated_noise_models:
+               log_like = get_noise_likelihood(the_instrument,xt,residuals,yerrt*1e6,noise)
             else:
-               taus = 1.0/((yerrt*1e6)**2 + (parameters['sigma_w']['object'].value)**2)
+               taus = 1.0/((yerrt.astype('float64',copy=False)*1e6)**2 + noise[0]**2)
                log_like = -0.5*(n_data_trs[0]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
             return log_like
 
-    def lnlike_transit(gamma=1.0):
+    def get_light_curve(instrument,dtype=None):
+        if options['photometry'][instrument]['RESAMPLING']:
+            # (the model of resampled instruments is evaluated on the resampled times):
+            if fast_transit[instrument]:
+                model = np.empty(len(resampling_order[instrument]))
+                model[resampling_order[instrument]] = get_fast_light_curve(m[instrument],fast_models[instrument],\
+                                                                            params[instrument])
+                return model
+            return m[instrument].light_curve(params[instrument])
+        # The times of the data are cast to double precision for batman (which is a view on float64 
+        # mode), and the cast is released after the evaluation. Resetting t0 makes batman recompute 
+        # the star-planet separations on them:
+        m[instrument].t = m[instrument].t_supersample = tr_data[dtype][0][tr_idxs[instrument]].astype('float64',copy=False)
+        m[instrument].t0 = None
+        if fast_transit[instrument]:
+            model = get_fast_light_curve(m[instrument],fast_models[instrument],params[instrument])
+        else:
+            model = m[instrument].light_curve(params[instrument])
+        m[instrument].t = m[instrument].t_supersample = None
+        return model
+
+    def set_transit_params(instrument):
+        t0,P,p,a,inc,ecc,omega,q1,q2 = param_values[tr_slots[instrument][:9]]
+        coeff1,coeff2 = reverse_ld_coeffs(options['photometry'][instrument]['LD_LAW'],q1,q2)
+        params[instrument].t0 = t0 - t_ref
+        params[instrument].per = P
+        params[instrument].rp = p
+        params[instrument].a = a
+        params[instrument].inc = inc
+        params[instrument].ecc = ecc
+        params[instrument].w = omega
+        params[instrument].u = [coeff1,coeff2]
+
+    def lnlike_transit_instrument(k,dtype=None):
+        xt,dyt,yerrt = tr_data[dtype]
+        instrument = all_tr_instruments[k]
+        set_transit_params(instrument)
+        model = get_light_curve(instrument,dtype)
+        if options['photometry'][instrument]['RESAMPLING']:
+           for i in range(len(idx_resampling[instrument])):
+               transit_flat[instrument][idx_resampling[instrument][i]] = \
+               np.mean(model[i*options['photometry'][instrument]['NRESAMPLING']:options['photometry'][instrument]['NRESAMPLING']*(i+1)])
+           residuals = (dyt[all_tr_instruments_idxs[k]]-(transit_flat[instrument]-1.))*1e6
+        else:
+           residuals = (dyt[all_tr_instruments_idxs[k]]-(model-1.))*1e6
+        noise = param_values[tr_slots[instrument][9:]]
+        if options['photometry'][instrument]['PHOT_NOISE_MODEL'] in correlated_noise_models:
+           log_like = get_noise_likelihood(instrument,xt[all_tr_instruments_idxs[k]],residuals,\
+                                           yerrt[all_tr_instruments_idxs[k]]*1e6,noise)
+        else:
+           taus = 1.0/((yerrt[all_tr_instruments_idxs[k]].astype('float64',copy=False)*1e6)**2 + noise[0]**2)
+           if instrument in fnorm_names:
+               yk = dyt[all_tr_instruments_idxs[k]].astype('float64')+1.
+               log_like,linear_conditionals[fnorm_names[instrument]] = get_marginalized_lnlike(yk*1e6,\
+                                      yk*1e6-residuals,1./taus,parameters[fnorm_names[instrument]]['type'],\
+                                      parameters[fnorm_names[instrument]]['object'].prior_hypp)
+           else:
+               log_like = -0.5*(n_data_trs[k]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
+        return log_like
+
+    def lnlike_transit(gamma=1.0,dtype=None):
         if len(all_tr_instruments) == 1:
-            coeff1,coeff2 = reverse_ld_coeffs(options['photometry'][the_instrument]['LD_LAW'], \
-                            parameters['q1']['object'].value,parameters['q2']['object'].value)
-            params[the_instrument].t0 = parameters['t0']['object'].value
-            params[the_instrument].per = parameters['P']['object'].value
-            params[the_instrument].rp = parameters['p']['object'].value
-            params[the_instrument].a = parameters['a']['object'].value
-            params[the_instrument].inc = parameters['inc']['object'].value
-            params[the_instrument].ecc = parameters['ecc']['object'].value
-            params[the_instrument].w = parameters['omega']['object'].value
-            params[the_instrument].u = [coeff1,coeff2]
-            model = m[the_instrument].light_curve(params[the_instrument])
+            xt,dyt,yerrt = tr_data[dtype]
+            set_transit_params(the_instrument)
+            model = get_light_curve(the_instrument,dtype)
             if options['photometry'][the_instrument]['RESAMPLING']:
                for i in range(len(idx_resampling[the_instrument])):
                    transit_flat[the_instrument][idx_resampling[the_instrument][i]] = \
                    np.mean(model[i*options['photometry'][the_instrument]['NRESAMPLING']:options['photometry'][the_instrument]['NRESAMPLING']*(i+1)])
-               residuals = (yt-transit_flat[the_instrument])*1e6
+               residuals = (dyt-(transit_flat[the_instrument]-1.))*1e6
             else:
-               residuals = (yt-model)*1e6
-            if options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'flicker':
-               log_like = get_fn_likelihood(residuals,parameters['sigma_w']['object'].value,\
-                               parameters['sigma_r']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
-               log_like = get_sq_exp_likelihood(xt,residuals,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnh']['object'].value,\
-                              parameters['lnlambda']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPGranulation':
-               log_like = get_granulation_likelihood(xt,residuals,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnomega']['object'].value,\
-                              parameters['lnS']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPAsteroseismology':
-               log_like = get_asteroseismology_likelihood(xt,residuals,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnomega']['object'].value,\
-                              parameters['lnS']['object'].value,\
-                              parameters['lnQ']['object'].value,\
-                              parameters['lnA']['object'].value,\
-                              parameters['epsilon']['object'].value,\
-                              parameters['lnW']['object'].value,\
-                              parameters['lnnu']['object'].value,\
-                              parameters['lnDeltanu']['object'].value,\
-                              the_instrument)
+               residuals = (dyt-(model-1.))*1e6
+            noise = param_values[tr_slots[the_instrument][9:]]
+            if options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] in correlated_noise_models:
+               log_like = get_noise_likelihood(the_instrument,xt,residuals,yerrt*1e6,noise)
             else:
-               taus = 1.0/((yerrt*1e6)**2 + (parameters['sigma_w']['object'].value)**2)
-               log_like = -0.5*(n_data_trs[0]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
+               taus = 1.0/((yerrt.astype('float64',copy=False)*1e6)**2 + noise[0]**2)
+               if the_instrument in fnorm_names:
+                   yk = dyt.astype('float64')+1.
+                   log_like,linear_conditionals[fnorm_names[the_instrument]] = get_marginalized_lnlike(yk*1e6,yk*1e6-residuals,1./taus,\
+                                          parameters[fnorm_names[the_instrument]]['type'],parameters[fnorm_names[the_instrument]]['object'].prior_hypp)
+               else:
+                   log_like = -0.5*(n_data_trs[0]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
             if 'stellardensity' in options.keys():
                 sd_mean = options['stellardensity']['mean']
                 sd_sigma = options['stellardensity']['sigma']
                 #print 'val:',sd_mean,sd_sigma
-                model = ((3.*np.pi)/(G*(parameters['P']['object'].value*(24.*3600.0))**2))*(parameters['a']['object'].value)**3
+                P,a = param_values[tr_slots[the_instrument][[1,3]]]
+                model = ((3.*np.pi)/(G*(P*(24.*3600.0))**2))*(a)**3
                 #print 'model:',model
                 log_like = log_like - 0.5*(log2pi + 2.*np.log(sd_sigma) + ((model-sd_mean)/sd_sigma)**2)
             #print 'Median residuals:',np.median(residuals)
             #print 'Transit log-like:',log_like
             return log_like
         else:
-            log_like = 0.0
-            for k in range(len(all_tr_instruments)):
-                instrument = all_tr_instruments[k]
-                coeff1,coeff2 = reverse_ld_coeffs(options['photometry'][instrument]['LD_LAW'], \
-                                parameters['q1'+sufix[instrument]['q1']]['object'].value,\
-                                parameters['q2'+sufix[instrument]['q2']]['object'].value)
-                params[instrument].t0 = parameters['t0'+sufix[instrument]['t0']]['object'].value
-                params[instrument].per = parameters['P']['object'].value
-                params[instrument].rp = parameters['p'+sufix[instrument]['p']]['object'].value
-                params[instrument].a = parameters['a'+sufix[instrument]['a']]['object'].value
-                params[instrument].inc = parameters['inc']['object'].value
-                params[instrument].ecc = parameters['ecc']['object'].value
-                params[instrument].w = parameters['omega']['object'].value
-                params[instrument].u = [coeff1,coeff2]
-                model = m[instrument].light_curve(params[instrument])
-                if options['photometry'][instrument]['RESAMPLING']:
-                   for i in range(len(idx_resampling[instrument])):
-                       transit_flat[instrument][idx_resampling[instrument][i]] = \
-                       np.mean(model[i*options['photometry'][instrument]['NRESAMPLING']:options['photometry'][instrument]['NRESAMPLING']*(i+1)])
-                   residuals = (yt[all_tr_instruments_idxs[k]]-transit_flat[instrument])*1e6
-                else:
-                   residuals = (yt[all_tr_instruments_idxs[k]]-model)*1e6
-                if options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'flicker':
-                   log_like = log_like + get_fn_likelihood(residuals,parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                                   parameters['sigma_r'+sufix[instrument]['sigma_r']]['object'].value)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
-                   log_like = log_like + get_sq_exp_likelihood(xt[all_tr_instruments_idxs[k]],residuals,yerrt[all_tr_instruments_idxs[k]]*1e6,\
-                              parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                              parameters['lnh'+sufix[instrument]['lnh']]['object'].value,\
-                              parameters['lnlambda'+sufix[instrument]['lnlambda']]['object'].value)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPGranulation':
-                   log_like = log_like + get_granulation_likelihood(xt[all_tr_instruments_idxs[k]],residuals,yerrt[all_tr_instruments_idxs[k]]*1e6,\
-                              parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                              parameters['lnomega'+sufix[instrument]['lnomega']]['object'].value,\
-                              parameters['lnS'+sufix[instrument]['lnS']]['object'].value)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPAsteroseismology':
-                   log_like = log_like + get_asteroseismology_likelihood(xt[all_tr_instruments_idxs[k]],residuals,yerrt[all_tr_instruments_idxs[k]]*1e6,\
-                              parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                              parameters['lnomega'+sufix[instrument]['lnomega']]['object'].value,\
-                              parameters['lnS'+sufix[instrument]['lnS']]['object'].value,\
-                              parameters['lnQ'+sufix[instrument]['lnQ']]['object'].value,\
-                              parameters['lnA'+sufix[instrument]['lnA']]['object'].value,\
-                              parameters['epsilon'+sufix[instrument]['epsilon']]['object'].value,\
-                              parameters['lnW'+sufix[instrument]['lnW']]['object'].value,\
-                              parameters['lnnu'+sufix[instrument]['lnnu']]['object'].value,\
-                              parameters['lnDeltanu'+sufix[instrument]['lnDeltanu']]['object'].value,\
-                              instrument)
-                else:
-                   taus = 1.0/((yerrt[all_tr_instruments_idxs[k]]*1e6)**2 + (parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value)**2)
-                   log_like = log_like - 0.5*(n_data_trs[k]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
+            log_like = sum([lnlike_transit_instrument(k,dtype) for k in range(len(all_tr_instruments))])
+            instrument = all_tr_instruments[-1]
             if 'stellardensity' in options.keys():
                 sd_mean = options['stellardensity']['mean']
                 sd_sigma = options['stellardensity']['sigma']
-                model = ((3.*np.pi)/(G*(parameters['P']['object'].value*(24.*3600.0))**2))*(parameters['a'+sufix[instrument]['a']]['object'].value)**3
+                P,a = param_values[tr_slots[instrument][[1,3]]]
+                model = ((3.*np.pi)/(G*(P*(24.*3600.0))**2))*(a)**3
                 log_like = log_like - 0.5*(log2pi + 2.*np.log(sd_sigma) + ((model-sd_mean)/sd_sigma)**2)
             return log_like
             
@@ -784,31 +2017,44 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
         #print 'K',parameters['K']['object'].value
         #print 'ecc',parameters['ecc']['object'].value
         if len(all_rv_instruments) == 1:
-            radvel_params['per1'] = radvel.Parameter(value=parameters['P']['object'].value)
-            radvel_params['tc1'] = radvel.Parameter(value=parameters['t0']['object'].value)
-            radvel_params['w1'] = radvel.Parameter(value=parameters['omega']['object'].value*np.pi/180.)
-            radvel_params['e1'] = radvel.Parameter(value=parameters['ecc']['object'].value)
-            radvel_params['k1'] = radvel.Parameter(value=parameters['K']['object'].value)
-            model = parameters['mu']['object'].value + radvel.model.RVModel(radvel_params).__call__(xrv)
+            P,t0,omega,ecc,K,mu,sigma_w_rv = param_values[rv_slots[all_rv_instruments[0]]]
+            radvel_params['per1'] = radvel.Parameter(value=P)
+            radvel_params['tc1'] = radvel.Parameter(value=t0)
+            radvel_params['w1'] = radvel.Parameter(value=omega*np.pi/180.)
+            radvel_params['e1'] = radvel.Parameter(value=ecc)
+            radvel_params['k1'] = radvel.Parameter(value=K)
+            taus = 1.0/((yerrrv)**2 + (sigma_w_rv)**2)
+            if 'mu' in marginalized_params:
+                model = radvel.model.RVModel(radvel_params).__call__(xrv)
+                log_like,linear_conditionals['mu'] = get_marginalized_lnlike(yrv-model,np.ones(n_data_rvs[0]),1./taus,\
+                                                     parameters['mu']['type'],parameters['mu']['object'].prior_hypp)
+                return log_like
+            model = mu + radvel.model.RVModel(radvel_params).__call__(xrv)
 
             residuals = (yrv-model)
             #print 'Median residuals:',np.median(residuals)
-            taus = 1.0/((yerrrv)**2 + (parameters['sigma_w_rv']['object'].value)**2)
             log_like = -0.5*(n_data_rvs[0]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
             #print 'RV log-like:',log_like
             return log_like
         else:
             log_like = 0.0
             for i in range(len(all_rv_instruments)):
-                radvel_params['per1'] = radvel.Parameter(value=parameters['P']['object'].value)
-                radvel_params['tc1'] = radvel.Parameter(value=parameters['t0']['object'].value)
-                radvel_params['w1'] = radvel.Parameter(value=parameters['omega']['object'].value*np.pi/180.)
-                radvel_params['e1'] = radvel.Parameter(value=parameters['ecc']['object'].value)
-                radvel_params['k1'] = radvel.Parameter(value=parameters['K']['object'].value)
-                model = parameters['mu'+sufix[all_rv_instruments[i]]['mu']]['object'].value + \
-                        radvel.model.RVModel(radvel_params).__call__(xrv[all_rv_instruments_idxs[i]])
+                P,t0,omega,ecc,K,mu,sigma_w_rv = param_values[rv_slots[all_rv_instruments[i]]]
+                radvel_params['per1'] = radvel.Parameter(value=P)
+                radvel_params['tc1'] = radvel.Parameter(value=t0)
+                radvel_params['w1'] = radvel.Parameter(value=omega*np.pi/180.)
+                radvel_params['e1'] = radvel.Parameter(value=ecc)
+                radvel_params['k1'] = radvel.Parameter(value=K)
+                taus = 1.0/((yerrrv[all_rv_instruments_idxs[i]])**2 + (sigma_w_rv)**2)
+                if all_rv_instruments[i] in rv_offset_names:
+                    par = rv_offset_names[all_rv_instruments[i]]
+                    model = radvel.model.RVModel(radvel_params).__call__(xrv[all_rv_instruments_idxs[i]])
+                    c_log_like,linear_conditionals[par] = get_marginalized_lnlike(yrv[all_rv_instruments_idxs[i]]-model,\
+                                                          np.ones(n_data_rvs[i]),1./taus,parameters[par]['type'],parameters[par]['object'].prior_hypp)
+                    log_like = log_like + c_log_like
+                    continue
+                model = mu + radvel.model.RVModel(radvel_params).__call__(xrv[all_rv_instruments_idxs[i]])
                 residuals = (yrv[all_rv_instruments_idxs[i]]-model)
-                taus = 1.0/((yerrrv[all_rv_instruments_idxs[i]])**2 + (parameters['sigma_w_rv'+sufix[all_rv_instruments[i]]['sigma_w_rv']]['object'].value)**2)
                 log_like = log_like -0.5*(n_data_rvs[i]*log2pi+np.sum(np.log(1./taus)+taus*(residuals**2)))
             return log_like
 
@@ -817,35 +2063,37 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
         # For each one, if everything is ok, get the total prior, which is the sum 
         # of the independant priors for each parameter:
         total_prior = 0.0
+        param_values[:n_params] = theta
         for i in range(n_params):
-            c_param = all_mcmc_params[i]
-            parameters[c_param]['object'].set_value(theta[i])
-            if c_param in parameters_to_check:
-                if not parameters[c_param]['object'].check_value(theta[i]):
+            mcmc_objects[i].set_value(theta[i])
+            if mcmc_checks[i]:
+                if not mcmc_objects[i].check_value(theta[i]):
                     return -np.inf
-            total_prior += parameters[c_param]['object'].get_ln_prior()
+            total_prior += mcmc_objects[i].get_ln_prior()
         return total_prior
 
-    def lnprob_full(theta):
+    # The posteriors evaluate the transit likelihoods on the data of the fit, or on the data in the 
+    # precision given by dtype (see the checks of the float32 mode):
+    def lnprob_full(theta,dtype=None):
         lp = lnprior(theta)
         if not np.isfinite(lp):
             return -np.inf
         lnrv = lnlike_rv()
-        return lp + lnrv + lnlike_transit()
+        return lp + lnrv + lnlike_transit(dtype=dtype)
 
-    def lnprob_transit(theta):
+    def lnprob_transit(theta,dtype=None):
         lp = lnprior(theta)
         if not np.isfinite(lp):
             return -np.inf
-        return lp + lnlike_transit()
+        return lp + lnlike_transit(dtype=dtype)
 
-    def lnprob_transit_noise(theta):
+    def lnprob_transit_noise(theta,dtype=None):
         lp = lnprior(theta)
         if not np.isfinite(lp):
             return -np.inf
-        return lp + lnlike_transit_noise()
+        return lp + lnlike_transit_noise(dtype=dtype)
 
-    def lnprob_rv(theta):
+    def lnprob_rv(theta,dtype=None):
         lp = lnprior(theta)
         if not np.isfinite(lp):
             return -np.inf
@@ -863,105 +2111,851 @@ def exonailer_mcmc_fit(times, relative_flux, error, tr_instruments, times_rv, rv
     else:
         print 'Mode not supported. Doing nothing.'
 
-    # If already not done, get posterior samples:
-    if len(parameters[all_mcmc_params[0]]['object'].posterior) == 0:
-        # Make a first MCMC run to search for optimal parameter values 
-        # in (almost) all the parameter space defined by the priors if 
-        # no initial guess is given:
-        ndim = n_params
-        pos = []
-        for j in range(200):
-            while True:
-                theta_vector = np.array([])
-                for i in range(n_params):
-                    current_parameter = all_mcmc_params[i]
-                    # If parameter has a guess, sample a value from prior distribution, multiply it by 1e-3 and 
-                    # add it to the real value (this is just to have the walkers move around a sphere around the 
-                    # guess with orders of magnitude defined by the prior). If no initial guess, sample from the 
-                    # prior:
-                    if parameters[current_parameter]['object'].has_guess:
-                        theta_vector = np.append(theta_vector,parameters[current_parameter]['object'].init_value + \
-                                                 (parameters[current_parameter]['object'].init_value-\
-                                                  parameters[current_parameter]['object'].sample())*1e-3)
-                    else:
-                        theta_vector = np.append(theta_vector,parameters[current_parameter]['object'].sample())
-                lnprob(theta_vector)
-                val = lnprob(theta_vector)
-                try:
-                    val = lnprob(theta_vector)
-                except:
-                    val = np.inf
-                if np.isfinite(val):
-                    break
-            pos.append(theta_vector)
+    # If asked, the sampler works on a different parameterization (phi) of the parameters; the 
+    # log-jacobian of the transformation is added so the posterior on the original parameters is the same:
+    lnprob_theta = lnprob
+    lnprior_phi = lnprior
+    if options['MODE'] != 'rvs':
+        reparam = get_reparameterization(all_mcmc_params,parameters,options,times)
+    else:
+        reparam = get_reparameterization(all_mcmc_params,parameters,options,times_rv)
+    if reparam is not None:
+        def lnprob(phi):
+            theta,ln_jacobian = phi_to_theta(phi,reparam)
+            if not np.isfinite(ln_jacobian):
+                return -np.inf
+            return lnprob_theta(theta) + ln_jacobian
 
-        # Run the sampler for a bit (300 walkers, 300 jumps, 300 burnin):
-        print '\t Starting first iteration run...'
-        sampler = emcee.EnsembleSampler(200, ndim, lnprob)
-        sampler.run_mcmc(pos, 200)
-
-        # Now sample the walkers around the values found in previous iteration:
-        pos = []
-        first_time = True
-        init_vals = np.zeros(n_params)
-        init_vals_sigma = np.zeros(n_params)
-        for j in range(options['NWALKERS']):
-            while True:
-                theta_vector = np.array([])
-                for i in range(n_params):
-                    if first_time:
-                        c_p_chain = np.array([])
-                        for walker in range(200):
-                            c_p_chain = np.append(c_p_chain,sampler.chain[walker,100:,i])
-                        init_vals[i] = np.median(c_p_chain)
-                        init_vals_sigma[i] = get_sigma(c_p_chain,np.median(c_p_chain))
-                    current_parameter = all_mcmc_params[i]
-                    # Put the walkers around a small gaussian sphere centered on the best value 
-                    # found in previous iteration. Walkers will run away from sphere eventually:
-                    theta_vector = np.append(theta_vector,np.random.normal(init_vals[i],\
-                                                                           init_vals_sigma[i]*1e-3))
-                if first_time:
-                    first_time = False
-                try:
+        def lnprior_phi(phi):
+            theta,ln_jacobian = phi_to_theta(phi,reparam)
+            if not np.isfinite(ln_jacobian):
+                return -np.inf
+            return lnprior(theta)
+
+    # Posterior workers only serve the evaluations of the posterior (see parallel_utils.WorkerPool):
+    if worker is not None:
+        worker.serve(lnprob)
+        return None
+
+    # On float32 mode, check that the error on the log-likelihood due to the reduced precision of the 
+    # data is small around the initial guesses (or on draws from the priors for parameters without one); 
+    # otherwise, use double precision. As constant offsets of the log-likelihood do not change the fit, 
+    # the error is measured as the spread of the differences between both precisions:
+    if options['MODE'] != 'rvs' and tr_dtype == 'float32':
+        test_points = np.zeros([10,n_params])
+        for i in range(n_params):
+            for j in range(10):
+                if parameters[all_mcmc_params[i]]['object'].has_guess:
+                    test_points[j,i] = parameters[all_mcmc_params[i]]['object'].init_value + \
+                                       (parameters[all_mcmc_params[i]]['object'].init_value-\
+                                        parameters[all_mcmc_params[i]]['object'].sample())*1e-3
+                else:
+                    test_points[j,i] = parameters[all_mcmc_params[i]]['object'].sample()
+        tr_data['float64'] = (np.asarray(times,dtype='float64')-t_ref,relative_flux-1.,error.astype('float64'))
+        lnprob_32 = np.array([lnprob_theta(theta) for theta in test_points])
+        lnprob_64 = np.array([lnprob_theta(theta,'float64') for theta in test_points])
+        finite = np.isfinite(lnprob_32) & np.isfinite(lnprob_64)
+        max_error = np.inf
+        if np.any(finite):
+            max_error = np.max(lnprob_32[finite]-lnprob_64[finite])-np.min(lnprob_32[finite]-lnprob_64[finite])
+        if max_error > options['PRECISION_TOL'] or np.any(np.isfinite(lnprob_32) != np.isfinite(lnprob_64)):
+            print '\t Warning: the log-likelihood error of the float32 mode is {0:.2e} (more than {1:.2e}). Using float64.'.format(\
+                  max_error,options['PRECISION_TOL'])
+            tr_data[None] = tr_data['float64']
+            xt,dyt,yerrt = tr_data[None]
+        else:
+            print '\t Using float32 data (log-likelihood error on the test points: {0:.2e}).'.format(max_error)
+        del tr_data['float64']
+
+    # On dry runs, estimate the cost of the fit by timing the posterior (and each of its components) on 
+    # points drawn as the ones used to initialize the walkers. The plots evaluate the models on the 
+    # data and on a grid four times denser than the data, and render the phased light curves. For the 
+    # instruments with the GPMatern32 noise model, its cost and its log-likelihood are compared with 
+    # the ones of the george GPExpSquaredKernel model it approximates, on the residuals of the data 
+    # from the model of the last drawn point:
+    if estimate:
+        def draw_point():
+            theta_vector = np.zeros(n_params)
+            for i in range(n_params):
+                if parameters[all_mcmc_params[i]]['object'].has_guess:
+                    theta_vector[i] = parameters[all_mcmc_params[i]]['object'].init_value + \
+                                      (parameters[all_mcmc_params[i]]['object'].init_value-\
+                                       parameters[all_mcmc_params[i]]['object'].sample())*1e-3
+                else:
+                    theta_vector[i] = parameters[all_mcmc_params[i]]['object'].sample()
+            if reparam is not None:
+                theta_vector = theta_to_phi(theta_vector,reparam)
+            return theta_vector
+        components = [('priors',lambda: lnprior(param_values[:n_params]))]
+        if options['MODE'] == 'transit_noise':
+            components.append(('transit noise ('+options['photometry'][the_instrument]['PHOT_NOISE_MODEL']+')',\
+                               lnlike_transit_noise))
+        elif options['MODE'] != 'rvs' and len(all_tr_instruments) == 1:
+            components.append(('transit '+the_instrument+' ('+options['photometry'][the_instrument]['PHOT_NOISE_MODEL']+')',\
+                               lnlike_transit))
+        elif options['MODE'] != 'rvs':
+            for k in range(len(all_tr_instruments)):
+                components.append(('transit '+all_tr_instruments[k]+' ('+\
+                                   options['photometry'][all_tr_instruments[k]]['PHOT_NOISE_MODEL']+')',\
+                                   lambda k=k: lnlike_transit_instrument(k)))
+        if options['MODE'] != 'transit' and options['MODE'] != 'transit_noise':
+            components.append(('RVs',lnlike_rv))
+        plot_time = 0.
+        if options['MODE'] != 'transit_noise':
+            lnprior_phi(draw_point())
+            start = time.time()
+            for name,function in components[1:]:
+                function()
+            plot_time = 5.*(time.time()-start)
+            if options['MODE'] != 'rvs' and options['PLOT'].lower() == 'batch':
+                start = time.time()
+                plt.figure()
+                for k in range(len(all_tr_instruments)):
+                    t0,P = param_values[tr_slots[all_tr_instruments[k]][:2]]
+                    plot_phased_data(get_phases(xt[all_tr_instruments_idxs[k]],P,t0-t_ref),\
+                                     dyt[all_tr_instruments_idxs[k]],options)
+                plt.savefig(StringIO())
+                plt.close()
+                plot_time = plot_time + (time.time()-start)
+        cost_estimate = get_cost_estimate(lnprob,lnprior_phi,draw_point,components,n_params,options,warm_start,\
+                                          len(marginalized_params),plot_time)
+        if options['MODE'] not in ['rvs','transit_noise']:
+            for k in range(len(all_tr_instruments)):
+                instrument = all_tr_instruments[k]
+                if options['photometry'][instrument]['PHOT_NOISE_MODEL'] != 'GPMatern32':
+                    continue
+                if 'george' not in globals():
+                    print '\t (george is not installed: the GPMatern32 model of '+instrument+' is not benchmarked)'
+                    continue
+                if len(all_tr_instruments) == 1:
+                    lnlike_transit()
+                else:
+                    lnlike_transit_instrument(k)
+                model = get_light_curve(instrument)
+                if options['photometry'][instrument]['RESAMPLING']:
+                    model = transit_flat[instrument]
+                idx = all_tr_instruments_idxs[k]
+                benchmark = get_gp_benchmark(xt[idx].astype('float64'),yerrt[idx].astype('float64')*1e6,\
+                                             (dyt[idx].astype('float64')-(model-1.))*1e6,*param_values[tr_slots[instrument][9:]])
+                if benchmark['speedup'] is None:
+                    print '\t GPMatern32 noise model of '+instrument+': the george GPExpSquaredKernel model could not be '+\
+                          'evaluated on {0:} points'.format(benchmark['npoints'])
+                else:
+                    print '\t GPMatern32 noise model of '+instrument+': {0:.2e} s per evaluation ({1:.1f} times faster '.format(\
+                          benchmark['celerite_time'],benchmark['speedup'])+\
+                          'than george), log-likelihood difference with GPExpSquaredKernel: {0:.2f}'.format(benchmark['delta_lnlike'])
+                cost_estimate.setdefault('gp_benchmark',{})[instrument] = benchmark
+        return cost_estimate
+
+    # If already not done, get posterior samples. For quick-look (MAP) fits, find the maximum 
+    # a-posteriori parameters and draw samples from the Laplace approximation around them:
+    diagnostics = None
+    fit_start = time.time()
+    if len(parameters[all_mcmc_params[0]]['object'].posterior) == 0 and options['FIT_METHOD'].lower() == 'map':
+        # Start from the initial guesses (when given) and from random draws from the priors:
+        starting_points = []
+        for j in range(100):
+            theta_vector = np.zeros(n_params)
+            for i in range(n_params):
+                current_parameter = all_mcmc_params[i]
+                if warm_start is not None and current_parameter in warm_start.keys() and j == 0:
+                    theta_vector[i] = np.median(warm_start[current_parameter])
+                elif parameters[current_parameter]['object'].has_guess and j == 0:
+                    theta_vector[i] = parameters[current_parameter]['object'].init_value
+                else:
+                    theta_vector[i] = parameters[current_parameter]['object'].sample()
+            starting_points.append(theta_vector)
+        if reparam is not None:
+            starting_points = list(theta_to_phi(starting_points,reparam))
+        # Bounds of the parameters, given by the supports of the priors (the reparameterized 
+        # ones, except for the logarithms of Jeffreys parameters, are only limited by the posterior):
+        bounds = []
+        for i in range(n_params):
+            current_parameter = all_mcmc_params[i]
+            if reparam is not None and i in reparam['logjeffreys']:
+                bounds.append(np.log(parameters[current_parameter]['object'].prior_hypp[:2]))
+            elif reparam is not None and i in reparam['indexes']:
+                bounds.append(None)
+            elif parameters[current_parameter]['type'] in ['Uniform','Jeffreys']:
+                bounds.append(parameters[current_parameter]['object'].prior_hypp[:2])
+            elif parameters[current_parameter]['type'] == 'Beta':
+                bounds.append([0.,1.])
+            else:
+                bounds.append(None)
+        theta_map,lnprob_map = get_map_fit(lnprob,starting_points,bounds)
+        print '\t Done! Log-posterior at the MAP: '+str(lnprob_map)+'. Computing hessian...'
+        # Initial steps for the hessian are a small fraction of the width of the priors:
+        scales = np.std(starting_points,axis=0)
+        scales[scales == 0] = 1.
+        hessian,steps = get_hessian(lnprob,theta_map,1e-3*scales)
+        for i in range(n_params):
+            if not hessian[i,i] < 0.:
+                print '\t Warning: the posterior has no curvature on '+all_mcmc_params[i]+' at the MAP (it might be at the edge'+\
+                      ' of its prior). The Laplace approximation might be inaccurate.'
+        laplace_cov = get_laplace_covariance(hessian,steps)
+        samples = get_laplace_samples(lnprior_phi,theta_map,laplace_cov,options['NWALKERS']*options['NJUMPS'])
+        if reparam is not None:
+            samples = phi_to_theta(samples,reparam)[0]
+        # The Laplace samples are independent, so there are no chain diagnostics to compute. The Laplace 
+        # approximation also gives an estimate of the (log-)evidence of the model:
+        diagnostics = {'fit_method':'MAP','nsamples':len(samples),'wall_time':time.time()-fit_start,\
+                       'lnprob_map':float(lnprob_map)}
+        sign,logdet = np.linalg.slogdet(laplace_cov)
+        if sign > 0:
+            diagnostics['ln_evidence_laplace'] = float(lnprob_map + 0.5*n_params*log2pi + 0.5*logdet)
+        print '\t Done! Saving...'
+        for i in range(n_params):
+            parameters[all_mcmc_params[i]]['object'].set_posterior(np.copy(samples[:,i]))
+    elif len(parameters[all_mcmc_params[0]]['object'].posterior) == 0:
+        ndim = n_params
+        # Evaluate the posterior on the posterior workers at WORKER_NODES, which receive the data of the 
+        # fit once, or on NWORKERS local processes, which map it (published once in shared memory) 
+        # instead of receiving a copy of it:
+        # Progress records of the sampling (see run_sampler), saved in the results folder of the fit:
+        progress = None
+        if options['PROGRESS_INTERVAL'] > 0.:
+            out_dir = get_out_dir(options)
+            if not os.path.exists(out_dir):
+                os.mkdir(out_dir)
+            progress = {'file':open(out_dir+'progress.jsonl','w'),'interval':options['PROGRESS_INTERVAL'],\
+                        'start':time.time()}
+        pool = None
+        if options['NWORKERS'] > 1 or options['WORKER_NODES'].lower() != 'none':
+            worker_arrays = {}
+            if options['MODE'] != 'rvs':
+                worker_arrays.update({'times':times,'tr_codes':tr_instruments['codes'],'xt':xt,'dyt':dyt,'yerrt':yerrt})
+                worker_meta['tr_instruments'] = dict((k,v) for k,v in tr_instruments.items() if k != 'codes')
+                worker_meta['resampling_instruments'] = idx_resampling.keys()
+                for instrument in idx_resampling.keys():
+                    if len(idx_resampling[instrument]) > 0:
+                        worker_arrays['idx_resampling_'+instrument] = np.asarray(idx_resampling[instrument])
+                for instrument in t_resampling.keys():
+                    worker_arrays['t_resampling_'+instrument] = t_resampling[instrument]
+            if 'transit' not in options['MODE']:
+                worker_arrays.update({'times_rv':times_rv,'rv_codes':rv_instruments['codes'],'xrv':xrv,'yrv':yrv})
+                if rv_err is not None:
+                    worker_arrays['yerrrv'] = yerrrv
+                worker_meta['rv_instruments'] = dict((k,v) for k,v in rv_instruments.items() if k != 'codes')
+            worker_meta['t_ref'] = t_ref
+            import parallel_utils
+            if options['WORKER_NODES'].lower() != 'none':
+                pool = parallel_utils.SocketPool(worker_arrays,worker_meta,options['WORKER_NODES'].split(','),\
+                                                  timeout=options['WORKER_TIMEOUT'])
+            else:
+                pool = parallel_utils.WorkerPool(worker_arrays,worker_meta,options['NWORKERS'])
+        if warm_start is not None:
+            # Initialize the walkers from the posteriors of the previous fit:
+            pos = get_warm_start_positions(lnprob,warm_start,all_mcmc_params,parameters,options['NWALKERS'],reparam)
+        else:
+            # Make a first MCMC run to search for optimal parameter values 
+            # in (almost) all the parameter space defined by the priors if 
+            # no initial guess is given (if WARMUP_NJUMPS is not positive, 
+            # the walkers of the final run start right away from these points):
+            nwarmup = options['WARMUP_NWALKERS']
+            if options['WARMUP_NJUMPS'] <= 0:
+                nwarmup = options['NWALKERS']
+            pos = []
+            for j in range(nwarmup):
+                while True:
+                    theta_vector = np.array([])
+                    for i in range(n_params):
+                        current_parameter = all_mcmc_params[i]
+                        # If parameter has a guess, sample a value from prior distribution, multiply it by 1e-3 and 
+                        # add it to the real value (this is just to have the walkers move around a sphere around the 
+                        # guess with orders of magnitude defined by the prior). If no initial guess, sample from the 
+                        # prior:
+                        if parameters[current_parameter]['object'].has_guess:
+                            theta_vector = np.append(theta_vector,parameters[current_parameter]['object'].init_value + \
+                                                     (parameters[current_parameter]['object'].init_value-\
+                                                      parameters[current_parameter]['object'].sample())*1e-3)
+                        else:
+                            theta_vector = np.append(theta_vector,parameters[current_parameter]['object'].sample())
+                    if reparam is not None:
+                        theta_vector = theta_to_phi(theta_vector,reparam)
+                    lnprob(theta_vector)
                     val = lnprob(theta_vector)
-                except:
-                    val = np.inf
-                if np.isfinite(val):
-                    break
-            pos.append(theta_vector)
+                    try:
+                        val = lnprob(theta_vector)
+                    except:
+                        val = np.inf
+                    if np.isfinite(val):
+                        break
+                pos.append(theta_vector)
+
+            if options['WARMUP_NJUMPS'] > 0:
+                # Run the sampler for a bit (WARMUP_NWALKERS walkers, WARMUP_NJUMPS jumps):
+                print '\t Starting first iteration run...'
+                sampler = emcee.EnsembleSampler(nwarmup, ndim, lnprob, pool=pool)
+                run_sampler(sampler, pos, options['WARMUP_NJUMPS'], progress, 'warm-up')
+
+                # Now sample the walkers around the values found in previous iteration:
+                pos = []
+                first_time = True
+                init_vals = np.zeros(n_params)
+                init_vals_sigma = np.zeros(n_params)
+                for j in range(options['NWALKERS']):
+                    while True:
+                        theta_vector = np.array([])
+                        for i in range(n_params):
+                            if first_time:
+                                c_p_chain = np.array([])
+                                for walker in range(nwarmup):
+                                    c_p_chain = np.append(c_p_chain,sampler.chain[walker,options['WARMUP_NJUMPS']/2:,i])
+                                init_vals[i] = np.median(c_p_chain)
+                                init_vals_sigma[i] = get_sigma(c_p_chain,np.median(c_p_chain))
+                            current_parameter = all_mcmc_params[i]
+                            # Put the walkers around a small gaussian sphere centered on the best value 
+                            # found in previous iteration. Walkers will run away from sphere eventually:
+                            theta_vector = np.append(theta_vector,np.random.normal(init_vals[i],\
+                                                                                   init_vals_sigma[i]*1e-3))
+                        if first_time:
+                            first_time = False
+                        try:
+                            val = lnprob(theta_vector)
+                        except:
+                            val = np.inf
+                        if np.isfinite(val):
+                            break
+                    pos.append(theta_vector)
 
         # Run the (final) MCMC:
-        print '\t Done! Starting MCMC...'
-        sampler = emcee.EnsembleSampler(options['NWALKERS'], ndim, lnprob)
-
-        sampler.run_mcmc(pos, options['NJUMPS']+options['NBURNIN'])
-
-        print '\t Done! Saving...'
+        sampler = emcee.EnsembleSampler(options['NWALKERS'], ndim, lnprob, pool=pool)
+        if warm_start is not None:
+            # Adaptive burn-in: run it in chunks of NBURNIN/10 steps (or 10, whichever is larger), 
+            # stopping as soon as the split-R-hat of the last half of the burn-in is small enough (if 
+            # NBURNIN is not positive, the final run starts right away from the previous posteriors):
+            nburnin = 0
+            if options['NBURNIN'] > 0:
+                print '\t Starting adaptive burn-in...'
+                nchunk = np.max([options['NBURNIN']/10,10])
+                while nburnin < options['NBURNIN']:
+                    pos = run_sampler(sampler, pos, nchunk, progress, 'burn-in', options['NBURNIN'])[0]
+                    nburnin = nburnin + nchunk
+                    max_rhat = np.nanmax([get_split_rhat(sampler.chain[:,nburnin/2:,i]) for i in range(n_params)])
+                    if max_rhat < options['WARM_START_RHAT']:
+                        break
+                print '\t Done! Burn-in stopped after '+str(nburnin)+' steps (maximum split R-hat: {0:.3f}). Starting MCMC...'.format(max_rhat)
+                sampler.reset()
+            else:
+                print '\t Done! Starting MCMC (without burn-in)...'
+            run_sampler(sampler, pos, options['NJUMPS'], progress, 'final')
+            nburnin = 0
+        else:
+            print '\t Done! Starting MCMC...'
+            run_sampler(sampler, pos, options['NJUMPS']+options['NBURNIN'], progress, 'final')
+            nburnin = options['NBURNIN']
+
+        # Parameter chains, mapped back to the original parameterization if the sampler used a different one:
+        chain = sampler.chain[:,nburnin:,:]
+        if reparam is not None:
+            chain = phi_to_theta(chain,reparam)[0]
+        diagnostics = get_chain_diagnostics(chain,all_mcmc_params,sampler.acceptance_fraction,time.time()-fit_start)
+        if pool is not None:
+            pool.close()
+            diagnostics['workers'] = pool.stats
+        if progress is not None:
+            progress['file'].close()
+        print '\t Done! Minimum effective sample size: {0:.1f}, maximum split R-hat: {1:.3f}. Saving...'.format(\
+              diagnostics['min_ess'],diagnostics['max_split_rhat'])
         # Save the parameter chains for the parameters that were actually varied:
+        chain = chain.reshape(-1,n_params)
         for i in range(n_params):
             c_param = all_mcmc_params[i]
-            c_p_chain = np.array([])
-            for walker in range(options['NWALKERS']):
-                c_p_chain = np.append(c_p_chain,sampler.chain[walker,options['NBURNIN']:,i])
-            parameters[c_param]['object'].set_posterior(np.copy(c_p_chain))
+            parameters[c_param]['object'].set_posterior(np.copy(chain[:,i]))
+
+    # Sample the analytically marginalized linear parameters from their conditional posteriors, 
+    # evaluated at each posterior sample of the rest of the parameters:
+    if len(marginalized_params) > 0 and len(parameters[marginalized_params[0]]['object'].posterior) == 0:
+        print '\t Sampling the marginalized parameters from their conditional posteriors...'
+        values = np.zeros(n_params)
+        for i in range(n_params):
+            values[i] = parameters[all_mcmc_params[i]]['object'].value
+        posterior_samples = np.array([parameters[all_mcmc_params[i]]['object'].posterior for i in range(n_params)])
+        linear_samples = {}
+        for par in marginalized_params:
+            linear_samples[par] = np.zeros(posterior_samples.shape[1])
+        for j in range(posterior_samples.shape[1]):
+            lnprob_theta(posterior_samples[:,j])
+            for par in marginalized_params:
+                linear_samples[par][j] = sample_linear_parameter(linear_conditionals[par])
+        for par in marginalized_params:
+            parameters[par]['object'].set_posterior(linear_samples[par])
+        for i in range(n_params):
+            parameters[all_mcmc_params[i]]['object'].set_value(values[i])
+
+    # Statistics to compare this fit with the fits of other models (the analytically marginalized 
+    # parameters are counted in the BIC, although their likelihood is the marginalized one):
+    if diagnostics is not None:
+        values = np.array([parameters[all_mcmc_params[i]]['object'].value for i in range(n_params)])
+        posterior_samples = np.array([parameters[all_mcmc_params[i]]['object'].posterior for i in range(n_params)]).T
+        n_data = 0
+        if options['MODE'] != 'rvs':
+            n_data = n_data + len(times)
+        if options['MODE'] != 'transit' and options['MODE'] != 'transit_noise':
+            n_data = n_data + len(times_rv)
+        diagnostics.update(get_model_comparison(lambda theta: lnprob_theta(theta)-lnprior(theta),posterior_samples,\
+                                                n_params+len(marginalized_params),n_data))
+        for i in range(n_params):
+            parameters[all_mcmc_params[i]]['object'].set_value(values[i])
 
     # When done or if MCMC already performed, save results:
     initial_values = {}
     for i in range(len(all_mcmc_params)):
         initial_values[all_mcmc_params[i]] = parameters[all_mcmc_params[i]]['object'].value
+    return diagnostics
 
 import matplotlib.pyplot as plt
+from general_utils import get_out_dir
+def run_grid_fit(args):
+    """
+    This function runs one of the fits of a grid of models (see run_model_grid). It attaches to the data 
+    published at path, sets the noise model and the limb-darkening law of all the transit instruments 
+    (None keeps the ones of the options) and runs the fit, whose results are saved as in a normal run; 
+    if these results already exist, the fit is not run again. It returns the row of the comparison table 
+    of the model, with the error message if the fit failed. The input is a tuple (path,noise_model,ld_law) 
+    in order to be used in a multiprocessing pool.
+    """
+    path,noise_model,ld_law = args
+    import parallel_utils
+    from general_utils import save_results
+    arrays,meta = parallel_utils.attach_context(path)
+    options = meta['options']
+    if options['MODE'] != 'rvs':
+        for instrument in options['photometry'].keys():
+            if noise_model is not None:
+                options['photometry'][instrument]['PHOT_NOISE_MODEL'] = noise_model
+            if ld_law is not None:
+                options['photometry'][instrument]['LD_LAW'] = ld_law
+    # The fits of the grid already run in parallel, so the posterior of each one is evaluated serially:
+    options['NWORKERS'] = 1
+    options['WORKER_NODES'] = 'NONE'
+    out_dir = get_out_dir(options)
+    row = {'noise_model':noise_model,'ld_law':ld_law,'out_dir':out_dir,'error':None}
+    start = time.time()
+    try:
+        if os.path.exists(out_dir+'posteriors.pkl'):
+            diagnostics = {}
+            if os.path.exists(out_dir+'diagnostics.json'):
+                f = open(out_dir+'diagnostics.json')
+                diagnostics = json.load(f)
+                f.close()
+            row['wall_time'] = diagnostics.get('run_wall_time',diagnostics.get('wall_time'))
+        else:
+            tr_instruments,rv_instruments = meta['tr_instruments'],meta['rv_instruments']
+            if tr_instruments is not None:
+                tr_instruments['codes'] = arrays['tr_codes']
+            if rv_instruments is not None:
+                rv_instruments['codes'] = arrays['rv_codes']
+            if meta['resampling_instruments'] is None:
+                idx_resampling = []
+            else:
+                idx_resampling = {}
+                for instrument in meta['resampling_instruments']:
+                    idx_resampling[instrument] = arrays.get('idx_resampling_'+instrument,[])
+            diagnostics = exonailer_mcmc_fit(arrays.get('times'),arrays.get('relative_flux'),arrays.get('error'),\
+                                             tr_instruments,arrays.get('times_rv'),arrays.get('rv'),arrays.get('rv_err'),\
+                                             rv_instruments,meta['parameters'],idx_resampling,options)
+            # (the wall time of the whole fit, set-up included, is saved for the comparison tables):
+            diagnostics['run_wall_time'] = time.time()-start
+            save_results(options['TARGET'],options,meta['parameters'],diagnostics)
+            row['wall_time'] = diagnostics['run_wall_time']
+    except (Exception,SystemExit) as error:
+        row['error'] = str(error) or error.__class__.__name__
+        row['wall_time'] = time.time()-start
+        diagnostics = {}
+    for name in ['fit_method','n_params','n_data','max_lnlike','bic','ln_evidence_laplace']:
+        row[name] = diagnostics.get(name)
+    return row
+
+def run_model_grid(times, relative_flux, error, tr_instruments, times_rv, rv, rv_err, rv_instruments,\
+                   parameters, idx_resampling, options, noise_models=None, ld_laws=None):
+    """
+    This function fits every combination of the noise models in noise_models and the limb-darkening 
+    laws in ld_laws (which are applied to all the transit instruments; if None, the ones in the options 
+    are used) to the (already pre-processed) data. The data is published once in shared memory (see 
+    parallel_utils.SharedContext), and the fits, which map it instead of receiving a copy of it, are run 
+    in parallel on NCPUS processes (see run_grid_fit; these are always new processes, so a fit which 
+    is killed is not taken as a failed model). It returns the rows of the comparison table, with 
+    the maximum log-likelihood, the BIC, the Laplace estimate of the log-evidence (for MAP fits) and the 
+    wall time of each fit.
+    """
+    for noise_model in (noise_models if noise_models is not None else []):
+        if noise_model not in ['white']+noise_model_params.keys():
+            print 'Error: noise model '+noise_model+' not supported. Exiting...'
+            sys.exit()
+    for ld_law in (ld_laws if ld_laws is not None else []):
+        if ld_law not in ['linear','quadratic','squareroot','logarithmic']:
+            print 'Error: limb-darkening law '+ld_law+' not supported. Exiting...'
+            sys.exit()
+    import parallel_utils
+    arrays = {}
+    meta = {'parameters':parameters,'options':options,'tr_instruments':None,'rv_instruments':None,\
+            'resampling_instruments':None}
+    if options['MODE'] != 'rvs':
+        arrays.update({'times':times,'relative_flux':relative_flux,'error':error,'tr_codes':tr_instruments['codes']})
+        meta['tr_instruments'] = dict((k,v) for k,v in tr_instruments.items() if k != 'codes')
+        meta['resampling_instruments'] = idx_resampling.keys()
+        for instrument in idx_resampling.keys():
+            if len(idx_resampling[instrument]) > 0:
+                arrays['idx_resampling_'+instrument] = np.asarray(idx_resampling[instrument])
+    if options['MODE'] != 'transit' and options['MODE'] != 'transit_noise':
+        arrays.update({'times_rv':times_rv,'rv':rv,'rv_codes':rv_instruments['codes']})
+        if rv_err is not None:
+            arrays['rv_err'] = rv_err
+        meta['rv_instruments'] = dict((k,v) for k,v in rv_instruments.items() if k != 'codes')
+    context = parallel_utils.SharedContext(arrays,meta)
+    grid = []
+    for noise_model in (noise_models if noise_models is not None else [None]):
+        for ld_law in (ld_laws if ld_laws is not None else [None]):
+            grid.append((context.path,noise_model,ld_law))
+    nprocesses = np.min([options['NCPUS'],len(grid)])
+    print '\t Fitting '+str(len(grid))+' models on '+str(nprocesses)+' processes...'
+    # Each fit runs on a new process (so the memory of the previous fits is released), on which 
+    # termination signals stop the fit instead of being taken as a failure of the model:
+    import multiprocessing,signal
+    pool = multiprocessing.Pool(nprocesses,initializer=signal.signal,initargs=(signal.SIGTERM,signal.SIG_DFL),\
+                                maxtasksperchild=1)
+    results = pool.imap(run_grid_fit,grid,chunksize=1)
+    rows = []
+    try:
+        for i in range(len(grid)):
+            # (waiting with a timeout, as otherwise signals are not handled until a fit finishes):
+            while True:
+                try:
+                    rows.append(results.next(1.))
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+    except (KeyboardInterrupt,SystemExit):
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    context.close()
+    return rows
+
+# Transit parameters that are injected (and recovered) in the injection-recovery tests:
+injected_params = ['P','t0','p','a','inc']
+
+def get_injection_trials(t,tr_instruments,parameters,periods,radii,ntrials=1,seed=0,bmax=0.8):
+    """
+    This function returns the transits to inject in an injection-recovery test: ntrials for each 
+    combination of the periods (in days) and planet-to-star radius ratios in periods and radii. The 
+    semi-major axis of each one is scaled with Kepler's third law from the one of the target (the 
+    initial values of a and P in the priors), and the time of transit (within the first period of the 
+    data) and the impact parameter (between 0 and bmax) are drawn at random. The random draws of each 
+    trial only depend on its name and on seed, so the same trials are obtained each time.
+    """
+    import zlib
+    P0,inc0,a0 = read_transit_params(parameters,tr_instruments['names'][0])[:3]
+    trials = []
+    for P in periods:
+        for p in radii:
+            for j in range(ntrials):
+                name = 'P{0:g}_p{1:g}_{2:03d}'.format(P,p,j)
+                state = np.random.RandomState(((zlib.crc32(name) & 0xffffffff) + seed) % 2**32)
+                a = a0*(P/P0)**(2./3.)
+                b = state.uniform(0.,bmax)
+                t0 = np.min(t) + state.uniform(0.,1.)*P
+                trials.append({'trial':name,'P':P,'t0':t0,'p':p,'a':a,'inc':np.arccos(b/a)*180./np.pi,'b':b})
+    return trials
+
+def write_injection_priors(template,fname,trial):
+    """
+    This function writes the priors of the fit of an injection-recovery trial to fname. These are the 
+    ones of the template priors file, except for the ones on the transit parameters (including the ones 
+    defined per instrument), which are centered on the injected values: the period is constrained to 
+    0.1% and the time of transit to a quarter of the transit duration, while the radius ratio, the 
+    semi-major axis and the inclination are free within wide ranges. The eccentricity and the argument 
+    of periastron are fixed to the ones of the injected (circular) orbit.
+    """
+    P,t0,p,a,inc = [trial[name] for name in injected_params]
+    duration = get_transit_duration(P,a,p,inc)
+    if duration == 0.:
+        duration = 0.1*P
+    p_max = np.min([3.*p,1.])
+    a_min = np.max([a/3.,1.])
+    inc_min = np.arccos(np.min([(1.+p_max)/a_min,1.]))*180./np.pi
+    priors = {'P':('Normal','{0:.10f},{1:.10f}'.format(P,1e-3*P),P),\
+              't0':('Normal','{0:.10f},{1:.10f}'.format(t0,0.25*duration),t0),\
+              'p':('Uniform','0,{0:.10f}'.format(p_max),p),\
+              'a':('Uniform','{0:.10f},{1:.10f}'.format(a_min,3.*a),a),\
+              'inc':('Uniform','{0:.10f},90'.format(inc_min),inc),\
+              'ecc':('FIXED','0',None),'omega':('FIXED','90',None)}
+    fin = open(template,'r')
+    fout = open(fname,'w')
+    for line in fin:
+        values = line.split()
+        if len(values) > 0 and line[0] != '#' and values[0].split('_')[0] in priors.keys():
+            prior_type,hyperparameters,value = priors[values[0].split('_')[0]]
+            line = '{0:34} {1:13} {2:}'.format(values[0],prior_type,hyperparameters)
+            if value is not None:
+                line = line + ' {0:.10f}'.format(value)
+            line = line + '\n'
+        fout.write(line)
+    fin.close()
+    fout.close()
+
+def run_injection_trial(args):
+    """
+    This function runs one of the trials of an injection-recovery test (see run_injection_recovery). It 
+    attaches to the (raw) transit data published at path, injects the transit of the trial on it (with 
+    the limb-darkening coefficients of the priors and, on resampled instruments, integrated over the 
+    exposure time as in the fit), and pre-processes and fits the result as in a normal run. It returns 
+    the row of the table of the test (with the error message if the fit failed), which is also saved 
+    to the trial_dir folder to be reused by later runs. The input is a tuple (path,trial,trial_dir) in 
+    order to be used in a multiprocessing pool.
+    """
+    path,trial,trial_dir = args
+    import parallel_utils
+    from general_utils import read_priors
+    arrays,meta = parallel_utils.attach_context(path)
+    options = meta['options']
+    tr_instruments = meta['tr_instruments']
+    tr_instruments['codes'] = arrays['tr_codes']
+    row = {'trial':trial['trial'],'error':None,'n_transits':0,'max_lnlike':None}
+    for name in injected_params+['b']:
+        row[name+'_inj'] = trial[name]
+    start = time.time()
+    try:
+        fname = trial_dir+trial['trial']+'_priors.dat'
+        write_injection_priors(meta['priors_file'],fname,trial)
+        parameters = read_priors(None,None,filename=fname)
+        # Inject the transit (the published data is read-only, so it is injected on a copy):
+        t = arrays['times']
+        f = np.array(arrays['relative_flux'],dtype='float64')
+        epochs = []
+        for instrument in tr_instruments['names']:
+            idx = tr_instruments['slices'][instrument]
+            q1,q2 = read_transit_params(parameters,instrument)[5:]
+            transit_params = [trial['t0'],trial['P'],trial['p'],trial['a'],trial['inc'],q1,q2,\
+                              options['photometry'][instrument]['LD_LAW']]
+            if options['photometry'][instrument]['RESAMPLING']:
+                # (same sampling of the exposures as in the fit, eq. (35) in Kipping 2010):
+                n = options['photometry'][instrument]['NRESAMPLING']
+                offsets = (np.arange(1,n+1)-((n+1)/2.))*(options['photometry'][instrument]['TEXP']/np.double(n))
+                model = get_transit_model((t[idx][:,None]+offsets).ravel(),*transit_params).reshape(-1,n).mean(axis=1)
+            else:
+                model = get_transit_model(np.array(t[idx],dtype='float64'),*transit_params)
+            f[idx] = f[idx]*model
+            epochs = np.append(epochs,np.round((t[idx][model<1.]-trial['t0'])/trial['P']))
+        row['n_transits'] = len(np.unique(epochs))
+        t,phases,f,f_err,tr_registry,summaries = pre_process(t,f,arrays.get('error'),options,tr_instruments,parameters)
+        idx_resampling = {}
+        for instrument in tr_registry['names']:
+            idx = tr_registry['slices'][instrument]
+            if options['photometry'][instrument]['RESAMPLING']:
+                idx_resampling[instrument] = np.where((phases[idx]>-options['photometry'][instrument]['PHASE_MAX_RESAMPLING'])&\
+                                             (phases[idx]<options['photometry'][instrument]['PHASE_MAX_RESAMPLING']))[0]
+            else:
+                idx_resampling[instrument] = []
+        diagnostics = exonailer_mcmc_fit(t,f,f_err,tr_registry,None,None,None,None,parameters,idx_resampling,options)
+        for name in meta['recovered']:
+            param = parameters[name]['object']
+            row[name] = param.value
+            row[name+'_up'] = param.value_u-param.value
+            row[name+'_low'] = param.value-param.value_l
+        row['max_lnlike'] = diagnostics.get('max_lnlike')
+    except (Exception,SystemExit) as error:
+        row['error'] = str(error) or error.__class__.__name__
+    row['wall_time'] = time.time()-start
+    # Save the trial (renaming the file into place, so an interrupted run does not leave a partial one):
+    fname = trial_dir+trial['trial']+'.json'
+    f = open(fname+'.tmp','w')
+    json.dump({'trial':trial,'row':row},f,indent=2,sort_keys=True)
+    f.close()
+    os.rename(fname+'.tmp',fname)
+    return row
+
+def run_injection_recovery(times, relative_flux, error, tr_instruments, parameters, options, periods, radii,\
+                           ntrials=1, seed=0, bmax=0.8):
+    """
+    This function runs an injection-recovery test on the (raw, not pre-processed) transit data of the 
+    target: each of the transits of get_injection_trials is injected in the data, which is then 
+    pre-processed and fitted as in a normal transit fit (short fits are recommended, i.e., FIT_METHOD: 
+    MAP or a small NJUMPS). The data is published once in shared memory, and the trials are run in 
+    parallel on NCPUS processes (see run_injection_trial). The injected and recovered parameters of each 
+    trial are appended to a table as soon as it finishes, and each trial is saved, so an interrupted 
+    test is resumed where it stopped. Trials whose fit failed (e.g., because the injected transit falls 
+    in a gap of the data) are kept in the table with a failed status. It returns the table name.
+    """
+    import copy,parallel_utils
+    if options['MODE'] not in ['transit','full']:
+        print 'Error: injection-recovery tests need the transit data (MODE: transit or full). Exiting...'
+        sys.exit()
+    # The trials are fitted as transits, and run in parallel, so each fit runs serially:
+    options = copy.deepcopy(options)
+    options['MODE'] = 'transit'
+    nprocesses = options['NCPUS']
+    options['NCPUS'] = 1
+    options['NWORKERS'] = 1
+    options['WORKER_NODES'] = 'NONE'
+    options['PROGRESS_INTERVAL'] = 0.
+    # The priors of the trials are centered on the injected transits, so the warm-up run of each 
+    # trial is as short as its burn-in:
+    options['WARMUP_NWALKERS'] = options['NWALKERS']
+    options['WARMUP_NJUMPS'] = options['NBURNIN']
+    out_dir = get_out_dir(options)[:-1]+'_injection/'
+    trial_dir = out_dir+'trials/'
+    if not os.path.exists(trial_dir):
+        os.makedirs(trial_dir)
+    # The recovered parameters are the transit parameters of the priors (in their order):
+    template = 'priors_data/'+options['TARGET']+'_priors.dat'
+    recovered = []
+    f = open(template,'r')
+    for line in f:
+        values = line.split()
+        if len(values) > 0 and line[0] != '#' and values[0].split('_')[0] in injected_params:
+            recovered.append(values[0])
+    f.close()
+    columns = ['trial']+[name+'_inj' for name in injected_params+['b']]+['n_transits']
+    for name in recovered:
+        columns = columns + [name,name+'_up',name+'_low']
+    columns = columns + ['max_lnlike','wall_time','status']
+    def write_row(fout,row):
+        values = []
+        for name in columns:
+            if name == 'status':
+                values.append('ok' if row['error'] is None else 'failed')
+            elif name in ['trial','n_transits']:
+                values.append(str(row[name]))
+            elif row.get(name) is None:
+                values.append('nan')
+            else:
+                values.append('{0:.10f}'.format(row[name]))
+        fout.write(' '.join(values)+'\n')
+        fout.flush()
+
+    # Reuse the trials saved by previous runs (if they match the current ones):
+    trials = get_injection_trials(times,tr_instruments,parameters,periods,radii,ntrials,seed,bmax)
+    done,pending = [],[]
+    for trial in trials:
+        fname = trial_dir+trial['trial']+'.json'
+        if os.path.exists(fname):
+            f = open(fname,'r')
+            cached = json.load(f)
+            f.close()
+            if np.all([name in cached['row'] for name in recovered]) and \
+               np.allclose([cached['trial'][name] for name in injected_params+['b']],\
+                           [trial[name] for name in injected_params+['b']],rtol=1e-12,atol=0.):
+                done.append(cached['row'])
+                continue
+        pending.append(trial)
+    fname = out_dir+'injection_recovery.dat'
+    fout = open(fname,'w')
+    fout.write('# '+' '.join(columns)+'\n')
+    for row in done:
+        write_row(fout,row)
+    print '\t Injection-recovery test: '+str(len(trials))+' trials ('+str(len(done))+' already done).'
+    if len(pending) > 0:
+        arrays = {'times':times,'relative_flux':relative_flux,'error':error,'tr_codes':tr_instruments['codes']}
+        meta = {'options':options,'tr_instruments':dict((k,v) for k,v in tr_instruments.items() if k not in ['codes','order']),\
+                'priors_file':template,'recovered':recovered}
+        context = parallel_utils.SharedContext(arrays,meta)
+        args = [(context.path,trial,trial_dir) for trial in pending]
+        nprocesses = np.min([nprocesses,len(pending)])
+        print '\t Running '+str(len(pending))+' trials on '+str(nprocesses)+' processes...'
+        # Each trial runs on a new process (so the memory of the previous trials is released), on which 
+        # termination signals stop the fit instead of being taken as a failure of the trial:
+        import multiprocessing,signal
+        pool = multiprocessing.Pool(nprocesses,initializer=signal.signal,initargs=(signal.SIGTERM,signal.SIG_DFL),\
+                                    maxtasksperchild=1)
+        results = pool.imap_unordered(run_injection_trial,args,chunksize=1)
+        try:
+            for i in range(len(pending)):
+                # (waiting with a timeout, as otherwise signals are not handled until a trial finishes):
+                while True:
+                    try:
+                        row = results.next(1.)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+                write_row(fout,row)
+                status = 'done' if row['error'] is None else 'failed ('+row['error']+')'
+                print '\t Trial '+row['trial']+' '+status+' in {0:.1f} s ({1:}/{2:}).'.format(row['wall_time'],i+1,len(pending))
+        except (KeyboardInterrupt,SystemExit):
+            # Stop the running trials (they are run again when the test is resumed):
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        context.close()
+    fout.close()
+    print '\t Injection-recovery table saved to '+fname
+    return fname
+
+def bin_phased_data(phase, y, nbins):
+    """
+    This function bins the (phase, y) pairs in nbins equally-spaced bins in
+    phase (from -0.5 to 0.5). It returns the centers of the non-empty bins, the
+    mean of y on each of them and the error on that mean. The cost is O(N).
+    """
+    edges = np.linspace(-0.5,0.5,nbins+1)
+    idx = np.floor((phase+0.5)*nbins).astype(int)
+    idx = np.clip(idx,0,nbins-1)
+    counts = np.bincount(idx,minlength=nbins)
+    sums = np.bincount(idx,weights=y,minlength=nbins)
+    sums2 = np.bincount(idx,weights=y**2,minlength=nbins)
+    good = np.where(counts>0)[0]
+    n = counts[good].astype('float64')
+    means = sums[good]/n
+    variances = np.maximum(sums2[good]/n - means**2,0.)
+    errors = np.sqrt(variances/n)
+    centers = (edges[good]+edges[good+1])/2.
+    return centers, means, errors
+
+def plot_phased_data(phase, y, options):
+    """
+    This function plots phased data. If PLOT is set to 'batch', the raw data
+    is either shown as a density (hexbin) map (if PLOT_DENSITY is YES) or as
+    a rasterized scatter of at most PLOT_MAXPOINTS points, and the data binned
+    in PLOT_NBINS phase bins is overlaid on top. This makes the rendering time
+    independent of the number of datapoints. Otherwise, all points are plotted.
+    """
+    if options['PLOT'].lower() != 'batch':
+        plt.plot(phase,y,'.',color='black',alpha=0.4)
+        return
+    if options['PLOT_DENSITY'].lower() == 'yes':
+        plt.hexbin(phase,y,gridsize=200,bins='log',cmap='Greys',mincnt=1,rasterized=True)
+    else:
+        if len(phase) > options['PLOT_MAXPOINTS']:
+            idx = np.linspace(0,len(phase)-1,options['PLOT_MAXPOINTS']).astype(int)
+        else:
+            idx = np.arange(len(phase))
+        plt.plot(phase[idx],y[idx],'.',color='black',alpha=0.2,rasterized=True)
+    centers,means,errors = bin_phased_data(phase,y,options['PLOT_NBINS'])
+    plt.errorbar(centers,means,yerr=errors,fmt='o',color='dodgerblue',markersize=3,zorder=3)
+
+def save_gp_products(fname,fname_model,t,phase,mu,var,detrended,errors,model_t,model_phase,mu_model,var_model):
+    """
+    This function saves the GP-predicted systematics of an instrument (see get_gp_products): fname 
+    has the times, phases, conditional mean and standard-deviation of the GP (in relative flux), and 
+    the detrended fluxes and their errors of the data; fname_model has the times, phases, and the 
+    conditional mean and standard-deviation of the GP on the model times. The standard-deviations 
+    are not saved if the variances were not computed.
+    """
+    for name,columns in [(fname,[t,phase,mu*1e-6]+([np.sqrt(np.maximum(var,0.))*1e-6] if var is not None else [])+[detrended,errors]),\
+                         (fname_model,[model_t,model_phase,mu_model*1e-6]+([np.sqrt(np.maximum(var_model,0.))*1e-6] if var_model is not None else []))]:
+        fout = open(name,'w')
+        for row in zip(*columns):
+            fout.write(' '.join(['{0:.10f}'.format(value) for value in row])+'\n')
+        fout.close()
+
+def get_plot_model_times(t, P, t0, npoints, options):
+    """
+    This function returns the times at which the model will be evaluated for the
+    plots. By default, these are npoints times between the first and last datapoint.
+    If PLOT is set to 'batch', PLOT_MAXPOINTS times covering one period around t0
+    are returned instead, which is enough to draw the phased model.
+    """
+    if options['PLOT'].lower() == 'batch':
+        return t0 + np.linspace(-0.5,0.5,options['PLOT_MAXPOINTS'])*P
+    return np.linspace(np.min(t),np.max(t),npoints)
+
 def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, rv, rv_err, rv_instruments,\
                        parameters, idx_resampling, options, texp = 0.020434):
     # Generate out_dir folder name (for saving residuals, models, etc.):
-    mode = options['MODE']
-    target = options['TARGET']
-    fname = target+'_'+mode+'_'
-    if mode != 'rvs':
-        for instrument in options['photometry'].keys():
-            fname = fname + instrument +'_'+options['photometry'][instrument]['PHOT_NOISE_MODEL']+\
-                          '_'+options['photometry'][instrument]['LD_LAW']+'_'
-    out_dir = 'results/'+fname[:-1]+'/'
+    out_dir = get_out_dir(options)
 
     plt.title('exonailer final fit + data')
     # If mode is not RV:
@@ -978,6 +2972,11 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
         yerrt = error.astype('float64')
         for k in range(len(all_tr_instruments)):
             instrument = all_tr_instruments[k]
+            # If the flux normalization was marginalized, normalize the fluxes with its median:
+            if options['photometry'][instrument]['MARGINALIZE_FNORM']:
+                fnorm = parameters[get_fnorm_name(parameters,instrument)]['object'].value
+                yt[all_tr_instruments_idxs[k]] = yt[all_tr_instruments_idxs[k]]/fnorm
+                yerrt[all_tr_instruments_idxs[k]] = yerrt[all_tr_instruments_idxs[k]]/fnorm
             params[instrument],m[instrument] = init_batman(xt[all_tr_instruments_idxs[k]],\
                                                law=options['photometry'][instrument]['LD_LAW'])
             # Initialize the parameters of the transit model, 
@@ -1086,7 +3085,7 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                             transit_params.pop(transit_params.index(noise_param+'_'+instrument))
                         elif parameters[noise_param+'_'+instrument]['type'] in prior_distributions:
                             parameters_to_check.append(noise_param+'_'+instrument)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
+                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] in ['GPExpSquaredKernel','GPMatern32']:
                     for noise_param in ['lnh','lnlambda']:
                         transit_params.append(noise_param+'_'+instrument)
                         if parameters[noise_param+'_'+instrument]['type'] == 'FIXED':
@@ -1118,7 +3117,7 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                     transit_params.pop(transit_params.index('sigma_r'))
                 elif parameters['sigma_r']['type'] in prior_distributions:
                     parameters_to_check.append('sigma_r')
-            elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
+            elif options['photometry'][options['photometry'].keys()[0]]['PHOT_NOISE_MODEL'] in ['GPExpSquaredKernel','GPMatern32']:
                 transit_params.pop(transit_params.index('sigma_r'))
                 for noise_param in ['lnh','lnlambda']:
                     transit_params.append(noise_param)
@@ -1221,7 +3220,7 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
             params[the_instrument].w = parameters['omega']['object'].value
             params[the_instrument].u = [coeff1,coeff2]
             model = m[the_instrument].light_curve(params[the_instrument])
-            model_t = np.linspace(np.min(xt),np.max(xt),len(xt)*100)#4)
+            model_t = get_plot_model_times(xt,params[the_instrument].per,params[the_instrument].t0,len(xt)*100,options)
             model_phase = get_phases(model_t,params[the_instrument].per,params[the_instrument].t0)
             phase = get_phases(xt,params[the_instrument].per,params[the_instrument].t0)
             if options['photometry'][the_instrument]['RESAMPLING']:
@@ -1252,12 +3251,28 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                residuals = (yt-model)
                params2,m2 = init_batman(model_t, law=options['photometry'][the_instrument]['LD_LAW'])
                model = m2.light_curve(params[the_instrument])
+            # For the gaussian-process noise models, the GP of the (posterior median) parameters is factorized 
+            # once and used both for the log-likelihood and for the GP-predicted systematics on the data and on 
+            # the model times. The data and residuals are plotted (and saved) detrended from these:
+            yt_detrended,residuals_detrended = yt,residuals
+            if options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] in gp_noise_models:
+                gp_noise = [parameters[name]['object'].value for name in ['sigma_w']+\
+                            noise_model_params[options['photometry'][the_instrument]['PHOT_NOISE_MODEL']]]
+                gp_log_like,gp_mu,gp_var,gp_mu_model,gp_var_model = get_gp_products(\
+                            options['photometry'][the_instrument]['PHOT_NOISE_MODEL'],xt,residuals*1e6,yerrt*1e6,gp_noise,\
+                            get_noise_segments(xt,options,the_instrument),model_t,\
+                            options['photometry'][the_instrument].get('NASTEROSEISMOLOGY',1),\
+                            options['PLOT_GP_VARIANCE'].lower() == 'yes')
+                if gp_mu is not None:
+                    yt_detrended,residuals_detrended = yt-gp_mu*1e-6,residuals-gp_mu*1e-6
+                    save_gp_products(out_dir+'tr_gp.dat',out_dir+'tr_gp_model.dat',xt,phase,gp_mu,gp_var,\
+                                     yt_detrended,yerrt,model_t,model_phase,gp_mu_model,gp_var_model)
             idx_phase = np.argsort(phase)
             idx_model_phase = np.argsort(model_phase)
-            plt.plot(phase[idx_phase],yt[idx_phase],'.',color='black',alpha=0.4)
+            plot_phased_data(phase[idx_phase],yt_detrended[idx_phase],options)
             plt.plot(model_phase[idx_model_phase],model[idx_model_phase],'r-')
-            sigma = get_sigma(residuals[idx_phase],0.0)
-            plt.plot(phase[idx_phase],residuals[idx_phase]+(1-1.8*(parameters['p']['object'].value**2))-10*sigma,'.',color='black',alpha=0.4)
+            sigma = get_sigma(residuals_detrended[idx_phase],0.0)
+            plot_phased_data(phase[idx_phase],residuals_detrended[idx_phase]+(1-1.8*(parameters['p']['object'].value**2))-10*sigma,options)
             plt.title(the_instrument)
             plt.ylabel('Relative flux')
             plt.xlabel('Phase')
@@ -1279,28 +3294,8 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
             if options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'flicker':
                log_like = exonailer_mcmc_fit.get_fn_likelihood(residuals*1e6,parameters['sigma_w']['object'].value,\
                                parameters['sigma_r']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
-               log_like = exonailer_mcmc_fit.get_sq_exp_likelihood(xt,residuals*1e6,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnh']['object'].value,\
-                              parameters['lnlambda']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPGranulation':
-               log_like = exonailer_mcmc_fit.get_granulation_likelihood(xt,residuals*1e6,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnomega']['object'].value,\
-                              parameters['lnS']['object'].value)
-            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] == 'GPAsteroseismology':
-               log_like = exonailer_mcmc_fit.get_asteroseismology_likelihood(xt,residuals*1e6,yerrt*1e6,\
-                              parameters['sigma_w']['object'].value,\
-                              parameters['lnomega']['object'].value,\
-                              parameters['lnS']['object'].value,\
-                              parameters['lnQ']['object'].value,\
-                              parameters['lnA']['object'].value,\
-                              parameters['epsilon']['object'].value,\
-                              parameters['lnW']['object'].value,\
-                              parameters['lnnu']['object'].value,\
-                              parameters['lnDeltanu']['object'].value,\
-                              the_instrument)
+            elif options['photometry'][the_instrument]['PHOT_NOISE_MODEL'] in gp_noise_models:
+               log_like = gp_log_like
             else:
                taus = 1.0/((yerrt*1e6)**2 + (parameters['sigma_w']['object'].value)**2)
                log_like = -0.5*(n_data_trs[0]*log2pi+np.sum(np.log(1./taus)+taus*((residuals*1e6)**2)))
@@ -1326,7 +3321,8 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                 params[instrument].w = parameters['omega']['object'].value
                 params[instrument].u = [coeff1,coeff2]
                 model = m[instrument].light_curve(params[instrument])
-                model_t = np.linspace(np.min(xt[all_tr_instruments_idxs[k]]),np.max(xt[all_tr_instruments_idxs[k]]),len(all_tr_instruments_idxs[k])*4)
+                model_t = get_plot_model_times(xt[all_tr_instruments_idxs[k]],params[instrument].per,params[instrument].t0,\
+                                               n_data_trs[k]*4,options)
                 model_phase = get_phases(model_t,params[instrument].per,params[instrument].t0)
                 phase = get_phases(xt[all_tr_instruments_idxs[k]],params[instrument].per,params[instrument].t0)
                 if options['photometry'][instrument]['RESAMPLING']:
@@ -1356,12 +3352,29 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                    residuals = (yt[all_tr_instruments_idxs[k]]-model)*1e6    
                    params2,m2 = init_batman(model_t, law=options['photometry'][instrument]['LD_LAW'])
                    model = m2.light_curve(params[instrument])
+                # GP-predicted systematics (see above), with the (posterior median) GP factorized once:
+                yt_detrended,residuals_detrended = yt[all_tr_instruments_idxs[k]],residuals
+                if options['photometry'][instrument]['PHOT_NOISE_MODEL'] in gp_noise_models:
+                    gp_noise = [parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value]+\
+                               [parameters[name+'_'+instrument]['object'].value for name in \
+                                noise_model_params[options['photometry'][instrument]['PHOT_NOISE_MODEL']]]
+                    gp_log_like,gp_mu,gp_var,gp_mu_model,gp_var_model = get_gp_products(\
+                                options['photometry'][instrument]['PHOT_NOISE_MODEL'],xt[all_tr_instruments_idxs[k]],\
+                                residuals,yerrt[all_tr_instruments_idxs[k]]*1e6,gp_noise,\
+                                get_noise_segments(xt[all_tr_instruments_idxs[k]],options,instrument),model_t,\
+                                options['photometry'][instrument].get('NASTEROSEISMOLOGY',1),\
+                                options['PLOT_GP_VARIANCE'].lower() == 'yes')
+                    if gp_mu is not None:
+                        yt_detrended,residuals_detrended = yt[all_tr_instruments_idxs[k]]-gp_mu*1e-6,residuals-gp_mu
+                        save_gp_products(out_dir+'tr_gp_'+instrument+'.dat',out_dir+'tr_gp_model_'+instrument+'.dat',\
+                                         xt[all_tr_instruments_idxs[k]],phase,gp_mu,gp_var,yt_detrended,\
+                                         yerrt[all_tr_instruments_idxs[k]],model_t,model_phase,gp_mu_model,gp_var_model)
                 idx_phase = np.argsort(phase)
                 idx_model_phase = np.argsort(model_phase)
-                plt.plot(phase[idx_phase],yt[all_tr_instruments_idxs[k]][idx_phase],'.',color='black',alpha=0.4)
+                plot_phased_data(phase[idx_phase],yt_detrended[idx_phase],options)
                 plt.plot(model_phase[idx_model_phase],model[idx_model_phase],'r-')
-                sigma = get_sigma(residuals[idx_phase]*1e-6,0.0)
-                plt.plot(phase[idx_phase],residuals[idx_phase]*1e-6+(1-1.8*(parameters['p'+sufix[instrument]['p']]['object'].value**2))-3*sigma,'.',color='black',alpha=0.4)
+                sigma = get_sigma(residuals_detrended[idx_phase]*1e-6,0.0)
+                plot_phased_data(phase[idx_phase],residuals_detrended[idx_phase]*1e-6+(1-1.8*(parameters['p'+sufix[instrument]['p']]['object'].value**2))-3*sigma,options)
                 plt.title(instrument)
                 # Save phased model, data and residuals for the transit:
                 fout_model = open(out_dir+'tr_model_'+instrument+'.dat','w')
@@ -1380,28 +3393,8 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                 if options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'flicker':
                    log_like = log_like + get_fn_likelihood(residuals*1e6,parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
                                    parameters['sigma_r'+sufix[instrument]['sigma_r']]['object'].value)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPExpSquaredKernel':
-                   log_like = log_like + get_sq_exp_likelihood(xt[all_tr_instruments_idxs[k]],residuals*1e6,yerrt[all_tr_instruments_idxs[k]]*1e6,\
-                              parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                              parameters['lnh'+sufix[instrument]['lnh']]['object'].value,\
-                              parameters['lnlambda'+sufix[instrument]['lnlambda']]['object'].value)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPGranulation':
-                   log_like = log_like + get_granulation_likelihood(xt[all_tr_instruments_idxs[k]],residuals*1e6,yerrt[all_tr_instruments_idxs[k]]*1e6,\
-                              parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                              parameters['lnomega'+sufix[instrument]['lnomega']]['object'].value,\
-                              parameters['lnS'+sufix[instrument]['lnS']]['object'].value)
-                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] == 'GPAsteroseismology':
-                   log_like = log_like + get_asteroseismology_likelihood(xt[all_tr_instruments_idxs[k]],residuals*1e6,yerrt[all_tr_instruments_idxs[k]]*1e6,\
-                              parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value,\
-                              parameters['lnomega'+sufix[instrument]['lnomega']]['object'].value,\
-                              parameters['lnS'+sufix[instrument]['lnS']]['object'].value,\
-                              parameters['lnQ'+sufix[instrument]['lnQ']]['object'].value,\
-                              parameters['lnA'+sufix[instrument]['lnA']]['object'].value,\
-                              parameters['epsilon'+sufix[instrument]['epsilon']]['object'].value,\
-                              parameters['lnW'+sufix[instrument]['lnW']]['object'].value,\
-                              parameters['lnnu'+sufix[instrument]['lnnu']]['object'].value,\
-                              parameters['lnDeltanu'+sufix[instrument]['lnDeltanu']]['object'].value,\
-                              instrument)
+                elif options['photometry'][instrument]['PHOT_NOISE_MODEL'] in gp_noise_models:
+                   log_like = log_like + gp_log_like
                 else:
                    taus = 1.0/((yerrt[all_tr_instruments_idxs[k]]*1e6)**2 + (parameters['sigma_w'+sufix[instrument]['sigma_w']]['object'].value)**2)
                    log_like = log_like - 0.5*(n_data_trs[k]*log2pi+np.sum(np.log(1./taus)+taus*((residuals*1e6)**2)))
@@ -1545,9 +3538,12 @@ def plot_transit_and_rv(times, relative_flux, error, tr_instruments, times_rv, r
                 plt.errorbar(all_phases[i],all_residuals[i],yerr=rv_err[all_rv_instruments_idxs[i]],fmt='o')
             plt.ylabel('RV Residuals')
             plt.xlabel('Phase')
-    if options['PLOT'].lower() != 'no' and options['PLOT'].lower() != 'false' and options['PLOT'].lower() != 'save':
+    if options['PLOT'].lower() not in ['no','false','save','batch']:
         plt.show()
     elif options['PLOT'].lower() == 'save':
         plt.savefig(out_dir+'fig.png',dpi=300)
+    elif options['PLOT'].lower() == 'batch':
+        plt.savefig(out_dir+'fig.png',dpi=150)
+        plt.close('all')
     else:
         plt.clf()
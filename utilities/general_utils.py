@@ -49,6 +49,50 @@ def get_instruments(instrument_list):
             all_instruments.append(instrument)
     return all_instruments
 
+def get_instrument_registry(instruments,times=None,names=None):
+    """
+    This function builds the instrument registry of a dataset, which is shared by all the stages of 
+    the pipeline. The instrument of each point can be given either as names or as integer codes (in 
+    which case the names of the codes must be given in names). Instruments are numbered in order of 
+    appearance, and the data is meant to be ordered by a single stable sort on the codes (and on the 
+    times within each instrument, if given), so the data of each instrument is a contiguous slice. 
+    It returns a dictionary with the instrument names ('names'), the codes of the sorted data ('codes'), 
+    the indexes that sort the data ('order', None if the data is already sorted), and the slice 
+    ('slices') and number of points ('counts') of each instrument.
+    """
+    if names is None:
+        names,first,codes = np.unique(instruments,return_index=True,return_inverse=True)
+        appearance = np.argsort(first)
+        names = names[appearance]
+        codes = np.argsort(appearance)[codes]
+    else:
+        codes = np.asarray(instruments)
+        # Drop instruments without data:
+        present = np.bincount(codes,minlength=len(names))>0
+        if not np.all(present):
+            codes = (np.cumsum(present)-1)[codes]
+            names = np.asarray(names)[present]
+    # Check if the data is already sorted before doing the sort:
+    code_steps = np.diff(codes)
+    if times is None:
+        is_sorted = np.all(code_steps>=0)
+    else:
+        is_sorted = np.all((code_steps>0)|((code_steps==0)&(np.diff(times)>=0)))
+    order = None
+    if not is_sorted:
+        if times is None:
+            order = np.argsort(codes,kind='mergesort')
+        else:
+            order = np.lexsort((times,codes))
+        codes = codes[order]
+    counts = np.bincount(codes,minlength=len(names))
+    edges = np.append(0,np.cumsum(counts))
+    registry = {'names':[str(name) for name in names],'codes':codes.astype('int16'),'order':order,'slices':{},'counts':{}}
+    for i in range(len(names)):
+        registry['slices'][registry['names'][i]] = slice(edges[i],edges[i+1])
+        registry['counts'][registry['names'][i]] = counts[i]
+    return registry
+
 from astropy.time import Time as APYTime
 def convert_time(conv_string,t):
     input_t,output_t = conv_string.split('->')
@@ -64,7 +108,9 @@ def read_data(options):
     mode = options['MODE']
     t_tr,f,f_err,transit_instruments = None,None,None,None
     t_rv,rv,rv_err,rv_instruments = None,None,None,None
-    if mode != 'rvs':
+    if mode != 'rvs' and options['MEMMAP'].lower() == 'yes':
+        t_tr,f,f_err,transit_instruments = read_memmap_lc(options)
+    elif mode != 'rvs':
         # Read in transit data:
         transit_data = np.genfromtxt('transit_data/'+target+'_lc.dat',dtype='|S100')
         # Get times and fluxes:
@@ -81,10 +127,16 @@ def read_data(options):
         else:
             f_err = np.zeros(len(t_tr))
             transit_instruments = np.array(len(t_tr)*['instrument'])
+        # Sort the data by instrument (and in time within each instrument):
+        transit_instruments = get_instrument_registry(transit_instruments,times=t_tr)
+        idx = transit_instruments['order']
+        if idx is not None:
+            t_tr,f,f_err = t_tr[idx],f[idx],f_err[idx]
         # Convert transit times (if input and output are the same, does nothing):
         for instrument in options['photometry'].keys():
-            idx = np.where(instrument == transit_instruments)[0]
-            t_tr[idx] = convert_time(options['photometry'][instrument]['TRANSIT_TIME_DEF'],t_tr[idx])
+            if instrument in transit_instruments['slices']:
+                idx = transit_instruments['slices'][instrument]
+                t_tr[idx] = convert_time(options['photometry'][instrument]['TRANSIT_TIME_DEF'],t_tr[idx])
     if 'transit' not in mode:
         # Read in RV data:
         rv_data = np.genfromtxt('rv_data/'+target+'_rvs.dat',dtype='|S100')
@@ -102,29 +154,157 @@ def read_data(options):
             rv_instruments = np.array(len(t_rv)*['instrument'])
         else:
             rv_instruments = np.array(len(t_rv)*['instrument'])
-        # Convert RV times:
+        # Sort the data by instrument:
+        rv_instruments = get_instrument_registry(rv_instruments)
+        idx = rv_instruments['order']
+        if idx is not None:
+            t_rv,rv = t_rv[idx],rv[idx]
+            if rv_err is not None:
+                rv_err = rv_err[idx]
         # Convert RV times (if input and output are the same, does nothing):
         for instrument in options['rvs'].keys():
-            idx = np.where(instrument == rv_instruments)[0]
-            t_rv[idx] = convert_time(options['rvs'][instrument]['RV_TIME_DEF'],t_rv[idx])
+            if instrument in rv_instruments['slices']:
+                idx = rv_instruments['slices'][instrument]
+                t_rv[idx] = convert_time(options['rvs'][instrument]['RV_TIME_DEF'],t_rv[idx])
         #t_rv = convert_time(rv_time_def,t_rv)
     return t_tr,f,f_err,transit_instruments,t_rv,rv,rv_err,rv_instruments
 
-import pickle,os
-def save_results(target,options,parameters):
-    mode = options['MODE']
-    target = options['TARGET']
-    fname = target+'_'+mode+'_'
-    if mode != 'rvs':
+import pickle,os,json
+def read_memmap_lc(options):
+    """
+    This function returns the transit data of the target as read-only, memory-mapped arrays. The 
+    first time (or if the light curve file or the time definitions of the instruments change), the 
+    light curve file is read, its times are converted, it is sorted by instrument and time and it is 
+    saved as binary files (times, fluxes, errors and the integer code of the instrument of each point) 
+    in the transit_data/TARGET_lc_memmap folder. The instruments are returned as the instrument 
+    registry of the data (see get_instrument_registry).
+    """
+    lc_file = 'transit_data/'+options['TARGET']+'_lc.dat'
+    out_dir = 'transit_data/'+options['TARGET']+'_lc_memmap/'
+    time_defs = {}
+    for instrument in options['photometry'].keys():
+        time_defs[instrument] = options['photometry'][instrument]['TRANSIT_TIME_DEF']
+    up_to_date = os.path.exists(out_dir+'instruments.json') and \
+                 os.path.getmtime(out_dir+'instruments.json') > os.path.getmtime(lc_file)
+    if up_to_date:
+        f = open(out_dir+'instruments.json','r')
+        info = json.load(f)
+        up_to_date = info['time_defs'] == time_defs and info.get('sorted_by') == 'instrument'
+        f.close()
+    if not up_to_date:
+        print '\t Saving the light curve of '+options['TARGET']+' as memory-mapped arrays...'
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
+        options['MEMMAP'] = 'NO'
+        t,f,f_err,registry = read_data(options)[:4]
+        options['MEMMAP'] = 'YES'
+        for name,array in [('t',t),('f',f),('f_err',f_err),('instruments',registry['codes'])]:
+            np.save(out_dir+name+'.npy',array)
+        f = open(out_dir+'instruments.json','w')
+        json.dump({'instruments':registry['names'],'time_defs':time_defs,'sorted_by':'instrument'},f)
+        f.close()
+    f = open(out_dir+'instruments.json','r')
+    instrument_names = json.load(f)['instruments']
+    f.close()
+    t,f,f_err,codes = [np.load(out_dir+name+'.npy',mmap_mode='r') for name in ['t','f','f_err','instruments']]
+    return t,f,f_err,get_instrument_registry(codes,times=t,names=instrument_names)
+
+def get_out_dir(options):
+    """
+    This function returns the folder in which the results of a given fit (defined 
+    by the target, the mode, the noise models and limb-darkening laws of each instrument 
+    and the fitting method) are saved.
+    """
+    fname = options['TARGET']+'_'+options['MODE']+'_'
+    if options['MODE'] != 'rvs':
         for instrument in options['photometry'].keys():
             fname = fname + instrument +'_'+options['photometry'][instrument]['PHOT_NOISE_MODEL']+\
                           '_'+options['photometry'][instrument]['LD_LAW']+'_'
-    out_dir = 'results/'+fname[:-1]+'/'
-    os.mkdir(out_dir)
+    if options['FIT_METHOD'].lower() == 'map':
+        fname = fname + 'MAP_'
+    return 'results/'+fname[:-1]+'/'
+
+def save_results(target,options,parameters,diagnostics=None):
+    target = options['TARGET']
+    out_dir = get_out_dir(options)
+    # The folder already exists on warm-started refits:
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
     # Copy used prior file to the results folder:
     os.system('cp priors_data/'+target+'_priors.dat '+out_dir+'priors.dat')
+    if options['FIT_METHOD'].lower() == 'map':
+        write_posteriors(out_dir,parameters,'the MAP fit (Laplace approximation)')
+    else:
+        write_posteriors(out_dir,parameters,'the MCMC chains')
+    # Save the convergence and efficiency diagnostics of the fit:
+    if diagnostics is not None:
+        f = open(out_dir+'diagnostics.json','w')
+        json.dump(diagnostics,f,indent=2,sort_keys=True)
+        f.close()
+
+def save_oot_summaries(out_dir,summaries):
+    """
+    This function saves the summaries of the out-of-transit data of each instrument (see 
+    data_utils.get_oot_summary) to the out_dir folder, as oot_summary_instrument.dat files.
+    """
+    for instrument in summaries.keys():
+        f = open(out_dir+'oot_summary_'+instrument+'.dat','w')
+        f.write('# time  median_flux  sigma  npoints\n')
+        for row in summaries[instrument]:
+            f.write('{0:.10f} {1:.10f} {2:.10f} {3:d}\n'.format(row['time'],row['flux'],row['sigma'],row['npoints']))
+        f.close()
+
+def save_cost_estimate(options,estimate):
+    """
+    This function saves the cost estimate of a fit (see data_utils.get_cost_estimate) to a json 
+    file next to the folder in which the results of the fit would be saved (which is not created).
+    """
+    fname = get_out_dir(options)[:-1]+'_estimate.json'
+    f = open(fname,'w')
+    json.dump(estimate,f,indent=2,sort_keys=True)
+    f.close()
+    print '\t Estimate saved to '+fname
+
+def save_model_grid(options,rows):
+    """
+    This function saves the comparison table of a grid of fits (see data_utils.run_model_grid) to the 
+    results folder, with the models sorted by their BIC (the difference with the lowest one is given 
+    too), and prints it. Missing values (e.g., the evidence of MCMC fits, or the statistics of fits 
+    that failed) are written as nan.
+    """
+    fname = 'results/'+options['TARGET']+'_'+options['MODE']+'_grid.dat'
+    def value(row,name):
+        if row[name] is None:
+            return np.nan
+        return row[name]
+    rows = sorted(rows,key=lambda row: value(row,'bic') if np.isfinite(value(row,'bic')) else np.inf)
+    min_bic = np.nanmin([value(row,'bic') for row in rows]+[np.inf])
+    f = open(fname,'w')
+    f.write('# noise_model  ld_law  fit_method  n_params  n_data  max_lnlike  BIC  delta_BIC  ln_evidence  wall_time  results\n')
+    print '\t {0:20} {1:12} {2:>14} {3:>14} {4:>10} {5:>14} {6:>10}'.format('Noise model','LD law','max lnlike',\
+                                                                        'BIC','delta BIC','ln evidence','time (s)')
+    for row in rows:
+        noise_model = row['noise_model'] if row['noise_model'] is not None else 'options'
+        ld_law = row['ld_law'] if row['ld_law'] is not None else 'options'
+        f.write('{0:} {1:} {2:} {3:} {4:} {5:.6f} {6:.6f} {7:.6f} {8:.6f} {9:.1f} {10:}\n'.format(noise_model,ld_law,\
+                row['fit_method'],row['n_params'],row['n_data'],value(row,'max_lnlike'),value(row,'bic'),\
+                value(row,'bic')-min_bic,value(row,'ln_evidence_laplace'),value(row,'wall_time'),row['out_dir']))
+        print '\t {0:20} {1:12} {2:14.2f} {3:14.2f} {4:10.2f} {5:14.2f} {6:10.1f}'.format(noise_model,ld_law,\
+                value(row,'max_lnlike'),value(row,'bic'),value(row,'bic')-min_bic,value(row,'ln_evidence_laplace'),\
+                value(row,'wall_time'))
+        if row['error'] is not None:
+            print '\t   (the fit failed: '+row['error']+')'
+    f.close()
+    print '\t Comparison table saved to '+fname
+
+def write_posteriors(out_dir,parameters,description):
+    """
+    This function writes the posterior_parameters.dat file (with the median and credibility 
+    bands of each parameter) and the posteriors.pkl file (with the posterior samples) to the 
+    out_dir folder. The description of the origin of the samples goes in the header.
+    """
     out_posterior_file = open(out_dir+'posterior_parameters.dat','w')
-    out_posterior_file.write('# This file has the final parameters obtained from the MCMC chains.\n')
+    out_posterior_file.write('# This file has the final parameters obtained from '+description+'.\n')
     out_posterior_file.write('# parameter value   median value  upper c-band  lower c-band\n')
 
     # Generate an output dictionary with the posteriors:
@@ -143,32 +323,56 @@ def save_results(target,options,parameters):
 
         out_posterior_file.write('{0:18}  {1:10.10f}  {2:10.10f}  {3:10.10f}\n'.format(\
                                    parameter, param, up_error, low_error))
+    out_posterior_file.close()
     # Save posterior dict:
     f = open(out_dir+'posteriors.pkl','w')
     pickle.dump(out_dict,f)
     f.close()
 
 def read_results(target,options,all_transit_instruments,all_rv_instruments):
-    mode = options['MODE']
     target = options['TARGET']
-    fname = target+'_'+mode+'_'
-    if mode != 'rvs':
-        for instrument in options['photometry'].keys():
-            fname = fname + instrument +'_'+options['photometry'][instrument]['PHOT_NOISE_MODEL']+\
-                          '_'+options['photometry'][instrument]['LD_LAW']+'_'
-    out_dir = 'results/'+fname[:-1]+'/'
+    out_dir = get_out_dir(options)
     parameters = read_priors(options['TARGET'],options['MODE'])#target,all_transit_instruments,all_rv_instruments,mode,filename = out_dir+'priors.dat')
-    thefile = open(out_dir+'posteriors.pkl','r')
-    posteriors = pickle.load(thefile)
+    posteriors = read_posteriors(out_dir)
     for parameter in parameters.keys():
         if parameters[parameter]['type'] != 'FIXED':
             try:
                 parameters[parameter]['object'].set_posterior(posteriors[parameter])  
             except:
                 print 'No posterior for parameter '+parameter
-    thefile.close()
     return parameters
 
+def get_ln_prior_samples(parameter,samples):
+    """
+    This function returns the log-prior of a parameter (as given by read_priors) evaluated 
+    on an array of samples, which is -np.inf for samples outside the support of the prior.
+    """
+    samples = np.array(samples).astype('float64')
+    if parameter['type'] == 'FIXED':
+        return np.where(samples == parameter['object'].value,0.,-np.inf)
+    if parameter['type'] in ['Uniform','Jeffreys']:
+        in_support = (samples > parameter['object'].prior_hypp[0]) & (samples < parameter['object'].prior_hypp[1])
+    elif parameter['type'] == 'Beta':
+        in_support = (samples > 0.) & (samples < 1.)
+    else:
+        in_support = np.ones(len(samples),dtype=bool)
+    value = parameter['object'].value
+    parameter['object'].set_value(np.where(in_support,samples,value))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        ln_prior = np.where(in_support,parameter['object'].get_ln_prior(),-np.inf)
+    parameter['object'].set_value(value)
+    return ln_prior
+
+def read_posteriors(out_dir):
+    """
+    This function returns the dictionary with the posterior samples of each parameter saved 
+    by save_results in the out_dir folder.
+    """
+    thefile = open(out_dir+'posteriors.pkl','r')
+    posteriors = pickle.load(thefile)
+    thefile.close()
+    return posteriors
+
 def get_quantiles(dist,alpha = 0.68, method = 'median'):
     """
     get_quantiles function
@@ -420,10 +624,14 @@ def read_input_parameters():
                 line = fin.readline()
             if general_opts:
                 if '---' not in line:
-                    var,opt = line.split(':')
+                    # (values can contain colons, e.g., the host:port addresses of WORKER_NODES):
+                    var,opt = line.split(':',1)
                     opt_dict[var.split()[0]] = (opt.split()[0]).split('\n')[0]
-                    if var.split()[0] in ['NWALKERS','NJUMPS','NBURNIN']:
+                    if var.split()[0] in ['NWALKERS','NJUMPS','NBURNIN','PLOT_NBINS','PLOT_MAXPOINTS','NCPUS','NWORKERS',\
+                                          'WARMUP_NWALKERS','WARMUP_NJUMPS']:
                         opt_dict[var.split()[0]] = int(opt_dict[var.split()[0]])
+                    elif var.split()[0] in ['WARM_START_RHAT','PRECISION_TOL','PROGRESS_INTERVAL','WORKER_TIMEOUT']:
+                        opt_dict[var.split()[0]] = np.double(opt_dict[var.split()[0]])
             if phot_opts:
                 if 'INSTRUMENT:' in line:
                     c_instrument = line.split('INSTRUMENT:')[-1].split()[0]
@@ -431,9 +639,10 @@ def read_input_parameters():
                 elif '---' not in line:
                     var,opt = line.split(':')
                     opt_dict['photometry'][c_instrument][var.split()[0]] = opt.split()[0]
-                    if var.split()[0] in ['WINDOW','NRESAMPLING','NASTEROSEISMOLOGY']:
+                    if var.split()[0] in ['WINDOW','NRESAMPLING','NASTEROSEISMOLOGY','PHOT_OUTLIERS_MAXITER']:
                         opt_dict['photometry'][c_instrument][var.split()[0]] = int(opt.split()[0])
-                    elif var.split()[0] in ['PHASE_MAX_RESAMPLING','TEXP']:
+                    elif var.split()[0] in ['PHASE_MAX_RESAMPLING','TEXP','PHOT_OUTLIERS_NSIGMA','WINDOW_TIME','SEGMENT_GAP',\
+                                            'PHOT_TRANSIT_WINDOW']:
                         opt_dict['photometry'][c_instrument][var.split()[0]] = np.double(opt.split()[0])
                     elif var.split()[0] in ['NOMIT']:
                             nomits = opt.split()[0].split(',')
@@ -465,8 +674,69 @@ def read_input_parameters():
                         opt_dict['rvs'][c_instrument][var.split()[0]] = None
                 
     fin.close()
+    # Set default values of optional general options:
+    if 'PLOT_NBINS' not in opt_dict.keys():
+        opt_dict['PLOT_NBINS'] = 500
+    if 'PLOT_MAXPOINTS' not in opt_dict.keys():
+        opt_dict['PLOT_MAXPOINTS'] = 10000
+    if 'PLOT_DENSITY' not in opt_dict.keys():
+        opt_dict['PLOT_DENSITY'] = 'NO'
+    if 'PLOT_GP_VARIANCE' not in opt_dict.keys():
+        opt_dict['PLOT_GP_VARIANCE'] = 'YES'
+    if 'NCPUS' not in opt_dict.keys():
+        opt_dict['NCPUS'] = 1
+    if 'PARALLEL_INSTRUMENTS' not in opt_dict.keys():
+        opt_dict['PARALLEL_INSTRUMENTS'] = 'NO'
+    if 'WARMUP_NWALKERS' not in opt_dict.keys():
+        opt_dict['WARMUP_NWALKERS'] = 200
+    if 'WARMUP_NJUMPS' not in opt_dict.keys():
+        opt_dict['WARMUP_NJUMPS'] = 200
+    if 'NWORKERS' not in opt_dict.keys():
+        opt_dict['NWORKERS'] = 1
+    if 'WORKER_NODES' not in opt_dict.keys():
+        opt_dict['WORKER_NODES'] = 'NONE'
+    if 'WORKER_TIMEOUT' not in opt_dict.keys():
+        opt_dict['WORKER_TIMEOUT'] = 600.
+    if 'PROGRESS_INTERVAL' not in opt_dict.keys():
+        opt_dict['PROGRESS_INTERVAL'] = 30.
+    if 'FIT_METHOD' not in opt_dict.keys():
+        opt_dict['FIT_METHOD'] = 'MCMC'
+    if 'MARGINALIZE_RV_OFFSETS' not in opt_dict.keys():
+        opt_dict['MARGINALIZE_RV_OFFSETS'] = 'NO'
+    if 'REPARAMETERIZE' not in opt_dict.keys():
+        opt_dict['REPARAMETERIZE'] = 'NONE'
+    if 'WARM_START' not in opt_dict.keys():
+        opt_dict['WARM_START'] = 'NO'
+    if 'WARM_START_RHAT' not in opt_dict.keys():
+        opt_dict['WARM_START_RHAT'] = 1.05
+    if 'PRECISION' not in opt_dict.keys():
+        opt_dict['PRECISION'] = 'float64'
+    if 'PRECISION_TOL' not in opt_dict.keys():
+        opt_dict['PRECISION_TOL'] = 0.01
+    if 'MEMMAP' not in opt_dict.keys():
+        opt_dict['MEMMAP'] = 'NO'
     if opt_dict['MODE'] != 'rvs':
         for instrument in opt_dict['photometry'].keys():
            if 'NOMIT' not in opt_dict['photometry'][instrument].keys():
                 opt_dict['photometry'][instrument]['NOMIT'] = np.array([])
+           if 'PHOT_OUTLIERS_NSIGMA' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['PHOT_OUTLIERS_NSIGMA'] = 3.
+           if 'PHOT_OUTLIERS_MAXITER' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['PHOT_OUTLIERS_MAXITER'] = 1
+           if 'WINDOW_TIME' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['WINDOW_TIME'] = 1.
+           if 'SEGMENT_GAP' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['SEGMENT_GAP'] = None
+           if 'NOISE_SEGMENTS' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['NOISE_SEGMENTS'] = False
+           if 'DETREND_MASK_TRANSIT' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['DETREND_MASK_TRANSIT'] = False
+           if 'PHOT_TRANSIT_WINDOW' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['PHOT_TRANSIT_WINDOW'] = None
+           if 'PHOT_OOT_SUMMARY' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['PHOT_OOT_SUMMARY'] = False
+           if 'FAST_TRANSIT' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['FAST_TRANSIT'] = False
+           if 'MARGINALIZE_FNORM' not in opt_dict['photometry'][instrument].keys():
+                opt_dict['photometry'][instrument]['MARGINALIZE_FNORM'] = False
     return opt_dict            
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import glob
+import errno
+import select
+import socket
+import shutil
+import atexit
+import signal
+import tempfile
+import traceback
+import subprocess
+import cPickle as pickle
+import numpy as np
+from multiprocessing.connection import Listener,Client,AuthenticationError
+
+def get_shared_dir():
+    """
+    This function returns the folder in which the shared fit contexts are published: /dev/shm (a
+    memory-backed filesystem) if available, or the temporary folder of the system otherwise.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def pid_exists(pid):
+    try:
+        os.kill(pid,0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def clean_stale_contexts():
+    """
+    This function removes the fit contexts published by processes that are not running anymore
+    (e.g., because they were killed before they could remove them).
+    """
+    for path in glob.glob(os.path.join(get_shared_dir(),'exonailer_ctx_*')):
+        try:
+            pid = int(os.path.basename(path).split('_')[2])
+        except:
+            continue
+        if not pid_exists(pid):
+            shutil.rmtree(path,ignore_errors=True)
+
+def get_rss(pid):
+    """
+    This function returns the resident memory (in MB) of a process, read from /proc, as a dictionary
+    with the total, the private (anonymous) and the shared (file-backed and shared memory) parts.
+    Returns None if this information is not available.
+    """
+    values = {}
+    try:
+        f = open('/proc/'+str(pid)+'/status','r')
+        for line in f.readlines():
+            if line.split(':')[0] in ['VmRSS','RssAnon','RssFile','RssShmem']:
+                values[line.split(':')[0]] = float(line.split()[1])/1024.
+        f.close()
+    except:
+        return None
+    if 'VmRSS' not in values.keys() or 'RssAnon' not in values.keys():
+        return None
+    return {'total':values['VmRSS'],'private':values['RssAnon'],\
+            'shared':values.get('RssFile',0.)+values.get('RssShmem',0.)}
+
+def get_pickle_time(arrays,max_size=1000000):
+    """
+    This function estimates the time it would take to send a dictionary of arrays to a process by
+    pickling them (i.e., to serialize and deserialize them). It is measured on (at most) the first
+    max_size elements of each array and scaled to the size of the arrays.
+    """
+    total_time = 0.
+    for name in arrays.keys():
+        array = arrays[name]
+        if len(array) == 0:
+            continue
+        sample = np.array(array[:max_size])
+        start = time.time()
+        pickle.loads(pickle.dumps(sample,2))
+        total_time = total_time + (time.time()-start)*len(array)/np.double(len(sample))
+    return total_time
+
+class SharedContext:
+    """
+    This class publishes the data of a fit (a dictionary of numpy arrays and a dictionary with the rest
+    of the context, which is pickled) as read-only files in a new folder on a memory-backed filesystem
+    (see get_shared_dir), which other processes map into memory without copying them (see attach_context).
+    The folder is removed when close is called (which can be done as soon as all the processes are attached,
+    as mapped files stay valid after they are removed), when the process exits or is terminated and, if
+    the process is killed, by the next process that publishes a context. To remove it on termination, 
+    termination signals are made to exit the process normally while the context is open (if they have 
+    the default handler); the default handler is restored by close.
+    """
+    def __init__(self,arrays,meta):
+        clean_stale_contexts()
+        start = time.time()
+        self.path = tempfile.mkdtemp(prefix='exonailer_ctx_'+str(os.getpid())+'_',dir=get_shared_dir())
+        atexit.register(self.close)
+        # Make termination signals exit the process normally, so the folder is removed:
+        self.handler = None
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            self.handler = lambda signum,frame: sys.exit(1)
+            signal.signal(signal.SIGTERM,self.handler)
+        self.nbytes = 0
+        for name in arrays.keys():
+            np.save(os.path.join(self.path,name+'.npy'),np.ascontiguousarray(arrays[name]))
+            self.nbytes = self.nbytes + arrays[name].nbytes
+        f = open(os.path.join(self.path,'meta.pkl'),'wb')
+        pickle.dump(meta,f,2)
+        f.close()
+        self.publish_time = time.time()-start
+
+    def close(self):
+        if self.path is not None:
+            shutil.rmtree(self.path,ignore_errors=True)
+            self.path = None
+        if self.handler is not None:
+            if signal.getsignal(signal.SIGTERM) == self.handler:
+                signal.signal(signal.SIGTERM,signal.SIG_DFL)
+            self.handler = None
+
+def attach_context(path):
+    """
+    This function attaches to a context published by SharedContext. It returns the dictionary of
+    arrays (as read-only memory-maps) and the dictionary with the rest of the context.
+    """
+    arrays = {}
+    for fname in glob.glob(os.path.join(path,'*.npy')):
+        arrays[os.path.basename(fname)[:-4]] = np.load(fname,mmap_mode='r')
+    f = open(os.path.join(path,'meta.pkl'),'rb')
+    meta = pickle.load(f)
+    f.close()
+    return arrays,meta
+
+def send(channel,message):
+    pickle.dump(message,channel,2)
+    channel.flush()
+
+def receive(channel):
+    try:
+        return pickle.load(channel)
+    except EOFError:
+        raise RuntimeError('A posterior worker exited unexpectedly.')
+
+class PipeChannel:
+    """
+    This class gives the pipes between a WorkerPool and one of its workers the send and recv 
+    methods of the connections of a SocketPool, so PosteriorWorker can serve on both.
+    """
+    def __init__(self,channel_in,channel_out):
+        self.channel_in = channel_in
+        self.channel_out = channel_out
+
+    def send(self,message):
+        send(self.channel_out,message)
+
+    def recv(self):
+        return pickle.load(self.channel_in)
+
+class WorkerPool:
+    """
+    This class runs a pool of nworkers processes that evaluate the posterior of a fit. The data of the
+    fit is published once in a SharedContext, and each worker (a new python process, see worker_main)
+    attaches to it, sets the fit up exactly as the main process does (see data_utils.exonailer_mcmc_fit)
+    and evaluates the posterior on the parameter vectors it receives. Its map method can be used as the
+    pool of an emcee sampler (the function passed to it is ignored, as the workers evaluate their own copy
+    of the posterior). On start, the publishing and start-up times and the memory of the workers are
+    measured and compared with the cost of pickling the data to each worker; these are kept in stats.
+    """
+    def __init__(self,arrays,meta,nworkers):
+        self.context = SharedContext(arrays,meta)
+        start = time.time()
+        script = os.path.abspath(__file__)
+        if script.endswith('.pyc'):
+            script = script[:-1]
+        self.workers = []
+        for i in range(nworkers):
+            self.workers.append(subprocess.Popen([sys.executable,script,self.context.path],bufsize=-1,\
+                                                 stdin=subprocess.PIPE,stdout=subprocess.PIPE))
+        for worker in self.workers:
+            receive(worker.stdout)
+        startup_time = time.time()-start
+        # The workers have mapped the data, so it can be removed from the filesystem:
+        self.context.close()
+        rss = [get_rss(worker.pid) for worker in self.workers]
+        self.stats = {'nworkers':nworkers,'shared_mb':self.context.nbytes/1024.**2,\
+                      'publish_time':self.context.publish_time,'startup_time':startup_time,\
+                      'pickle_time_per_worker':get_pickle_time(arrays)}
+        if None not in rss:
+            for key in ['total','private','shared']:
+                self.stats['worker_rss_'+key+'_mb'] = float(np.mean([r[key] for r in rss]))
+        print '\t Started {0:} posterior workers in {1:.2f} s. Shared data: {2:.1f} MB, published once in {3:.2f} s '.format(\
+              nworkers,startup_time,self.stats['shared_mb'],self.stats['publish_time'])+\
+              '(pickling it would copy it to each worker, taking {0:.2f} s per worker).'.format(self.stats['pickle_time_per_worker'])
+        if None not in rss:
+            print '\t Mean memory per worker: {0:.1f} MB ({1:.1f} MB of it shared with the other workers).'.format(\
+                  self.stats['worker_rss_total_mb'],self.stats['worker_rss_shared_mb'])
+
+    def map(self,function,positions):
+        positions = list(positions)
+        chunks = np.array_split(np.arange(len(positions)),len(self.workers))
+        for worker,chunk in zip(self.workers,chunks):
+            send(worker.stdin,('evaluate',[positions[i] for i in chunk]))
+        # Gather the replies of all the workers (even after an error, so none is left pending):
+        results,errors = [],[]
+        for worker in self.workers:
+            status,values = receive(worker.stdout)
+            if status == 'error':
+                errors.append(values)
+            else:
+                results = results + values
+        if len(errors) > 0:
+            raise RuntimeError('Error on a posterior worker:\n'+errors[0])
+        return results
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                send(worker.stdin,('close',None))
+            except:
+                pass
+            worker.wait()
+        self.workers = []
+        self.context.close()
+
+class PosteriorWorker:
+    """
+    This class is the end of a worker process that talks to its WorkerPool or SocketPool through 
+    channel (a PipeChannel or a connection). It holds the arrays and the context attached by the 
+    worker, which are used to set the fit up, and serves the evaluations of the posterior.
+    """
+    def __init__(self,channel,arrays,meta):
+        self.channel = channel
+        self.arrays = arrays
+        self.meta = meta
+
+    def serve(self,lnprob):
+        self.channel.send(('ready',os.getpid()))
+        while True:
+            try:
+                command,positions = self.channel.recv()
+            except EOFError:
+                break
+            if command == 'close':
+                break
+            try:
+                self.channel.send(('ok',[lnprob(position) for position in positions]))
+            except:
+                self.channel.send(('error',traceback.format_exc()))
+
+def run_worker(arrays,meta,channel):
+    """
+    This function runs the set-up of the fit described by arrays and meta (see WorkerPool) in 
+    worker mode, which ends serving the evaluations of the posterior received from channel 
+    until the pool is closed.
+    """
+    if 'data_utils' not in sys.modules.keys():
+        import matplotlib
+        matplotlib.use('Agg')
+        sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import data_utils
+    tr_instruments,rv_instruments = meta['tr_instruments'],meta['rv_instruments']
+    if tr_instruments is not None:
+        tr_instruments['codes'] = arrays['tr_codes']
+    if rv_instruments is not None:
+        rv_instruments['codes'] = arrays['rv_codes']
+    if meta['resampling_instruments'] is None:
+        idx_resampling = []
+    else:
+        idx_resampling = {}
+        for instrument in meta['resampling_instruments']:
+            idx_resampling[instrument] = arrays.get('idx_resampling_'+instrument,[])
+    worker = PosteriorWorker(channel,arrays,meta)
+    data_utils.exonailer_mcmc_fit(arrays.get('times'),arrays.get('relative_flux'),arrays.get('error'),tr_instruments,\
+                                  arrays.get('times_rv'),arrays.get('rv'),arrays.get('rv_err'),rv_instruments,\
+                                  meta['parameters'],idx_resampling,meta['options'],worker = worker)
+
+def worker_main(path):
+    """
+    This function is the entry point of the worker processes of a WorkerPool. It attaches to the 
+    context of the fit published at path and runs the worker (see run_worker).
+    """
+    # Keep the standard output for the messages to the pool, and discard the rest of the output
+    # (i.e., the messages printed while setting the fit up):
+    channel_out = os.fdopen(os.dup(1),'wb')
+    os.dup2(os.open(os.devnull,os.O_WRONLY),1)
+    channel_in = os.fdopen(0,'rb')
+    arrays,meta = attach_context(path)
+    run_worker(arrays,meta,PipeChannel(channel_in,channel_out))
+
+def split_address(address):
+    host,port = address.strip().rsplit(':',1)
+    return host,int(port)
+
+def get_authkey():
+    """
+    This function returns the key with which the SocketPool and the posterior workers of serve_worker 
+    authenticate each other, read from the EXONAILER_AUTHKEY environment variable (it is not read from 
+    the options, as these are saved with the results and sent to the workers).
+    """
+    authkey = os.environ.get('EXONAILER_AUTHKEY','')
+    if authkey == '':
+        raise RuntimeError('The EXONAILER_AUTHKEY environment variable must be set to use the socket posterior workers.')
+    return authkey
+
+class SocketPool:
+    """
+    This class distributes the evaluations of the posterior of a fit among posterior workers running 
+    on other processes or nodes (see serve_worker), listening at the given addresses ("host:port"). 
+    Connections are authenticated with the key given by get_authkey. The data of the fit (the same 
+    arrays and context a WorkerPool publishes) is sent once to each worker on connection, and each 
+    worker holds the set-up fit until the pool is closed. Each map splits the positions in batches 
+    (two per worker), which are sent to the workers as they become free; if a worker is lost, or it 
+    does not answer a batch within timeout seconds, its batch is re-queued on the rest (the results 
+    do not depend on which worker evaluates them). Connection and start-up times are kept in stats.
+    """
+    def __init__(self,arrays,meta,addresses,timeout=600.):
+        start = time.time()
+        authkey = get_authkey()
+        self.timeout = timeout
+        context = pickle.dumps(('context',(arrays,meta)),2)
+        self.workers = []
+        self.lost = []
+        self.nrequeued = 0
+        for address in addresses:
+            try:
+                connection = Client(split_address(address),authkey=authkey)
+                connection.send_bytes(context)
+                self.workers.append({'address':address,'connection':connection})
+            except (socket.error,EOFError,IOError,AuthenticationError) as e:
+                print '\t Warning: could not connect to the posterior worker at '+address+' ('+str(e)+').'
+        # Wait for the workers to set the fit up:
+        for worker in list(self.workers):
+            try:
+                if not worker['connection'].poll(timeout):
+                    raise IOError('timed out')
+                worker['connection'].recv()
+            except Exception:
+                self.drop(worker)
+        if len(self.workers) == 0:
+            raise RuntimeError('Could not start any of the posterior workers at '+','.join(addresses)+'.')
+        startup_time = time.time()-start
+        self.stats = {'nworkers':len(self.workers),'addresses':[w['address'] for w in self.workers],\
+                      'context_mb':len(context)/1024.**2,'startup_time':startup_time}
+        print '\t Connected to {0:} posterior workers in {1:.2f} s (fit data sent to each: {2:.1f} MB).'.format(\
+              len(self.workers),startup_time,self.stats['context_mb'])
+
+    def drop(self,worker):
+        print '\t Warning: lost the posterior worker at '+worker['address']+'.'
+        self.workers.remove(worker)
+        self.lost.append(worker['address'])
+        try:
+            worker['connection'].close()
+        except (socket.error,IOError):
+            pass
+
+    def map(self,function,positions):
+        positions = list(positions)
+        batches = [list(batch) for batch in np.array_split(np.arange(len(positions)),2*len(self.workers)) if len(batch) > 0]
+        results = [None]*len(positions)
+        busy = {}
+        errors = []
+        while len(batches) > 0 or len(busy) > 0:
+            # Send the pending batches to the free workers:
+            for worker in list(self.workers):
+                if len(batches) == 0:
+                    break
+                if worker['address'] in busy.keys():
+                    continue
+                batch = batches.pop(0)
+                try:
+                    worker['connection'].send(('evaluate',[positions[i] for i in batch]))
+                    busy[worker['address']] = (worker,batch,time.time())
+                except Exception:
+                    batches.insert(0,batch)
+                    self.drop(worker)
+            if len(self.workers) == 0:
+                raise RuntimeError('All the posterior workers were lost.')
+            # Gather the results of the workers that are done, re-queuing the batches of the lost ones 
+            # and of the ones that did not answer in time:
+            wait = np.max([np.min([sent+self.timeout for worker,batch,sent in busy.values()])-time.time(),0.])
+            readable = select.select([worker['connection'] for worker,batch,sent in busy.values()],[],[],wait)[0]
+            for address in busy.keys():
+                worker,batch,sent = busy[address]
+                if worker['connection'] not in readable:
+                    if time.time()-sent > self.timeout:
+                        print '\t Warning: the posterior worker at '+address+' did not answer in {0:.0f} s.'.format(self.timeout)
+                        del busy[address]
+                        batches.append(batch)
+                        self.nrequeued = self.nrequeued + 1
+                        self.drop(worker)
+                    continue
+                del busy[address]
+                try:
+                    status,values = worker['connection'].recv()
+                except Exception:
+                    batches.append(batch)
+                    self.nrequeued = self.nrequeued + 1
+                    self.drop(worker)
+                    continue
+                if status == 'error':
+                    # Stop sending batches, but gather the replies of the busy workers before raising 
+                    # the error, so none is left pending:
+                    errors.append('Error on the posterior worker at '+address+':\n'+values)
+                    batches = []
+                    continue
+                for i,value in zip(batch,values):
+                    results[i] = value
+            if len(errors) > 0 and len(busy) == 0:
+                raise RuntimeError(errors[0])
+        return results
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker['connection'].send(('close',None))
+                worker['connection'].close()
+            except Exception:
+                pass
+        self.workers = []
+        self.stats['lost'] = self.lost
+        self.stats['requeued_batches'] = self.nrequeued
+
+def serve_worker(address):
+    """
+    This function runs a posterior worker listening at address ("host:port") for SocketPool 
+    connections, which must authenticate with the key given by get_authkey. On each connection, 
+    it receives the data of the fit, sets it up and serves the evaluations of the posterior until 
+    the pool is closed; then, it waits for the next fit.
+    """
+    server = Listener(split_address(address),family='AF_INET',authkey=get_authkey())
+    while True:
+        print '\t Posterior worker listening at '+address+'...'
+        sys.stdout.flush()
+        try:
+            connection = server.accept()
+        except (AuthenticationError,EOFError,IOError) as e:
+            print '\t Warning: rejected a connection ('+str(e)+').'
+            continue
+        try:
+            command,(arrays,meta) = connection.recv()
+            print '\t Setting up the fit of '+meta['options']['TARGET']+' for '+str(server.last_accepted[0])+'...'
+            run_worker(arrays,meta,connection)
+        except (EOFError,IOError,socket.error):
+            pass
+        connection.close()
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--listen':
+        serve_worker(sys.argv[2])
+    else:
+        worker_main(sys.argv[1])